@@ -14,12 +14,38 @@ communes_path = "/Users/noa/Desktop/PRISM/Data/MISC/CONVERTED/test.shp"
 # Chemin du fichier SHP "département"
 departements_path = "/Users/noa/Desktop/PRISM/Data/MISC/Autres polygones administratifs/DEPARTEMENT.shp"
 
+# Dossier du cache des poids d'intersection grille SAFRAN / référence
+cache_path = "/Users/noa/Desktop/PRISM/Data/MISC/CACHE_DRIAS"
+
 # Options de traitement
 GENERER_VERIFICATION = False  # True pour OUI, False pour NON - Générer les fichiers de vérification
+NB_VERIFICATIONS = 5          # Nombre d'entités dont le calcul est détaillé dans la table de vérification
+GRAINE_VERIFICATION = 0       # Graine du tirage des entités vérifiées (mêmes entités à chaque exécution)
+FIGURES_VERIFICATION = True   # True pour OUI, False pour NON - Une figure par entité vérifiée (cellules coloriées par poids)
 GENERER_CARTES = False        # True pour OUI, False pour NON - Générer les cartes
 GENERER_CSV = False           # True pour OUI, False pour NON - Générer les fichiers CSV
+GENERER_NIVEAUX_DETAIL = False  # True pour OUI, False pour NON - Mettre en cache les géométries simplifiées (10, 100, 200, 500 m) de la référence pour les cartes et l'application
 CALCUL_DEPARTEMENT = False     # True pour OUI, False pour NON - Effectuer les calculs par département
 TRAITER_DOSSIER_COMPLET = True  # True pour traiter tous les fichiers .txt du dossier, False pour traiter un seul fichier
+UTILISER_CACHE_POIDS = True     # True pour OUI, False pour NON - Réutiliser les poids d'intersection déjà calculés
+MOTEUR_INTERSECTION = "RECTANGLES"  # Options: "RECTANGLES" (noyau NumPy pour cellules carrées), "SHAPELY" (GEOS) ou "RASTER" (approché, exploratoire)
+RESOLUTION_RASTER = 200         # Taille des pixels en mètres pour le moteur "RASTER" (100 à 250 m)
+MODE_VALEURS = "SURFACE"        # Options: "SURFACE" (moyenne pondérée par l'aire), "BILINEAIRE" ou "IDW" (valeur interpolée au centroïde)
+TOLERANCE_RASTER = 0.05         # Erreur maximale admise sur les poids du moteur "RASTER" (contrôlée sur un échantillon)
+UTILISER_CACHE_LECTURE = True   # True pour OUI, False pour NON - Réutiliser les tables déjà lues (Parquet à côté du .txt)
+NORMALISER_REF = False          # True pour OUI, False pour NON - Écrire les variations (écart et %) par rapport au fichier REFERENCE dans Data/DRIAS_NORM/{dossier}/Resultats (remplace normalize_drias_data.R)
+STATISTIQUES_ENSEMBLE = False   # True pour OUI, False pour NON - Moyenne, écart-type et quantiles entre les fichiers (modèles) d'un même scénario, par entité (Resultats/Ensemble/)
+TRAITEMENT_INCREMENTAL = True   # True pour OUI, False pour NON - Ne retraiter que les fichiers nouveaux ou modifiés, ou dont les options ou la référence ont changé (manifeste dans Resultats/)
+NB_PROCESSUS = 0                # Nombre de processus pour un dossier complet (0 = tous les cœurs, 1 = séquentiel ; un seul thread dans un lot parallèle)
+NB_THREADS = 0                  # Threads pour le calcul des poids d'un fichier, par blocs d'entités voisines (0 = tous les cœurs, 1 = séquentiel ; un seul thread dans un lot parallèle)
+RAPPORT_THREADS = False         # True pour OUI, False pour NON - Mesurer le passage à l'échelle du calcul des poids (1, 2, 4... threads)
+MODE_TUILES = "AUCUN"           # Options: "AUCUN" (fichier entier en mémoire), "DEPARTEMENT" ou "TUILE" (carrés) - exécution à mémoire bornée pour les couches nationales
+BUDGET_MEMOIRE_MO = 2000        # Mémoire visée par tuile en Mo pour MODE_TUILES (les tuiles sont découpées pour tenir dans ce budget)
+FORMAT_SORTIE = "GPKG"          # Options: "GPKG" (géométrie dans chaque fichier) ou "PARQUET" (valeurs seules + couche GEOMETRIES_ commune)
+FORMAT_CUBE = "AUCUN"           # Options: "AUCUN", "ZARR" ou "NETCDF" - Cube entité x variable x scénario x horizon x saison de tous les résultats du lot
+EXPORT_TUILES = "AUCUN"         # Options: "AUCUN", "PMTILES" ou "MBTILES" - Tuiles vectorielles hors ligne de chaque couche de résultats (mises à jour si la couche a changé)
+NB_PROCESSUS_CARTES = 0         # Processus de rendu des cartes d'un fichier (0 = tous les cœurs, 1 = séquentiel ; séquentiel dans un lot parallèle)
+RASTERISER_CARTES = False       # True pour OUI, False pour NON - Remplissages des cartes PDF tramés à 300 dpi (contours vectoriels), fichiers plus légers pour les couches nationales
 
 # Si TRAITER_DOSSIER_COMPLET est False, spécifier le fichier individuel à traiter
 fichier_individuel = "/Users/noa/Desktop/TESTING/INDICATEURS_SAISONNIERS_ETE/DRIAS_ETE_REFERENCE.txt"
@@ -27,15 +53,136 @@ fichier_individuel = "/Users/noa/Desktop/TESTING/INDICATEURS_SAISONNIERS_ETE/DRI
 # =========== NE PAS MODIFIER ===========
 # =====================================================
 import pandas as pd
-import geopandas as gpd
 import numpy as np
-import matplotlib.pyplot as plt
-import random
 import os
-from shapely.geometry import Point
 from matplotlib.colors import LinearSegmentedColormap
 import matplotlib.patheffects as pe
 import re
+from drias_interpolation import PAS_SAFRAN, reseau_safran, matrice_interpolation
+from drias_lecture import lire_fichier_drias, preparer_cache_lecture, resumer_cache_lecture, lire_cache_cellules
+from drias_lots import charger_couche, chemin_temporaire, ecrire_atomique, traiter_lot
+from drias_cartes import rendre_cartes
+from drias_cube import chemin_cube, ecrire_cube
+from drias_manifeste import ManifesteLot
+from drias_normalisation import NormalisationRef
+from drias_ensemble import EnsembleDrias
+from drias_verification import echantillon_entites, figures_verification, table_verification
+from drias_simplification import NIVEAUX_DETAIL, nb_sommets, niveau_pour_resolution, niveaux_detail
+from drias_tuiles_web import exporter_tuiles
+from drias_sorties import SortieSansGeometrie, ecrire_sans_geometrie, empreinte_couche
+from drias_poids import (GrilleSafran, cle_cellules, valeurs_par_cellule, grille_depuis_registre,
+                         geometries_grille, construire_matrice_poids_parallele, mesurer_parallelisme, moyennes_ponderees,
+                         groupes_par_point_interieur, matrice_groupes, agreger_poids, comparer_appariement,
+                         comparer_moteurs, comparer_raster, cle_cache_poids, charger_poids_cache,
+                         sauvegarder_poids_cache)
+from drias_tuiles import (cellules_emprise, entites_de_la_tuile, fids_couche, infos_couche, lire_entites,
+                          memoire_max_mo, profil_memoire, tuiles_reference)
+
+# Sélection et renommage des colonnes de la couche de référence pour le fichier final
+def preparer_unites_jointure(unites_jointure):
+    if TYPE_REFERENCE == "COMMUNE":
+        # Mapping des colonnes pour le format commune
+        colonnes_requises = ["geometry"]
+        colonnes_a_renommer = {}
+
+        # Vérification et mapping des colonnes potentielles pour les communes
+        if "NOM" in unites_jointure.columns:
+            colonnes_requises.append("NOM")
+            colonnes_a_renommer["NOM"] = "LIB"
+        elif "nom" in unites_jointure.columns:
+            colonnes_requises.append("nom")
+            colonnes_a_renommer["nom"] = "LIB"
+
+        if "INSEE_COM" in unites_jointure.columns:
+            colonnes_requises.append("INSEE_COM")
+            colonnes_a_renommer["INSEE_COM"] = "CODE_C"
+        elif "Code_commu" in unites_jointure.columns:
+            colonnes_requises.append("Code_commu")
+            colonnes_a_renommer["Code_commu"] = "CODE_C"
+        elif "code_insee" in unites_jointure.columns:
+            colonnes_requises.append("code_insee")
+            colonnes_a_renommer["code_insee"] = "CODE_C"
+
+        if "DEP" in unites_jointure.columns:
+            colonnes_requises.append("DEP")
+        elif "CODE_DEPT" in unites_jointure.columns:
+            colonnes_requises.append("CODE_DEPT")
+            colonnes_a_renommer["CODE_DEPT"] = "DEP"
+    else:  # TYPE_REFERENCE == "POSTAL"
+        # Mapping des colonnes pour le format code postal
+        colonnes_requises = ["geometry"]
+        colonnes_a_renommer = {}
+
+        # Vérification et mapping des colonnes potentielles pour les codes postaux
+        if "LIB" in unites_jointure.columns:
+            colonnes_requises.append("LIB")
+        elif "NOM" in unites_jointure.columns:
+            colonnes_requises.append("NOM")
+            colonnes_a_renommer["NOM"] = "LIB"
+
+        if "ID" in unites_jointure.columns:
+            colonnes_requises.append("ID")
+            colonnes_a_renommer["ID"] = "CODE_C"
+
+        if "DEP" in unites_jointure.columns:
+            colonnes_requises.append("DEP")
+
+    # Sélectionner uniquement les colonnes existantes
+    colonnes_existantes = [col for col in colonnes_requises if col in unites_jointure.columns]
+    unites_jointure = unites_jointure[colonnes_existantes].copy()
+
+    # Renommer les colonnes selon le mapping défini
+    return unites_jointure.rename(columns=colonnes_a_renommer)
+
+# Colonnes NOM / INSEE_DEP de la couche des départements, en Lambert 93
+def preparer_departements(departements_jointure):
+    # Vérifier et sélectionner les colonnes d'intérêt pour les départements
+    colonnes_requises_dep = ["geometry"]
+    colonnes_a_renommer_dep = {}
+
+    # Vérification et mapping des colonnes potentielles pour les départements
+    if "NOM" in departements_jointure.columns:
+        colonnes_requises_dep.append("NOM")
+    elif "Nom" in departements_jointure.columns:
+        colonnes_requises_dep.append("Nom")
+        colonnes_a_renommer_dep["Nom"] = "NOM"
+
+    if "INSEE_DEP" in departements_jointure.columns:
+        colonnes_requises_dep.append("INSEE_DEP")
+    elif "CODE_DEPT" in departements_jointure.columns:
+        colonnes_requises_dep.append("CODE_DEPT")
+        colonnes_a_renommer_dep["CODE_DEPT"] = "INSEE_DEP"
+
+    # Sélectionner uniquement les colonnes existantes
+    colonnes_existantes_dep = [col for col in colonnes_requises_dep if col in departements_jointure.columns]
+    departements_jointure = departements_jointure[colonnes_existantes_dep].copy()
+
+    # Renommer les colonnes selon le mapping défini
+    departements_jointure = departements_jointure.rename(columns=colonnes_a_renommer_dep)
+
+    # Assurer que les départements ont le même CRS que la grille
+    if departements_jointure.crs != "EPSG:2154":
+        departements_jointure = departements_jointure.to_crs("EPSG:2154")
+
+    # Colonnes conservées pour les départements
+    colonnes_dep = ['geometry']
+    if 'NOM' in departements_jointure.columns:
+        colonnes_dep.append('NOM')
+    if 'INSEE_DEP' in departements_jointure.columns:
+        colonnes_dep.append('INSEE_DEP')
+
+    return departements_jointure[colonnes_dep].copy()
+
+# Écriture d'une couche de résultats au format choisi (FORMAT_SORTIE)
+def ecrire_resultat(gdf, chemin_sans_extension, nom_geometries, empreinte, colonnes_valeurs):
+    """Écrit `gdf` en GeoPackage, ou en table Parquet sans géométrie reliée à la couche GEOMETRIES_{nom_geometries}.gpkg
+    (écrite une seule fois pour la référence identifiée par `empreinte`). Retourne le chemin écrit."""
+    if FORMAT_SORTIE == "PARQUET":
+        return ecrire_sans_geometrie(chemin_sans_extension + ".parquet", gdf, os.path.dirname(chemin_sans_extension),
+                                     nom_geometries, empreinte, colonnes_valeurs)
+    chemin = chemin_sans_extension + ".gpkg"
+    ecrire_atomique(chemin, lambda c: gdf.to_file(c, driver="GPKG"))
+    return chemin
 
 # Fonction pour traiter un seul fichier
 def traiter_fichier(fichier_entree, reference_path, departements_path):
@@ -43,106 +190,24 @@ def traiter_fichier(fichier_entree, reference_path, departements_path):
     print(f"TRAITEMENT DU FICHIER: {fichier_entree}")
     print("="*80 + "\n")
     
-    fichier_sortie = fichier_entree.replace(".txt", "_clean.csv")
-    
-    # Nettoyage du fichier CSV
     # Vérifier si le fichier existe
     if not os.path.exists(fichier_entree):
         print(f"Erreur: Le fichier {fichier_entree} n'existe pas.")
         return False
     
     try:
+        # Lecture en un seul passage : en-tête repéré dans les commentaires, colonnes typées
         print(f"Lecture du fichier: {fichier_entree}")
-        
-        # Lire tout le contenu du fichier
-        with open(fichier_entree, 'r', encoding='utf-8') as file:
-            content = file.read()
-            
-        # Afficher les 300 premiers caractères pour le débogage
-        print("Début du fichier (300 premiers caractères):")
-        print(content[:300])
-        
-        # Diviser le contenu en lignes
-        lines = content.splitlines()
-        print(f"Nombre de lignes dans le fichier: {len(lines)}")
-        
-        # Variables pour stocker l'en-tête et les données
-        header = ""
-        data_lines = []
-        
-        # On cherche d'abord la ligne contenant "Format des enregistrements"
-        format_line_index = -1
-        for i, line in enumerate(lines):
-            if "Format des enregistrements" in line:
-                format_line_index = i
-                print(f"Ligne 'Format des enregistrements' trouvée à l'index {i}: {line}")
-                break
-        
-        if format_line_index == -1:
-            print("ERREUR: Ligne 'Format des enregistrements' non trouvée!")
-            # Essayons une approche alternative
-            for i, line in enumerate(lines):
-                if ";" in line and line.startswith("#"):
-                    print(f"Ligne d'en-tête potentielle trouvée à l'index {i}: {line}")
-                    header = line.replace("#", "").strip()
-                    break
-        else:
-            # Chercher la ligne d'en-tête après "Format des enregistrements"
-            for i in range(format_line_index + 1, min(format_line_index + 5, len(lines))):
-                if i < len(lines) and ";" in lines[i] and lines[i].startswith("#"):
-                    print(f"Ligne d'en-tête trouvée à l'index {i}: {lines[i]}")
-                    header = lines[i].replace("#", "").strip()
-                    break
-        
-        # Si on a trouvé l'en-tête, on cherche les lignes de données
-        if header:
-            print(f"En-tête trouvée: {header}")
-            # Chercher les lignes de données (celles contenant des points-virgules mais ne commençant pas par #)
-            for i, line in enumerate(lines):
-                if ";" in line and not line.startswith("#") and len(line.strip()) > 0:
-                    data_lines.append(line.strip())
-                    if len(data_lines) <= 3:  # Afficher seulement les 3 premières lignes pour le débogage
-                        print(f"Ligne de données trouvée: {line.strip()}")
-            
-            print(f"Nombre total de lignes de données trouvées: {len(data_lines)}")
-        else:
-            print("ERREUR: Impossible de trouver la ligne d'en-tête!")
-            # Essayons une autre méthode - chercher directement les lignes avec des nombres et des points-virgules
-            for i, line in enumerate(lines):
-                if ";" in line and any(c.isdigit() for c in line) and not line.startswith("#"):
-                    if not data_lines:
-                        print("Recherche de lignes de données sans en-tête...")
-                    data_lines.append(line.strip())
-                    if len(data_lines) <= 3:
-                        print(f"Ligne de données potentielle: {line.strip()}")
-            
-            if data_lines:
-                print(f"Trouvé {len(data_lines)} lignes de données sans en-tête.")
-                # Essayer de déduire l'en-tête à partir des lignes de données
-                if ";" in data_lines[0]:
-                    num_columns = data_lines[0].count(";")
-                    print(f"Création d'un en-tête générique avec {num_columns+1} colonnes")
-                    header = ";".join([f"Col{i}" for i in range(1, num_columns+2)])
-                    print(f"En-tête générée: {header}")
-        
-        # Écrire le fichier de sortie si on a des données
-        if header and data_lines:
-            with open(fichier_sortie, 'w', encoding='utf-8') as output_file:
-                output_file.write(header + "\n")
-                for line in data_lines:
-                    output_file.write(line + "\n")
-            
-            print(f"Succès! Fichier nettoyé enregistré dans {fichier_sortie}")
-        else:
-            print("Échec: Impossible de créer le fichier de sortie (en-tête ou données manquantes)")
+        df = lire_fichier_drias(fichier_entree, utiliser_cache=UTILISER_CACHE_LECTURE, nom_periode='Période')
+        if df is None or df.empty:
+            print("Échec: Impossible de lire les données du fichier (en-tête ou données manquantes)")
             return False
+        print(f"Données chargées avec {len(df)} lignes")
     
-        # Chemin du fichier nettoyé
-        csv_path = fichier_sortie
-        
         # Création des noms de fichiers de sortie basés sur le fichier d'entrée
-        base_dir = os.path.dirname(csv_path)
-        base_filename = os.path.splitext(os.path.basename(csv_path))[0]
+        # (suffixe "_clean" conservé pour les scripts qui relisent les résultats)
+        base_dir = os.path.dirname(fichier_entree)
+        base_filename = os.path.splitext(os.path.basename(fichier_entree))[0] + "_clean"
         
         # Création des dossiers de sortie uniquement si nécessaire
         resultats_dir = os.path.join(base_dir, "Resultats")
@@ -156,13 +221,8 @@ def traiter_fichier(fichier_entree, reference_path, departements_path):
             cartes_dir = os.path.join(base_dir, "Cartes")
             os.makedirs(cartes_dir, exist_ok=True)
         
-        # Chargement des données
-        print("Chargement du CSV...")
-        df = pd.read_csv(csv_path, sep=";")
-        print(f"CSV chargé avec {len(df)} lignes")
-        
         # Extraction des scénarios et variables disponibles
-        scenarios = df['Période'].unique() if 'Période' in df.columns else df['PÃ©riode'].unique()
+        scenarios = df['Période'].unique()
         print(f"Scénarios trouvés: {scenarios}")
         
         # Détection automatique des colonnes de données numériques (variables climatiques)
@@ -182,31 +242,93 @@ def traiter_fichier(fichier_entree, reference_path, departements_path):
             raise ValueError("Aucune variable climatique numérique détectée dans le jeu de données")
         
         print("Chargement du fichier de référence...")
-        reference_gdf = gpd.read_file(reference_path)
+        reference_gdf = charger_couche(reference_path)
         print(f"Entités chargées : {len(reference_gdf)} entités")
         
-        # Créer un GeoDataFrame en utilisant Longitude et Latitude
-        geometry = [Point(xy) for xy in zip(df['Longitude'], df['Latitude'])]
-        gdf = gpd.GeoDataFrame(df, geometry=geometry)
-        
-        # Définir le CRS et reprojeter vers Lambert 93
-        gdf.crs = "EPSG:4326"  # WGS 84 (standard pour lat/long)
-        gdf_lambert = gdf.to_crs("EPSG:2154")  # Lambert 93
-        
-        # Créer la grille de 4000m x 4000m
-        buffer_gdf = gdf_lambert.copy()
-        buffer_gdf['geometry'] = gdf_lambert.buffer(4000, cap_style=3, join_style=2)
-        
-        # Assurons-nous que le fichier de référence a le même CRS
-        if reference_gdf.crs != buffer_gdf.crs:
-            print(f"Reprojection du fichier de référence de {reference_gdf.crs} vers {buffer_gdf.crs}")
-            reference_gdf = reference_gdf.to_crs(buffer_gdf.crs)
+        # Assurons-nous que le fichier de référence est en Lambert 93 (CRS de la grille)
+        if reference_gdf.crs != "EPSG:2154":
+            print(f"Reprojection du fichier de référence de {reference_gdf.crs} vers EPSG:2154")
+            reference_gdf = reference_gdf.to_crs("EPSG:2154")
         
         # Ajouter une colonne d'index original pour la traçabilité
         reference_gdf['index_original'] = reference_gdf.index
         
-        # Dictionnaire pour stocker les GeoDataFrames résultants pour chaque scénario et variable
-        resultats_communes = {}
+        # Niveaux de détail de la référence (cache à côté de la couche) ; les cartes utilisent le moins
+        # détaillé dont la tolérance reste sous la taille d'un pixel (page de 11 pouces à 300 dpi)
+        if GENERER_CARTES or GENERER_NIVEAUX_DETAIL:
+            niveaux_reference = niveaux_detail(reference_path, reference_gdf.geometry)
+            xmin, ymin, xmax, ymax = reference_gdf.total_bounds
+            geometries_carte = niveaux_reference[niveau_pour_resolution(NIVEAUX_DETAIL, max(xmax - xmin, ymax - ymin) / (11 * 300))]
+        
+        # Cellules SAFRAN uniques triées par identifiant (la grille est la même pour tous les scénarios du fichier)
+        cle_grille = cle_cellules(df)
+        cellules_df = df.loc[~cle_grille.duplicated().to_numpy(), ['Longitude', 'Latitude']]
+        cellules_df.index = cle_grille[~cle_grille.duplicated()].to_numpy()
+        cellules_df = cellules_df.sort_index()
+        ids_cellules = cellules_df.index.to_numpy()
+        print(f"Cellules SAFRAN uniques: {len(ids_cellules)}")
+        
+        # Grille implicite : centres des cellules en Lambert 93 et demi-côté, sans polygones ;
+        # les coordonnées projetées sont lues dans le registre de la grille (jointure sur l'identifiant)
+        grille, _ = grille_depuis_registre(ids_cellules, cellules_df['Longitude'],
+                                           cellules_df['Latitude'], cache_path)
+        
+        # Matrice des poids : rechargée depuis le cache si la grille et la référence sont inchangées
+        matrice_poids = None
+        if MODE_VALEURS != "SURFACE":
+            # Mode ponctuel : poids d'interpolation des nœuds SAFRAN voisins du centroïde de chaque entité
+            print(f"Interpolation {MODE_VALEURS} des valeurs aux centroïdes des entités...")
+            centroides = reference_gdf.geometry.centroid
+            matrice_poids = matrice_interpolation(reseau_safran(cellules_df['Longitude'], cellules_df['Latitude']),
+                                                  centroides.x.to_numpy(), centroides.y.to_numpy(), MODE_VALEURS)
+        elif UTILISER_CACHE_POIDS:
+            cle_poids = cle_cache_poids(ids_cellules, cellules_df['Longitude'], cellules_df['Latitude'],
+                                        grille.demi_cote, reference_path,
+                                        f"RASTER_{RESOLUTION_RASTER}" if MOTEUR_INTERSECTION == "RASTER" else MOTEUR_INTERSECTION)
+            cache = charger_poids_cache(cache_path, cle_poids)
+            if cache is not None and cache[0].shape == (len(reference_gdf), len(ids_cellules)):
+                matrice_poids = cache[0]
+                print(f"Matrice des poids rechargée depuis le cache (clé {cle_poids})")
+        
+        if matrice_poids is None:
+            # Calcul unique des aires d'intersection entités x cellules (matrice creuse) ; les paires
+            # candidates sont trouvées par arithmétique sur la grille (RECTANGLES) ou par STRtree (SHAPELY)
+            print(f"Calcul de la matrice des poids (aires d'intersection entités x cellules, moteur {MOTEUR_INTERSECTION})...")
+            # Le premier fichier d'un lot est traité seul dans le processus principal : les poids y sont
+            # calculés sur tous les threads puis relus depuis le cache par les autres processus
+            matrice_poids = construire_matrice_poids_parallele(reference_gdf.geometry.values, grille, MOTEUR_INTERSECTION,
+                                                               NB_THREADS, resolution_raster=RESOLUTION_RASTER)
+            if RAPPORT_THREADS:
+                mesurer_parallelisme(reference_gdf.geometry.values, grille, MOTEUR_INTERSECTION, NB_THREADS,
+                                     resolution_raster=RESOLUTION_RASTER)
+            
+            # Mode approché : erreur maximale des poids contrôlée contre le calcul exact sur un échantillon
+            if MOTEUR_INTERSECTION == "RASTER":
+                comparer_raster(reference_gdf.geometry.values, grille, RESOLUTION_RASTER, TOLERANCE_RASTER)
+            
+            # Contrôles croisés : appariement et noyau RECTANGLES contre GEOS sur un échantillon d'entités
+            if GENERER_VERIFICATION:
+                comparer_appariement(reference_gdf.geometry.values, grille)
+                if MOTEUR_INTERSECTION == "RECTANGLES":
+                    comparer_moteurs(reference_gdf.geometry.values, grille)
+            if UTILISER_CACHE_POIDS:
+                chemin_cache = sauvegarder_poids_cache(cache_path, cle_poids, matrice_poids, ids_cellules,
+                                                       reference_gdf['index_original'].to_numpy())
+                print(f"Matrice des poids enregistrée dans le cache: {chemin_cache}")
+        nature_poids = "intersections" if MODE_VALEURS == "SURFACE" else "nœuds d'interpolation"
+        print(f"Matrice des poids: {matrice_poids.shape[0]} entités x {matrice_poids.shape[1]} cellules, "
+              f"{matrice_poids.nnz} {nature_poids}")
+        
+        # Les polygones des cellules ne sont construits que pour les cartes et les figures de vérification
+        # (voir geometries_grille)
+        grille_complete = df
+        
+        # Matrice unique des résultats (entités x sorties) en float32, colonnes dans l'ordre scénario puis
+        # variable ; les attributs et la géométrie de la référence ne sont rattachés qu'à l'écriture
+        noms_sorties = [f'{variable}_{scenario}' for scenario in scenarios for variable in colonnes_variables]
+        index_sorties = {nom: k for k, nom in enumerate(noms_sorties)}
+        resultats = np.full((len(reference_gdf), len(noms_sorties)), np.nan, dtype=np.float32)
+        sorties_calculees = []
         
         # Fonction pour créer une palette de couleurs de type température
         def create_temperature_cmap():
@@ -230,17 +352,27 @@ def traiter_fichier(fichier_entree, reference_path, departements_path):
             ]
             return LinearSegmentedColormap.from_list('rainbow', colors)
         
+        # Cartes à rendre par couche (chemin, valeurs, titre, légende) : chaque couche est dessinée une fois,
+        # seules les couleurs changent d'une carte à l'autre
+        cartes_communes, cartes_safran, cartes_departements = [], [], []
+        options_cartes = {"cmap": create_temperature_cmap(), "nb_processus": NB_PROCESSUS_CARTES,
+                          "rasteriser": RASTERISER_CARTES}
+        
         # Boucle sur chaque scénario et chaque variable
         for scenario in scenarios:
             print(f"\n==== Traitement du scénario: {scenario} ====")
             
             # Filtrer les données pour le scénario actuel
-            periode_col = 'Période' if 'Période' in buffer_gdf.columns else 'PÃ©riode'
-            grille_scenario = buffer_gdf[buffer_gdf[periode_col] == scenario]
+            periode_col = 'Période'
+            grille_scenario = grille_complete[grille_complete[periode_col] == scenario]
             print(f"Grille filtrée pour le scénario {scenario}: {len(grille_scenario)} entités")
             
+            # Moyennes pondérées de toutes les variables du scénario en un seul produit matriciel
+            valeurs_scenario = valeurs_par_cellule(grille_scenario, ids_cellules, colonnes_variables)
+            moyennes_scenario = moyennes_ponderees(matrice_poids, valeurs_scenario)
+            
             # Créer un GeoDataFrame pour chaque variable dans ce scénario
-            for variable in colonnes_variables:
+            for num_variable, variable in enumerate(colonnes_variables):
                 print(f"\n--- Traitement de la variable: {variable} ---")
                 
                 # Vérifier si la variable existe et contient des données numériques valides
@@ -252,363 +384,137 @@ def traiter_fichier(fichier_entree, reference_path, departements_path):
                     print(f"La variable {variable} ne contient pas de données numériques valides")
                     continue
                 
-                # Créer une copie du GeoDataFrame des références pour ce scénario et cette variable
-                communes_resultat = reference_gdf.copy()
-                
                 # Nom de la colonne pour stocker le résultat
                 colonne_resultat = f'{variable}_{scenario}'
-                communes_resultat[colonne_resultat] = np.nan
+                resultats[:, index_sorties[colonne_resultat]] = moyennes_scenario[:, num_variable]
+                sorties_calculees.append(colonne_resultat)
+                print(f"Moyenne pondérée calculée pour {len(reference_gdf)} entités")
                 
-                # Liste pour stocker les détails des vérifications
-                verification_details = []
-                
-                # Sélectionner aléatoirement des communes pour vérification détaillée (5 communes)
-                nb_verifications = min(5, len(communes_resultat))
-                indices_verification = random.sample(range(len(communes_resultat)), nb_verifications)
-                
-                print(f"Calcul de la moyenne pondérée pour {len(communes_resultat)} entités...")
-                print(f"Vérification détaillée pour {len(indices_verification)} entités")
-                
-                # Pour chaque entité (commune ou code postal)
-                for idx, commune in communes_resultat.iterrows():
-                    if idx % 100 == 0:
-                        print(f"Traitement de l'entité {idx}/{len(communes_resultat)}")
-                    
-                    # Variables pour calculer la moyenne pondérée
-                    total_pondéré = 0
-                    total_poids = 0
-                    
-                    # Récupérer la géométrie et l'aire de l'entité
-                    geom_commune = commune.geometry
-                    aire_commune = geom_commune.area
-                    
-                    # Liste pour stocker les détails de calcul si c'est une entité à vérifier
-                    details_calcul = []
-                    faire_verification = idx in indices_verification and GENERER_VERIFICATION
-                    
-                    # Pour chaque cellule de la grille qui intersecte cette entité
-                    cellules_intersectees = grille_scenario[grille_scenario.intersects(geom_commune)]
-                    
-                    for _, cellule in cellules_intersectees.iterrows():
-                        # Calculer l'intersection
-                        intersection = geom_commune.intersection(cellule.geometry)
-                        aire_intersection = intersection.area
-                        
-                        # Calculer le poids (proportion de l'entité dans cette cellule)
-                        poids = aire_intersection / aire_commune
-                        
-                        # Ajouter à la somme pondérée
-                        total_pondéré += cellule[variable] * poids
-                        total_poids += poids
-                        
-                        # Si c'est une entité à vérifier, stocker les détails
-                        if faire_verification:
-                            details_calcul.append({
-                                'id_cellule': cellule.name,
-                                'valeur': cellule[variable],
-                                'aire_intersection': aire_intersection,
-                                'poids': poids,
-                                'contribution': cellule[variable] * poids
-                            })
-                    
-                    # Calculer et stocker la moyenne pondérée
-                    if total_poids > 0:
-                        valeur_moyenne = total_pondéré / total_poids
-                        communes_resultat.at[idx, colonne_resultat] = valeur_moyenne
-                        
-                        # Si c'est une entité à vérifier, stocker tous les détails
-                        if faire_verification:
-                            nom_commune = commune.get('NOM', commune.get('nom', f'Commune_{idx}'))
-                            verification_details.append({
-                                'idx': idx,
-                                'nom_commune': nom_commune,
-                                'aire_commune': aire_commune,
-                                'nb_cellules': len(cellules_intersectees),
-                                'valeur_moyenne': valeur_moyenne,
-                                'details': details_calcul
-                            })
-                            
-                            # Ajouter des informations d'identification pour le débogage
-                            if 'index_original' in commune:
-                                verification_details[-1]['index_original'] = commune['index_original']
-                            if 'INSEE_COM' in commune:
-                                verification_details[-1]['INSEE_COM'] = commune['INSEE_COM']
-                            if 'code_insee' in commune:
-                                verification_details[-1]['code_insee'] = commune['code_insee']
-                
-                # Créer un rapport de vérification pour cette variable et ce scénario
-                if GENERER_VERIFICATION and verification_details:
-                    rapport_path = os.path.join(verification_dir, f"verification_calcul_{variable}_{scenario}.txt")
-                    with open(rapport_path, 'w') as f:
-                        f.write(f"RAPPORT DE VÉRIFICATION DU CALCUL DE {variable} MOYEN - SCÉNARIO {scenario}\n")
-                        f.write("=" * 70 + "\n\n")
-                        
-                        for verif in verification_details:
-                            f.write(f"COMMUNE: {verif['nom_commune']} (index_original: {verif['idx']})\n")
-                            f.write(f"Aire totale: {verif['aire_commune']:.2f} m²\n")
-                            f.write(f"Nombre de cellules intersectées: {verif['nb_cellules']}\n")
-                            f.write(f"Valeur moyenne calculée: {verif['valeur_moyenne']:.4f}\n\n")
-                            
-                            f.write("Détails du calcul:\n")
-                            f.write("-" * 80 + "\n")
-                            f.write(f"{'ID Cellule':<12} {variable:<10} {'Aire Inter.':<15} {'Poids':<10} {'Contribution':<15}\n")
-                            
-                            total_verification = 0
-                            sum_poids = 0
-                            for detail in verif['details']:
-                                f.write(f"{detail['id_cellule']:<12} {detail['valeur']:<10.2f} {detail['aire_intersection']:<15.2f} "
-                                       f"{detail['poids']:<10.4f} {detail['contribution']:<15.4f}\n")
-                                total_verification += detail['contribution']
-                                sum_poids += detail['poids']
-                            
-                            f.write("-" * 80 + "\n")
-                            f.write(f"Somme des poids: {sum_poids:.4f}\n")
-                            f.write(f"Total des contributions: {total_verification:.4f}\n")
-                            f.write(f"Moyenne pondérée: {total_verification:.4f}\n")
-                            f.write("\n" + "=" * 70 + "\n\n")
-                    
-                    print(f"Rapport de vérification créé: {rapport_path}")
-                
-                # Visualiser les résultats pour cette variable et ce scénario
-                if GENERER_VERIFICATION and verification_details:
-                    fig, ax = plt.subplots(figsize=(12, 12))
-                    cmap = create_temperature_cmap()
-                    
-                    # Déterminer les valeurs min/max pour la légende
-                    vmin = communes_resultat[colonne_resultat].min()
-                    vmax = communes_resultat[colonne_resultat].max()
-                    
-                    # Tracer les communes avec la valeur moyenne
-                    communes_resultat.plot(column=colonne_resultat, cmap=cmap, legend=True, ax=ax,
-                                         vmin=vmin, vmax=vmax,
-                                         legend_kwds={'shrink': 0.6, 'aspect': 20, 'label': f'Valeur moyenne de {variable}'})
-                    
-                    # Mettre en évidence les communes utilisées pour la vérification
-                    for idx in indices_verification:
-                        communes_resultat.iloc[[idx]].plot(ax=ax, facecolor='none', edgecolor='black', linewidth=2)
-                    
-                    plt.title(f'Valeur moyenne de {variable} par commune - Scénario {scenario}\n(communes vérifiées en bordure noire)')
-                    plt.savefig(os.path.join(verification_dir, f"communes_{variable}_{scenario}_moyen.png"), dpi=300)
-                    plt.close()
-                
-                # Créer des images de vérification pour les communes sélectionnées
-                if GENERER_VERIFICATION and verification_details:
-                    for verif in verification_details:
-                        fig, ax = plt.subplots(figsize=(10, 10))
-                        
-                        # Récupérer la commune
-                        commune = communes_resultat.iloc[verif['idx']]
-                        
-                        # Dessiner la commune
-                        communes_resultat.iloc[[verif['idx']]].plot(ax=ax, color='lightgrey', edgecolor='black')
-                        
-                        # Dessiner les cellules qui intersectent la commune
-                        cellules_ids = [d['id_cellule'] for d in verif['details']]
-                        if cellules_ids:  # Vérifier que la liste n'est pas vide
-                            grille_scenario.loc[cellules_ids].plot(ax=ax, column=variable, cmap=cmap, alpha=0.5)
-                            
-                            # Ajouter des étiquettes pour chaque cellule
-                            for detail in verif['details']:
-                                if detail['id_cellule'] in grille_scenario.index:
-                                    cell = grille_scenario.loc[detail['id_cellule']]
-                                    centroid = cell.geometry.centroid
-                                    plt.annotate(f"ID: {detail['id_cellule']}\n{variable}: {cell[variable]:.2f}\nPoids: {detail['poids']:.3f}",
-                                                (centroid.x, centroid.y), ha='center', 
-                                                bbox=dict(boxstyle="round,pad=0.3", fc="white", alpha=0.7))
-                        
-                        # Ajout de l'ID de la commune dans le titre
-                        commune_id_display = verif['idx'] + 1
-                        plt.title(f"Vérification pour la commune {commune_id_display}\n{verif['nom_commune']}\n{variable} ({scenario}) - Valeur moyenne: {verif['valeur_moyenne']:.4f}")
-                        
-                        output_img = os.path.join(verification_dir, f"verification_commune_{commune_id_display}_{verif['nom_commune'].replace(' ', '_')}_{variable}_{scenario}.png")
-                        plt.savefig(output_img, dpi=300)
-                        plt.close()
-                        print(f"Image de vérification créée: {output_img}")
-                
-                # Créer la carte PDF pour cette variable et ce scénario
+                # Carte PDF de cette variable et de ce scénario (géométries simplifiées au niveau de la carte)
                 if GENERER_CARTES:
-                    print(f"Création de la carte pour {variable} - Scénario {scenario}...")
-                    fig, ax = plt.subplots(figsize=(11, 8.5))  # Format US Letter
-                    
-                    # Déterminer les valeurs min/max pour la légende
-                    vmin = communes_resultat[colonne_resultat].min()
-                    vmax = communes_resultat[colonne_resultat].max()
-                    
-                    # Tracer les communes avec la valeur moyenne
-                    communes_resultat.plot(column=colonne_resultat, cmap=cmap, 
-                                         vmin=vmin, vmax=vmax, ax=ax, legend=True,
-                                         legend_kwds={'shrink': 0.6, 'aspect': 20, 
-                                                      'label': f'Valeur moyenne de {variable} - {scenario}'})
-                    
-                    # Ajouter les frontières des communes
-                    communes_resultat.boundary.plot(ax=ax, linewidth=0.2, color='black')
-                    
-                    # Titre en gros caractères
-                    plt.title(f'Valeur moyenne de {variable} par commune - Scénario {scenario}', 
-                              fontsize=18, fontweight='bold')
-                    plt.tight_layout()
-                    
-                    # Enregistrer au format PDF
-                    communes_pdf = os.path.join(cartes_dir, f"carte_COMMUNE_{variable}_{scenario}.pdf")
-                    plt.savefig(communes_pdf, format='pdf', dpi=300, bbox_inches='tight')
-                    plt.close()
-                    print(f"Carte créée: {communes_pdf}")
-                
-                # Stocker ce GeoDataFrame dans le dictionnaire des résultats
-                resultats_communes[(scenario, variable)] = communes_resultat
+                    cartes_communes.append((os.path.join(cartes_dir, f"carte_COMMUNE_{variable}_{scenario}.pdf"),
+                                            moyennes_scenario[:, num_variable],
+                                            f'Valeur moyenne de {variable} par commune - Scénario {scenario}',
+                                            f'Valeur moyenne de {variable} - {scenario}'))
             
-            # Créer également une carte de la grille SAFRAN pour ce scénario
+            # Créer également une carte de la grille SAFRAN pour ce scénario (valeurs dans l'ordre des cellules)
             if GENERER_CARTES:
-                print(f"Création des cartes SAFRAN pour le scénario {scenario}...")
-                for variable in colonnes_variables:
-                    if variable not in grille_scenario.columns:
-                        continue
-                        
-                    fig, ax = plt.subplots(figsize=(11, 8.5))  # Format US Letter
-                    cmap = create_temperature_cmap()
-                    
-                    # Déterminer les valeurs min/max pour la légende
-                    vmin = grille_scenario[variable].min()
-                    vmax = grille_scenario[variable].max()
-                    
-                    # Tracer la grille SAFRAN
-                    grille_scenario.plot(column=variable, cmap=cmap, alpha=0.8, 
-                                       vmin=vmin, vmax=vmax, ax=ax, legend=True,
-                                       legend_kwds={'shrink': 0.6, 'aspect': 20, 'label': f'Valeur de {variable}'})
-                    
-                    # Titre en gros caractères
-                    plt.title(f'Distribution spatiale des valeurs {variable} - Scénario {scenario}', 
-                              fontsize=18, fontweight='bold')
-                    plt.tight_layout()
-                    
-                    # Enregistrer au format PDF
-                    safran_pdf = os.path.join(cartes_dir, f"carte_SAFRAN_{variable}_{scenario}.pdf")
-                    plt.savefig(safran_pdf, format='pdf', dpi=300, bbox_inches='tight')
-                    plt.close()
-                    print(f"Carte SAFRAN créée: {safran_pdf}")
+                for num_variable, variable in enumerate(colonnes_variables):
+                    if variable in grille_scenario.columns:
+                        cartes_safran.append((os.path.join(cartes_dir, f"carte_SAFRAN_{variable}_{scenario}.pdf"),
+                                              valeurs_scenario[:, num_variable],
+                                              f'Distribution spatiale des valeurs {variable} - Scénario {scenario}',
+                                              f'Valeur de {variable}'))
+        
+        # Vérification d'un échantillon d'entités, recalculée après coup à partir de leurs lignes de la matrice des poids
+        if GENERER_VERIFICATION and sorties_calculees:
+            colonnes_verifiees = [index_sorties[nom] for nom in sorties_calculees]
+            valeurs_cellules = np.full((len(ids_cellules), len(noms_sorties)), np.nan)
+            for scenario in scenarios:
+                valeurs_cellules[:, [index_sorties[f'{variable}_{scenario}'] for variable in colonnes_variables]] = \
+                    valeurs_par_cellule(grille_complete[grille_complete[periode_col] == scenario], ids_cellules, colonnes_variables)
+            indices_verification = echantillon_entites(len(reference_gdf), NB_VERIFICATIONS, GRAINE_VERIFICATION)
+            colonnes_description = [col for col in ['NOM', 'nom', 'INSEE_COM', 'code_insee'] if col in reference_gdf.columns]
+            verification = table_verification(matrice_poids, indices_verification, reference_gdf['index_original'].to_numpy(),
+                                              ids_cellules, valeurs_cellules[:, colonnes_verifiees],
+                                              resultats[:, colonnes_verifiees], sorties_calculees,
+                                              reference_gdf[colonnes_description])
+            rapport_path = os.path.join(verification_dir, f"{base_filename}_VERIFICATION.csv")
+            ecrire_atomique(rapport_path, lambda chemin: verification.to_csv(chemin, index=False))
+            print(f"Table de vérification créée: {rapport_path} ({len(indices_verification)} entités, "
+                  f"écart maximal {np.nanmax(np.abs(verification['ecart'].to_numpy()), initial=0):.2e})")
+            if FIGURES_VERIFICATION:
+                noms_entites = (reference_gdf[colonnes_description[0]] if colonnes_description else reference_gdf['index_original']).to_numpy()
+                for chemin in figures_verification(verification_dir, base_filename, reference_gdf.geometry.values, noms_entites,
+                                                   indices_verification, matrice_poids, grille):
+                    print(f"Image de vérification créée: {chemin}")
+        
+        if GENERER_CARTES:
+            print(f"\nCréation des cartes des entités ({len(cartes_communes)}) et de la grille SAFRAN ({len(cartes_safran)})...")
+            rendre_cartes(geometries_carte.values, cartes_communes, **options_cartes)
+            rendre_cartes(geometries_grille(grille, np.arange(len(ids_cellules))), cartes_safran,
+                          alpha=0.8, largeur_contour=0, **options_cartes)
         
         # Créer un fichier unique contenant toutes les variables et tous les scénarios
         print("\nPréparation des données pour le fichier final...")
         
         # Création d'un DataFrame combiné avec toutes les variables et scénarios
-        combined_gdf = None
+        combined_df = None
         combined_dep_gdf = None
         
-        if resultats_communes:
-            # Traitement des communes
-            base_gdf = list(resultats_communes.values())[0]
-            
-            # Créer un GeoDataFrame avec uniquement l'identifiant de commune et la géométrie
-            colonnes_base = ['index_original', 'geometry']
+        if sorties_calculees:
+            # Traitement des communes : identifiant et noms de la référence, sans géométrie
+            colonnes_base = ['index_original']
             
             # Ajouter les colonnes NOM ou nom si elles existent
             for col in ['NOM', 'nom', 'INSEE_COM', 'code_insee']:
-                if col in base_gdf.columns:
+                if col in reference_gdf.columns:
                     colonnes_base.append(col)
             
-            combined_gdf = base_gdf[colonnes_base].copy()
-            
-            # Ajouter toutes les colonnes de valeur de chaque GeoDataFrame
-            for (scenario, variable), communes_gdf in resultats_communes.items():
-                colonne_resultat = f'{variable}_{scenario}'
-                if colonne_resultat in communes_gdf.columns:
-                    combined_gdf[colonne_resultat] = communes_gdf[colonne_resultat]
+            # Toutes les colonnes calculées sont extraites de la matrice des résultats en une fois
+            valeurs_calculees = pd.DataFrame(resultats[:, [index_sorties[nom] for nom in sorties_calculees]],
+                                             columns=sorties_calculees, index=reference_gdf.index)
+            combined_df = pd.concat([pd.DataFrame(reference_gdf[colonnes_base]), valeurs_calculees], axis=1)
             
             # Traitement des départements uniquement si l'option est activée
             if CALCUL_DEPARTEMENT:
                 # Traitement des départements
                 print("\nChargement des départements...")
-                departements_gdf = gpd.read_file(departements_path)
-                departements_jointure = gpd.read_file(departements_path)
-                
-                # Vérifier et sélectionner les colonnes d'intérêt pour les départements
-                colonnes_requises_dep = ["geometry"]
-                colonnes_a_renommer_dep = {}
-                
-                # Vérification et mapping des colonnes potentielles pour les départements
-                if "NOM" in departements_jointure.columns:
-                    colonnes_requises_dep.append("NOM")
-                elif "Nom" in departements_jointure.columns:
-                    colonnes_requises_dep.append("Nom")
-                    colonnes_a_renommer_dep["Nom"] = "NOM"
-                
-                if "INSEE_DEP" in departements_jointure.columns:
-                    colonnes_requises_dep.append("INSEE_DEP")
-                elif "CODE_DEPT" in departements_jointure.columns:
-                    colonnes_requises_dep.append("CODE_DEPT")
-                    colonnes_a_renommer_dep["CODE_DEPT"] = "INSEE_DEP"
+                departements_jointure = charger_couche(departements_path)
+                codes_region = departements_jointure["INSEE_REG"].to_numpy() if "INSEE_REG" in departements_jointure.columns else None
                 
-                # Sélectionner uniquement les colonnes existantes
-                colonnes_existantes_dep = [col for col in colonnes_requises_dep if col in departements_jointure.columns]
-                departements_jointure = departements_jointure[colonnes_existantes_dep].copy()
+                combined_dep_gdf = preparer_departements(departements_jointure)
                 
-                # Renommer les colonnes selon le mapping défini
-                departements_jointure = departements_jointure.rename(columns=colonnes_a_renommer_dep)
-                
-                # Assurer que les départements ont le même CRS que la grille
-                if departements_jointure.crs != buffer_gdf.crs:
-                    departements_jointure = departements_jointure.to_crs(buffer_gdf.crs)
-                
-                # Créer un GeoDataFrame pour les départements
-                colonnes_dep = ['geometry']
-                if 'NOM' in departements_jointure.columns:
-                    colonnes_dep.append('NOM')
-                if 'INSEE_DEP' in departements_jointure.columns:
-                    colonnes_dep.append('INSEE_DEP')
-                
-                combined_dep_gdf = departements_jointure[colonnes_dep].copy()
+                # Matrice des poids départements x cellules, obtenue en sommant les poids des entités de chaque
+                # département (appartenance par point intérieur) : aucune nouvelle intersection
+                print("Agrégation des poids des entités par département...")
+                departement_entite = groupes_par_point_interieur(reference_gdf.geometry.values, combined_dep_gdf.geometry.values)
+                print(f"Entités rattachées à un département: {(departement_entite >= 0).sum()}/{len(departement_entite)}")
+                matrice_poids_dep = agreger_poids(matrice_groupes(departement_entite, len(combined_dep_gdf)), matrice_poids,
+                                                  None if MODE_VALEURS == "SURFACE" else reference_gdf.geometry.area.to_numpy())
                 
                 # Calculer les moyennes pondérées pour chaque département
                 print("Calcul des moyennes pondérées par département...")
                 for scenario in scenarios:
                     print(f"\nTraitement du scénario: {scenario}")
-                    grille_scenario = buffer_gdf[buffer_gdf[periode_col] == scenario]
+                    grille_scenario = grille_complete[grille_complete[periode_col] == scenario]
+                    moyennes_dep = moyennes_ponderees(
+                        matrice_poids_dep, valeurs_par_cellule(grille_scenario, ids_cellules, colonnes_variables))
                     
-                    for variable in colonnes_variables:
+                    for num_variable, variable in enumerate(colonnes_variables):
                         if variable not in grille_scenario.columns:
                             continue
                         
                         print(f"Calcul des moyennes pour la variable: {variable}")
                         colonne_resultat = f'{variable}_{scenario}'
-                        combined_dep_gdf[colonne_resultat] = np.nan
-                        
-                        # Traiter tous les départements d'un coup pour cette variable
-                        for idx, departement in combined_dep_gdf.iterrows():
-                            if idx % 10 == 0:  # Afficher la progression tous les 10 départements
-                                print(f"  Progression: département {idx+1}/{len(combined_dep_gdf)}")
-                            valeur_moyenne = calculer_moyenne_ponderee_departement(
-                                grille_scenario, departement, variable, scenario)
-                            combined_dep_gdf.at[idx, colonne_resultat] = valeur_moyenne
+                        combined_dep_gdf[colonne_resultat] = moyennes_dep[:, num_variable]
                         
                         # Générer des cartes pour les départements si l'option est activée
                         if GENERER_CARTES:
-                            print(f"Création de la carte départementale pour {variable} - Scénario {scenario}...")
-                            fig, ax = plt.subplots(figsize=(11, 8.5))  # Format US Letter
-                            cmap = create_temperature_cmap()
-                            
-                            # Déterminer les valeurs min/max pour la légende
-                            vmin = combined_dep_gdf[colonne_resultat].min()
-                            vmax = combined_dep_gdf[colonne_resultat].max()
-                            
-                            # Tracer les départements avec la valeur moyenne
-                            combined_dep_gdf.plot(column=colonne_resultat, cmap=cmap, 
-                                               vmin=vmin, vmax=vmax, ax=ax, legend=True,
-                                               legend_kwds={'shrink': 0.6, 'aspect': 20, 
-                                                          'label': f'Valeur moyenne de {variable} - {scenario}'})
-                            
-                            # Ajouter les frontières des départements
-                            combined_dep_gdf.boundary.plot(ax=ax, linewidth=0.2, color='black')
-                            
-                            # Titre en gros caractères
-                            plt.title(f'Valeur moyenne de {variable} par département - Scénario {scenario}', 
-                                    fontsize=18, fontweight='bold')
-                            plt.tight_layout()
-                            
-                            # Enregistrer au format PDF
-                            dep_pdf = os.path.join(cartes_dir, f"carte_DEPARTEMENT_{variable}_{scenario}.pdf")
-                            plt.savefig(dep_pdf, format='pdf', dpi=300, bbox_inches='tight')
-                            plt.close()
-                            print(f"Carte départementale créée: {dep_pdf}")
+                            cartes_departements.append((os.path.join(cartes_dir, f"carte_DEPARTEMENT_{variable}_{scenario}.pdf"),
+                                                        moyennes_dep[:, num_variable],
+                                                        f'Valeur moyenne de {variable} par département - Scénario {scenario}',
+                                                        f'Valeur moyenne de {variable} - {scenario}'))
+                
+                if GENERER_CARTES:
+                    print(f"\nCréation des cartes départementales ({len(cartes_departements)})...")
+                    rendre_cartes(combined_dep_gdf.geometry.values, cartes_departements, **options_cartes)
+            
+            # Régions : agrégation des poids des départements (colonne INSEE_REG de la couche des départements)
+            combined_reg_gdf = None
+            if CALCUL_DEPARTEMENT and codes_region is not None:
+                print("\nAgrégation des poids des départements par région...")
+                regions, region_departement = np.unique(codes_region.astype(str), return_inverse=True)
+                matrice_poids_reg = agreger_poids(matrice_groupes(region_departement, len(regions)), matrice_poids_dep)
+                combined_reg_gdf = combined_dep_gdf[['geometry']].assign(INSEE_REG=regions[region_departement])
+                combined_reg_gdf = combined_reg_gdf.dissolve('INSEE_REG').reset_index()
+                for scenario in scenarios:
+                    grille_scenario = grille_complete[grille_complete[periode_col] == scenario]
+                    moyennes_reg = moyennes_ponderees(
+                        matrice_poids_reg, valeurs_par_cellule(grille_scenario, ids_cellules, colonnes_variables))
+                    for num_variable, variable in enumerate(colonnes_variables):
+                        if variable in grille_scenario.columns:
+                            combined_reg_gdf[f'{variable}_{scenario}'] = moyennes_reg[:, num_variable]
             
             # Ajout d'une étape de jointure spatiale
             print("\nRéalisation de la jointure spatiale et création du fichier final...")
@@ -616,105 +522,30 @@ def traiter_fichier(fichier_entree, reference_path, departements_path):
             # Charger le fichier des entités avec les colonnes d'intérêt
             try:
                 # Charger le fichier SHP des références (communes ou codes postaux)
-                if TYPE_REFERENCE == "COMMUNE":
-                    unites_jointure = gpd.read_file(communes_path)
-                    # Mapping des colonnes pour le format commune
-                    colonnes_requises = ["geometry"]
-                    colonnes_a_renommer = {}
-                    
-                    # Vérification et mapping des colonnes potentielles pour les communes
-                    if "NOM" in unites_jointure.columns:
-                        colonnes_requises.append("NOM")
-                        colonnes_a_renommer["NOM"] = "LIB"
-                    elif "nom" in unites_jointure.columns:
-                        colonnes_requises.append("nom")
-                        colonnes_a_renommer["nom"] = "LIB"
-                    
-                    if "INSEE_COM" in unites_jointure.columns:
-                        colonnes_requises.append("INSEE_COM")
-                        colonnes_a_renommer["INSEE_COM"] = "CODE_C"
-                    elif "Code_commu" in unites_jointure.columns:
-                        colonnes_requises.append("Code_commu")
-                        colonnes_a_renommer["Code_commu"] = "CODE_C"
-                    elif "code_insee" in unites_jointure.columns:
-                        colonnes_requises.append("code_insee")
-                        colonnes_a_renommer["code_insee"] = "CODE_C"
-                    
-                    if "DEP" in unites_jointure.columns:
-                        colonnes_requises.append("DEP")
-                    elif "CODE_DEPT" in unites_jointure.columns:
-                        colonnes_requises.append("CODE_DEPT")
-                        colonnes_a_renommer["CODE_DEPT"] = "DEP"
-                else:  # TYPE_REFERENCE == "POSTAL"
-                    unites_jointure = gpd.read_file(postal_path)
-                    # Mapping des colonnes pour le format code postal
-                    colonnes_requises = ["geometry"]
-                    colonnes_a_renommer = {}
-                    
-                    # Vérification et mapping des colonnes potentielles pour les codes postaux
-                    if "LIB" in unites_jointure.columns:
-                        colonnes_requises.append("LIB")
-                    elif "NOM" in unites_jointure.columns:
-                        colonnes_requises.append("NOM")
-                        colonnes_a_renommer["NOM"] = "LIB"
-                    
-                    if "ID" in unites_jointure.columns:
-                        colonnes_requises.append("ID")
-                        colonnes_a_renommer["ID"] = "CODE_C"
-                    
-                    if "DEP" in unites_jointure.columns:
-                        colonnes_requises.append("DEP")
+                unites_jointure = preparer_unites_jointure(
+                    charger_couche(communes_path if TYPE_REFERENCE == "COMMUNE" else postal_path))
                 
-                # Sélectionner uniquement les colonnes existantes
-                colonnes_existantes = [col for col in colonnes_requises if col in unites_jointure.columns]
-                unites_jointure = unites_jointure[colonnes_existantes].copy()
-                
-                # Renommer les colonnes selon le mapping défini
-                unites_jointure = unites_jointure.rename(columns=colonnes_a_renommer)
-                
-                # Effectuer la jointure spatiale avec le fichier combiné
-                if combined_gdf is not None:
-                    # Assurez-vous que les deux GeoDataFrames ont le même CRS
-                    if unites_jointure.crs != combined_gdf.crs:
-                        unites_jointure = unites_jointure.to_crs(combined_gdf.crs)
-                    
-                    print("Exécution de la jointure spatiale...")
-                    
-                    # Option 1: utiliser sjoin avec un seul point par entité
-                    unites_point = unites_jointure.copy()
-                    unites_point['geometry'] = unites_point.geometry.centroid
-                    
-                    # Effectuer la jointure spatiale avec les centroides
-                    result_jointure = gpd.sjoin_nearest(unites_point, combined_gdf, how="left", max_distance=5000)
-                    print(f"Jointure effectuée avec {len(result_jointure)} résultats")
-                    
-                    # Restaurer la géométrie originale
-                    result_jointure['geometry'] = unites_jointure.geometry
-                    
-                    # Vérifier pour des communes sans correspondance
-                    missing = result_jointure[result_jointure['index_right'].isna()]
-                    if len(missing) > 0:
-                        print(f"Attention: {len(missing)} communes n'ont pas trouvé de correspondance")
-                        
-                        # Essayer avec une distance plus grande pour les communes sans correspondance
-                        if len(missing) > 0:
-                            print("Tentative avec une distance plus grande pour les communes sans correspondance...")
-                            missing_communes = unites_point[unites_point.index.isin(missing.index)]
-                            second_attempt = gpd.sjoin_nearest(missing_communes, combined_gdf, how="left", max_distance=10000)
-                            
-                            # Mettre à jour les valeurs manquantes
-                            for idx in second_attempt.index:
-                                if not pd.isna(second_attempt.loc[idx, 'index_right']):
-                                    for col in result_jointure.columns:
-                                        if col in second_attempt.columns and col != 'geometry':
-                                            result_jointure.loc[idx, col] = second_attempt.loc[idx, col]
+                # Rattacher les résultats aux attributs de la référence par identifiant (index_original) :
+                # la couche est la même que celle des calculs, ligne pour ligne
+                if combined_df is not None:
+                    # Assurez-vous que la géométrie est dans le CRS des résultats
+                    if unites_jointure.crs != reference_gdf.crs:
+                        unites_jointure = unites_jointure.to_crs(reference_gdf.crs)
+                    
+                    print("Assemblage des résultats par identifiant d'entité...")
+                    valeurs_resultats = combined_df.set_index('index_original')
+                    result_jointure = unites_jointure.join(valeurs_resultats, how="left", lsuffix="_left", rsuffix="_right")
+                    sans_resultat = (~unites_jointure.index.isin(valeurs_resultats.index)).sum()
+                    print(f"Assemblage effectué avec {len(result_jointure)} résultats")
+                    if sans_resultat > 0:
+                        print(f"Attention: {sans_resultat} communes n'ont pas trouvé de correspondance")
                     
                     # Supprimer les colonnes redondantes
                     result_jointure = result_jointure.loc[:, ~result_jointure.columns.str.contains('index_|^idx$')]
                     
                     # Sauvegarder le résultat final pour les communes/codes postaux
-                    jointure_output = os.path.join(resultats_dir, f"{base_filename}_FINAL_RESULTS_{TYPE_REFERENCE}.gpkg")
-                    result_jointure.to_file(jointure_output, driver="GPKG")
+                    jointure_output = ecrire_resultat(result_jointure, os.path.join(resultats_dir, f"{base_filename}_FINAL_RESULTS_{TYPE_REFERENCE}"),
+                                                      TYPE_REFERENCE, empreinte_couche(reference_path), noms_sorties)
                     print(f"Fichier final pour {TYPE_REFERENCE} sauvegardé: {jointure_output}")
                     
                     # Générer un fichier CSV si nécessaire
@@ -722,53 +553,70 @@ def traiter_fichier(fichier_entree, reference_path, departements_path):
                         # Créer une version CSV sans la géométrie
                         csv_columns = [col for col in result_jointure.columns if col != 'geometry']
                         csv_output = os.path.join(resultats_dir, f"{base_filename}_FINAL_RESULTS_{TYPE_REFERENCE}.csv")
-                        result_jointure[csv_columns].to_csv(csv_output, index=False)
+                        ecrire_atomique(csv_output, lambda chemin: result_jointure[csv_columns].to_csv(chemin, index=False))
                         print(f"Fichier CSV final pour {TYPE_REFERENCE} sauvegardé: {csv_output}")
                 
                 # Sauvegarder les résultats pour les départements si l'option est activée
                 if CALCUL_DEPARTEMENT and combined_dep_gdf is not None:
                     # Simplifier les géométries des départements pour réduire la taille du fichier
+                    # (niveaux de détail calculés une fois pour la couche, frontières communes conservées)
                     print("Simplification des géométries des départements pour réduire la taille du fichier...")
+                    niveaux_dep = niveaux_detail(departements_path, combined_dep_gdf.geometry)
                     combined_dep_gdf_simplified = combined_dep_gdf.copy()
                     
                     # Paramètre de tolérance pour la simplification (en mètres)
                     tolerance = 100  # Ajuster si nécessaire
+                    combined_dep_gdf_simplified['geometry'] = niveaux_dep[tolerance]
                     
-                    # Simplifier la géométrie des départements
-                    combined_dep_gdf_simplified['geometry'] = combined_dep_gdf_simplified.geometry.simplify(tolerance, preserve_topology=True)
-                    
-                    # Vérifier la réduction de taille
-                    taille_avant = sum(combined_dep_gdf.geometry.apply(lambda g: len(g.wkt)))
-                    taille_apres = sum(combined_dep_gdf_simplified.geometry.apply(lambda g: len(g.wkt)))
-                    reduction = (1 - taille_apres/taille_avant) * 100 if taille_avant > 0 else 0
-                    print(f"Réduction de la taille des géométries: {reduction:.2f}% (tolérance: {tolerance}m)")
+                    # Vérifier la réduction de taille (nombre de sommets)
+                    sommets_avant = nb_sommets(combined_dep_gdf.geometry.values)
+                    sommets_apres = nb_sommets(combined_dep_gdf_simplified.geometry.values)
+                    reduction = (1 - sommets_apres/sommets_avant) * 100 if sommets_avant > 0 else 0
+                    print(f"Réduction du nombre de sommets: {reduction:.2f}% (tolérance: {tolerance}m)")
                     
-                    # Si la réduction n'est pas suffisante, essayer avec une tolérance plus grande
-                    if reduction < 50 and taille_avant > 10000000:  # Si moins de 50% de réduction et la taille est grande
+                    # Si la réduction n'est pas suffisante, prendre le niveau plus simplifié
+                    if reduction < 50 and sommets_avant > 250000:  # Si moins de 50% de réduction et beaucoup de sommets
                         tolerance = 200  # Doubler la tolérance
                         print(f"Augmentation de la tolérance à {tolerance}m pour une meilleure réduction...")
-                        combined_dep_gdf_simplified['geometry'] = combined_dep_gdf.geometry.simplify(tolerance, preserve_topology=True)
+                        combined_dep_gdf_simplified['geometry'] = niveaux_dep[tolerance]
                         
-                        taille_apres = sum(combined_dep_gdf_simplified.geometry.apply(lambda g: len(g.wkt)))
-                        reduction = (1 - taille_apres/taille_avant) * 100 if taille_avant > 0 else 0
+                        sommets_apres = nb_sommets(combined_dep_gdf_simplified.geometry.values)
+                        reduction = (1 - sommets_apres/sommets_avant) * 100 if sommets_avant > 0 else 0
                         print(f"Nouvelle réduction: {reduction:.2f}%")
                     
                     # Sauvegarder avec les géométries simplifiées
-                    dep_output = os.path.join(resultats_dir, f"{base_filename}_FINAL_RESULTS_DEPARTEMENTS_{TYPE_REFERENCE}.gpkg")
-                    combined_dep_gdf_simplified.to_file(dep_output, driver="GPKG")
+                    dep_output = ecrire_resultat(combined_dep_gdf_simplified,
+                                                 os.path.join(resultats_dir, f"{base_filename}_FINAL_RESULTS_DEPARTEMENTS_{TYPE_REFERENCE}"),
+                                                 "DEPARTEMENTS", empreinte_couche(departements_path, "couverture", tolerance), noms_sorties)
                     print(f"Fichier final pour les départements sauvegardé: {dep_output}")
                     
                     if GENERER_CSV:
                         # Créer également une version CSV sans la géométrie
                         csv_columns_dep = [col for col in combined_dep_gdf_simplified.columns if col != 'geometry']
                         csv_dep_output = os.path.join(resultats_dir, f"{base_filename}_FINAL_RESULTS_DEPARTEMENTS_{TYPE_REFERENCE}.csv")
-                        combined_dep_gdf_simplified[csv_columns_dep].to_csv(csv_dep_output, index=False)
+                        ecrire_atomique(csv_dep_output, lambda chemin: combined_dep_gdf_simplified[csv_columns_dep].to_csv(chemin, index=False))
                         print(f"Fichier CSV final pour les départements sauvegardé: {csv_dep_output}")
+                
+                # Sauvegarder les résultats pour les régions
+                if combined_reg_gdf is not None:
+                    combined_reg_gdf['geometry'] = niveaux_detail(departements_path, combined_reg_gdf.geometry, (200,), "REGIONS")[200]
+                    reg_output = ecrire_resultat(combined_reg_gdf,
+                                                 os.path.join(resultats_dir, f"{base_filename}_FINAL_RESULTS_REGIONS_{TYPE_REFERENCE}"),
+                                                 "REGIONS", empreinte_couche(departements_path, "REGIONS", "couverture"), noms_sorties)
+                    print(f"Fichier final pour les régions sauvegardé: {reg_output}")
+                    
+                    if GENERER_CSV:
+                        csv_reg_output = os.path.join(resultats_dir, f"{base_filename}_FINAL_RESULTS_REGIONS_{TYPE_REFERENCE}.csv")
+                        ecrire_atomique(csv_reg_output, lambda chemin: combined_reg_gdf.drop(columns='geometry').to_csv(chemin, index=False))
+                        print(f"Fichier CSV final pour les régions sauvegardé: {csv_reg_output}")
             
             except Exception as e:
                 import traceback
                 print(f"Erreur lors de la jointure spatiale: {e}")
                 traceback.print_exc()
+                # Couches finales absentes ou incomplètes : fichier compté en échec par traiter_lot
+                # (et non inscrit au manifeste, pour être retraité au prochain lot)
+                return False
         
         print("\nTraitement terminé avec succès!")
         return True
@@ -779,47 +627,229 @@ def traiter_fichier(fichier_entree, reference_path, departements_path):
         traceback.print_exc()
         return False
 
-def calculer_moyenne_ponderee_departement(grille_scenario, departement, variable, scenario):
-    """Calcule la moyenne pondérée pour un département de manière optimisée."""
+# Variante à mémoire bornée pour les couches de référence nationales (MODE_TUILES) : les entités sont
+# traitées tuile par tuile avec les seules cellules SAFRAN de leur emprise, et les résultats écrits au fur et à mesure
+def traiter_fichier_tuiles(fichier_entree, reference_path, departements_path):
+    print("\n" + "="*80)
+    print(f"TRAITEMENT PAR TUILES DU FICHIER: {fichier_entree}")
+    print("="*80 + "\n")
+    
+    # Vérifier si le fichier existe
+    if not os.path.exists(fichier_entree):
+        print(f"Erreur: Le fichier {fichier_entree} n'existe pas.")
+        return False
+    
+    sorties_temporaires, sortie_parquet = [], None
     try:
-        # Créer un masque pour les cellules qui intersectent le département
-        cellules_intersectees = grille_scenario[grille_scenario.intersects(departement.geometry)]
-        
-        if len(cellules_intersectees) == 0:
-            return np.nan
-        
-        # Calculer toutes les intersections d'un coup
-        intersections = gpd.overlay(
-            gpd.GeoDataFrame({'geometry': [departement.geometry]}, crs=grille_scenario.crs),
-            cellules_intersectees,
-            how='intersection'
-        )
-        
-        if len(intersections) == 0:
-            return np.nan
-        
-        # Calculer les aires des intersections
-        aires_intersection = intersections.geometry.area
-        
-        # Calculer les poids (proportions des intersections)
-        aire_departement = departement.geometry.area
-        poids = aires_intersection / aire_departement
+        if GENERER_VERIFICATION or GENERER_CARTES:
+            print("Vérifications et cartes non disponibles en mode tuiles: seuls les résultats sont calculés")
+        
+        # Table convertie par blocs au format Parquet, puis relue cellule par cellule pour chaque tuile
+        chemin_cache = preparer_cache_lecture(fichier_entree, nom_periode='Période')
+        if chemin_cache is None:
+            print("Mode tuiles indisponible (pyarrow absent ou aucune donnée), traitement du fichier entier")
+            return traiter_fichier(fichier_entree, reference_path, departements_path)
+        colonnes_a_exclure = ['Point', 'Latitude', 'Longitude', 'Contexte', 'Période', 'PÃ©riode', 'Saison']
+        cellules_df, scenarios, colonnes_variables, nb_lignes = resumer_cache_lecture(chemin_cache, 'Période', colonnes_a_exclure)
+        print(f"Scénarios trouvés: {scenarios}")
+        print(f"Variables climatiques détectées: {colonnes_variables}")
+        if not colonnes_variables:
+            raise ValueError("Aucune variable climatique numérique détectée dans le jeu de données")
         
-        # Calculer la moyenne pondérée
-        valeurs = intersections[variable]
-        moyenne_ponderee = np.sum(valeurs * poids) / np.sum(poids)
+        ids_cellules = cellules_df.index.to_numpy()
+        longitudes, latitudes = cellules_df['Longitude'].to_numpy(), cellules_df['Latitude'].to_numpy()
+        grille, _ = grille_depuis_registre(ids_cellules, longitudes, latitudes, cache_path)
+        print(f"Cellules SAFRAN uniques: {len(ids_cellules)}")
         
-        return moyenne_ponderee
+        base_dir = os.path.dirname(fichier_entree)
+        base_filename = os.path.splitext(os.path.basename(fichier_entree))[0] + "_clean"
+        resultats_dir = os.path.join(base_dir, "Resultats")
+        os.makedirs(resultats_dir, exist_ok=True)
         
+        noms_sorties = [f'{variable}_{scenario}' for scenario in scenarios for variable in colonnes_variables]
+        nb_variables = len(colonnes_variables)
+        
+        # Départements : appartenance des entités et sommes pondérées cumulées d'une tuile à l'autre
+        departements, codes_region = None, None
+        if CALCUL_DEPARTEMENT or MODE_TUILES == "DEPARTEMENT":
+            departements_bruts = charger_couche(departements_path)
+            codes_region = departements_bruts["INSEE_REG"].to_numpy() if "INSEE_REG" in departements_bruts.columns else None
+            departements = preparer_departements(departements_bruts)
+            numerateurs_dep = np.zeros((len(departements), len(noms_sorties)))
+            denominateurs_dep = np.zeros((len(departements), len(noms_sorties)))
+        
+        # Découpage de l'emprise de la référence selon le budget mémoire
+        nb_entites, emprise = infos_couche(reference_path)
+        marge = grille.demi_cote if MODE_VALEURS == "SURFACE" else 2 * PAS_SAFRAN
+        reseau = reseau_safran(longitudes, latitudes) if MODE_VALEURS != "SURFACE" else None
+        profil = profil_memoire(reference_path, nb_entites, emprise, nb_lignes, len(ids_cellules),
+                                nb_variables + 3, len(noms_sorties), grille.demi_cote, marge)
+        tuiles = tuiles_reference(emprise, profil, BUDGET_MEMOIRE_MO * 2**20,
+                                  departements.bounds.to_numpy() if MODE_TUILES == "DEPARTEMENT" else None)
+        print(f"{nb_entites} entités réparties en {len(tuiles)} tuiles (mode {MODE_TUILES}, budget {BUDGET_MEMOIRE_MO} Mo)")
+        
+        # Rang de chaque entité dans la couche (identifiant des sorties sans géométrie, comme index_original)
+        fids = pd.Index(fids_couche(reference_path))
+        jointure_output = os.path.join(resultats_dir, f"{base_filename}_FINAL_RESULTS_{TYPE_REFERENCE}.gpkg")
+        csv_output = os.path.join(resultats_dir, f"{base_filename}_FINAL_RESULTS_{TYPE_REFERENCE}.csv")
+        sorties_temporaires = [chemin_temporaire(jointure_output), chemin_temporaire(csv_output)]
+        if FORMAT_SORTIE == "PARQUET":
+            jointure_output = os.path.splitext(jointure_output)[0] + ".parquet"
+            sortie_parquet = SortieSansGeometrie(jointure_output, resultats_dir, TYPE_REFERENCE,
+                                                 empreinte_couche(reference_path), noms_sorties)
+        premiere_tuile = True
+        
+        def traiter_entites(entites, departement_entite):
+            """Calcule les moyennes des entités d'une tuile et les ajoute aux fichiers de sortie."""
+            nonlocal premiere_tuile
+            if MODE_VALEURS != "SURFACE":
+                # Réseau de tout le fichier : seules les cellules voisines des centroïdes sont ensuite lues
+                centroides = entites.geometry.centroid
+                matrice_poids = matrice_interpolation(reseau, centroides.x.to_numpy(), centroides.y.to_numpy(), MODE_VALEURS)
+                indices = np.unique(matrice_poids.indices)
+                matrice_poids = matrice_poids[:, indices]
+            else:
+                indices = cellules_emprise(grille, entites.total_bounds, marge)
+            ids_tuile = ids_cellules[indices]
+            if len(indices) == 0:
+                matrice_poids = None
+            elif MODE_VALEURS == "SURFACE":
+                matrice_poids = construire_matrice_poids_parallele(
+                    entites.geometry.values, GrilleSafran(grille.x[indices], grille.y[indices], grille.demi_cote),
+                    MOTEUR_INTERSECTION, NB_THREADS, resolution_raster=RESOLUTION_RASTER)
+            
+            resultats = np.full((len(entites), len(noms_sorties)), np.nan, dtype=np.float32)
+            if matrice_poids is not None:
+                table = lire_cache_cellules(chemin_cache, ids_tuile, longitudes[indices], latitudes[indices])
+                if departements is not None:
+                    matrice_poids_dep = agreger_poids(matrice_groupes(departement_entite, len(departements)), matrice_poids,
+                                                      None if MODE_VALEURS == "SURFACE" else entites.geometry.area.to_numpy())
+                for num_scenario, scenario in enumerate(scenarios):
+                    colonnes = slice(num_scenario * nb_variables, (num_scenario + 1) * nb_variables)
+                    valeurs = valeurs_par_cellule(table[table['Période'] == scenario], ids_tuile, colonnes_variables)
+                    resultats[:, colonnes] = moyennes_ponderees(matrice_poids, valeurs)
+                    if departements is not None:
+                        valides = ~np.isnan(valeurs)
+                        numerateurs_dep[:, colonnes] += matrice_poids_dep @ np.where(valides, valeurs, 0.0)
+                        denominateurs_dep[:, colonnes] += matrice_poids_dep @ valides.astype(np.float64)
+            
+            # Attributs de la référence et résultats de la tuile (mêmes colonnes que traiter_fichier),
+            # ajoutés aux fichiers temporaires
+            colonnes_base = [col for col in ['NOM', 'nom', 'INSEE_COM', 'code_insee'] if col in entites.columns]
+            valeurs_resultats = pd.concat([pd.DataFrame(entites[colonnes_base]),
+                                           pd.DataFrame(resultats, columns=noms_sorties, index=entites.index)], axis=1)
+            resultat = preparer_unites_jointure(entites).join(valeurs_resultats, lsuffix="_left", rsuffix="_right")
+            resultat = resultat.loc[:, ~resultat.columns.str.contains('index_|^idx$')].reset_index(drop=True)
+            if FORMAT_SORTIE == "PARQUET":
+                sortie_parquet.ajouter(resultat, fids.get_indexer(entites.index))
+            else:
+                resultat.to_file(sorties_temporaires[0], driver="GPKG", mode="w" if premiere_tuile else "a")
+            if GENERER_CSV:
+                resultat.drop(columns='geometry').to_csv(sorties_temporaires[1], index=False, header=premiere_tuile,
+                                                         mode="w" if premiere_tuile else "a")
+            premiere_tuile = False
+            return len(indices)
+        
+        traitees = set()
+        for num_tuile, tuile in enumerate(tuiles):
+            entites = lire_entites(reference_path, tuile[:4])
+            entites = entites[~entites.index.isin(list(traitees))]
+            if entites.empty:
+                continue
+            departement_entite = (groupes_par_point_interieur(entites.geometry.values, departements.geometry.values)
+                                  if departements is not None else None)
+            garder = entites_de_la_tuile(entites.geometry.values, tuile, departement_entite)
+            if not garder.any():
+                continue
+            nb_cellules = traiter_entites(entites[garder], departement_entite[garder] if departement_entite is not None else None)
+            traitees.update(entites.index[garder])
+            print(f"Tuile {num_tuile + 1}/{len(tuiles)}: {garder.sum()} entités, {nb_cellules} cellules "
+                  f"({len(traitees)}/{nb_entites} entités traitées)")
+        
+        # Entités prises par aucune tuile (point intérieur sur un bord ou hors des départements)
+        restantes = np.setdiff1d(fids.to_numpy(), np.fromiter(traitees, dtype=np.int64, count=len(traitees)))
+        if len(restantes) > 0:
+            print(f"Traitement des {len(restantes)} entités restantes...")
+            entites = lire_entites(reference_path, fids=restantes)
+            traiter_entites(entites, groupes_par_point_interieur(entites.geometry.values, departements.geometry.values)
+                            if departements is not None else None)
+        
+        if premiere_tuile:
+            raise ValueError("Aucune entité de référence traitée")
+        if FORMAT_SORTIE == "PARQUET":
+            sortie_parquet.terminer()
+        else:
+            os.replace(sorties_temporaires[0], jointure_output)
+        print(f"Fichier final pour {TYPE_REFERENCE} sauvegardé: {jointure_output}")
+        if GENERER_CSV:
+            os.replace(sorties_temporaires[1], csv_output)
+            print(f"Fichier CSV final pour {TYPE_REFERENCE} sauvegardé: {csv_output}")
+        
+        # Départements et régions : moyennes à partir des sommes cumulées sur toutes les tuiles
+        if CALCUL_DEPARTEMENT:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                moyennes_dep = np.where(denominateurs_dep > 0, numerateurs_dep / denominateurs_dep, np.nan)
+            combined_dep_gdf = departements.join(pd.DataFrame(moyennes_dep, columns=noms_sorties, index=departements.index))
+            combined_dep_gdf['geometry'] = niveaux_detail(departements_path, departements.geometry)[100]
+            dep_output = ecrire_resultat(combined_dep_gdf,
+                                         os.path.join(resultats_dir, f"{base_filename}_FINAL_RESULTS_DEPARTEMENTS_{TYPE_REFERENCE}"),
+                                         "DEPARTEMENTS", empreinte_couche(departements_path, "couverture", 100), noms_sorties)
+            print(f"Fichier final pour les départements sauvegardé: {dep_output}")
+            if GENERER_CSV:
+                csv_dep_output = os.path.join(resultats_dir, f"{base_filename}_FINAL_RESULTS_DEPARTEMENTS_{TYPE_REFERENCE}.csv")
+                ecrire_atomique(csv_dep_output, lambda chemin: combined_dep_gdf.drop(columns='geometry').to_csv(chemin, index=False))
+            
+            if codes_region is not None:
+                regions, region_departement = np.unique(codes_region.astype(str), return_inverse=True)
+                appartenance = matrice_groupes(region_departement, len(regions))
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    numerateurs_reg, denominateurs_reg = appartenance @ numerateurs_dep, appartenance @ denominateurs_dep
+                    moyennes_reg = np.where(denominateurs_reg > 0, numerateurs_reg / denominateurs_reg, np.nan)
+                combined_reg_gdf = departements[['geometry']].assign(INSEE_REG=regions[region_departement])
+                combined_reg_gdf = combined_reg_gdf.dissolve('INSEE_REG').reset_index()
+                combined_reg_gdf = combined_reg_gdf.join(pd.DataFrame(moyennes_reg, columns=noms_sorties))
+                combined_reg_gdf['geometry'] = niveaux_detail(departements_path, combined_reg_gdf.geometry, (200,), "REGIONS")[200]
+                reg_output = ecrire_resultat(combined_reg_gdf,
+                                             os.path.join(resultats_dir, f"{base_filename}_FINAL_RESULTS_REGIONS_{TYPE_REFERENCE}"),
+                                             "REGIONS", empreinte_couche(departements_path, "REGIONS", "couverture"), noms_sorties)
+                print(f"Fichier final pour les régions sauvegardé: {reg_output}")
+                if GENERER_CSV:
+                    csv_reg_output = os.path.join(resultats_dir, f"{base_filename}_FINAL_RESULTS_REGIONS_{TYPE_REFERENCE}.csv")
+                    ecrire_atomique(csv_reg_output, lambda chemin: combined_reg_gdf.drop(columns='geometry').to_csv(chemin, index=False))
+        
+        pic = memoire_max_mo()
+        if pic is not None:
+            print(f"Pic de mémoire du processus: {pic:.0f} Mo (budget {BUDGET_MEMOIRE_MO} Mo)")
+        print("\nTraitement terminé avec succès!")
+        return True
+    
     except Exception as e:
-        print(f"Erreur lors du calcul de la moyenne pondérée: {e}")
-        return np.nan
+        import traceback
+        print(f"Erreur lors du traitement: {e}")
+        traceback.print_exc()
+        return False
+    finally:
+        for chemin in sorties_temporaires:
+            if os.path.exists(chemin):
+                os.remove(chemin)
+        if sortie_parquet is not None:
+            sortie_parquet.abandonner()
 
 # Code principal pour traiter un fichier ou un dossier complet
 if __name__ == "__main__":
     # Sélectionner le chemin de référence selon le type choisi
     reference_path = communes_path if TYPE_REFERENCE == "COMMUNE" else postal_path
     print(f"Utilisation de la référence: {TYPE_REFERENCE} avec le fichier: {reference_path}")
+    traitement = traiter_fichier if MODE_TUILES == "AUCUN" else traiter_fichier_tuiles
+    
+    # Lot incrémental : options qui modifient les sorties d'un fichier et couches de référence utilisées
+    options_lot = {"TYPE_REFERENCE": TYPE_REFERENCE, "CALCUL_DEPARTEMENT": CALCUL_DEPARTEMENT, "GENERER_CSV": GENERER_CSV,
+                   "GENERER_VERIFICATION": GENERER_VERIFICATION, "NB_VERIFICATIONS": NB_VERIFICATIONS,
+                   "GRAINE_VERIFICATION": GRAINE_VERIFICATION, "FIGURES_VERIFICATION": FIGURES_VERIFICATION,
+                   "GENERER_CARTES": GENERER_CARTES, "RASTERISER_CARTES": RASTERISER_CARTES,
+                   "MOTEUR_INTERSECTION": MOTEUR_INTERSECTION, "RESOLUTION_RASTER": RESOLUTION_RASTER,
+                   "MODE_VALEURS": MODE_VALEURS, "MODE_TUILES": MODE_TUILES, "FORMAT_SORTIE": FORMAT_SORTIE}
+    couches_lot = {"reference": reference_path, "departements": departements_path if CALCUL_DEPARTEMENT else None}
     
     if TRAITER_DOSSIER_COMPLET:
         print(f"Traitement du dossier complet: {chemin_entree}")
@@ -828,11 +858,45 @@ if __name__ == "__main__":
             fichiers_txt = [os.path.join(chemin_entree, f) for f in os.listdir(chemin_entree) if f.endswith('.txt')]
             print(f"Nombre de fichiers .txt trouvés: {len(fichiers_txt)}")
             
-            # Traiter chaque fichier
-            for fichier in fichiers_txt:
-                traiter_fichier(fichier, reference_path, departements_path)
+            # Statistiques d'ensemble et variations par rapport à REF : les résultats de chaque fichier sont
+            # ajoutés dès qu'il est traité (rappels de traiter_lot dans le processus principal)
+            ensemble = EnsembleDrias(TYPE_REFERENCE) if STATISTIQUES_ENSEMBLE else None
+            normalisation = NormalisationRef(TYPE_REFERENCE) if NORMALISER_REF else None
+            rappels = [etape.ajouter_fichier for etape in (ensemble, normalisation) if etape is not None]
+            fichiers_lot = fichiers_txt
+            
+            # Fichiers déjà traités avec les mêmes entrées et options : sorties réutilisées
+            if TRAITEMENT_INCREMENTAL:
+                manifeste = ManifesteLot(TYPE_REFERENCE)
+                fichiers_txt = manifeste.a_traiter(fichiers_txt, couches_lot, options_lot)
+            
+            # Traiter les fichiers en parallèle (un échec n'interrompt pas le lot)
+            resultats_lot = traiter_lot(fichiers_txt, traitement, (reference_path, departements_path), NB_PROCESSUS,
+                                        rappel=rappels)
+            if TRAITEMENT_INCREMENTAL:
+                manifeste.enregistrer(resultats_lot)
+            
+            dossiers_resultats = [os.path.join(chemin_entree, "Resultats")]
+            
+            # Sorties existantes des fichiers à jour (non retraités) : membres de l'ensemble et couches REF
+            # ou scénarios dont les variations restent à écrire
+            for fichier in sorted(set(fichiers_lot) - set(resultats_lot)):
+                for rappel in rappels:
+                    rappel(fichier)
+            if normalisation is not None:
+                normalisation.terminer()
+            if ensemble is not None:
+                ensemble.ecrire()
+            
+            # Rassembler tous les résultats du dossier dans un seul cube (réécrit si un fichier a été traité)
+            if FORMAT_CUBE != "AUCUN" and (resultats_lot or not os.path.exists(chemin_cube(dossiers_resultats, TYPE_REFERENCE, FORMAT_CUBE))):
+                ecrire_cube(dossiers_resultats, TYPE_REFERENCE, FORMAT_CUBE)
+            
+            # Tuiles vectorielles des couches nouvelles ou modifiées pour l'application
+            if EXPORT_TUILES != "AUCUN":
+                exporter_tuiles(os.path.join(chemin_entree, "Resultats"), EXPORT_TUILES)
         else:
             print(f"Erreur: {chemin_entree} n'est pas un dossier valide.")
     else:
         print(f"Traitement du fichier individuel: {fichier_individuel}")
-        traiter_fichier(fichier_individuel, reference_path, departements_path)
\ No newline at end of file
+        traitement(fichier_individuel, reference_path, departements_path)
\ No newline at end of file
@@ -1,11 +1,10 @@
 import pandas as pd
 import geopandas as gpd
-import matplotlib.pyplot as plt
 import numpy as np
 from matplotlib.colors import LinearSegmentedColormap
-import matplotlib as mpl
 import matplotlib.patheffects as pe
 import os
+from drias_cartes import rendre_cartes
 
 # Création du dossier de résultats
 results_dir = "/Users/noa/Desktop/PRISM/Data/Resultats_CATNAT_MVT_Terrain_Unique"
@@ -139,44 +138,24 @@ cp_map_data["frequence"] = cp_map_data["frequence"].fillna(0)
 
 # Pour le rendu visuel, les zones sans données seront grises plutôt que blanches/transparentes
 print("\nCréation de la carte par code postal avec les zones sans données en gris...")
-cp_fig, cp_ax = plt.figure(figsize=(15, 10)), plt.gca()
 
-# Créer une palette de couleurs type "température" (bleu-jaune-rouge)
+# Créer une palette de couleurs type "température" (bleu-jaune-rouge) ; les valeurs sous le minimum
+# (codes postaux sans mouvement de terrain) sont en gris clair, dans la même collection de polygones
 colors = ['#0000FF', '#00FFFF', '#FFFF00', '#FF0000']  # Bleu, Cyan, Jaune, Rouge
-cmap = LinearSegmentedColormap.from_list('temperature', colors)
+cmap = LinearSegmentedColormap.from_list('temperature', colors).with_extremes(under="#EEEEEE")
 
-# Créer une fonction de normalisation pour les couleurs (excluant les valeurs 0)
+# Échelle des couleurs excluant les valeurs 0
 cp_vmin = cp_map_data[cp_map_data["frequence"] > 0]["frequence"].min()
 cp_vmax = cp_map_data["frequence"].max()
-cp_norm = mpl.colors.Normalize(vmin=cp_vmin, vmax=cp_vmax)
-
-# Masque pour les codes postaux avec fréquence 0
-cp_mask = cp_map_data["frequence"] == 0
-
-# Afficher les codes postaux avec mouvements de terrain
-cp_map_data[~cp_mask].plot(column="frequence", 
-                          cmap=cmap, 
-                          linewidth=0.1, 
-                          ax=cp_ax, 
-                          edgecolor="0.5",
-                          norm=cp_norm,
-                          legend=True,
-                          legend_kwds={'label': "Fréquence de mouvements de terrain par code postal"})
-
-# Afficher les codes postaux sans mouvements de terrain (en gris clair avec contour gris)
-cp_map_data[cp_mask].plot(color="#EEEEEE", 
-                         edgecolor="0.5", 
-                         linewidth=0.1, 
-                         ax=cp_ax,
-                         label="Aucun mouvement de terrain")
-
-# Ajouter un titre
-plt.title("Fréquence d'occurrence des mouvements de terrain par code postal en France", fontsize=14)
-plt.axis('off')
 
 # Sauvegarder la carte
 cp_output_png = os.path.join(results_dir, "carte_frequence_mvt_terrain_cp.png")
-plt.savefig(cp_output_png, dpi=300, bbox_inches="tight")
+rendre_cartes(cp_map_data.geometry.values,
+              [(cp_output_png, cp_map_data["frequence"].to_numpy(),
+                "Fréquence d'occurrence des mouvements de terrain par code postal en France",
+                "Fréquence de mouvements de terrain par code postal", cp_vmin, cp_vmax)],
+              nb_processus=1, cmap=cmap, figsize=(15, 10), couleur_contour="0.5", largeur_contour=0.1,
+              axes=False, taille_titre=14, gras=False, legende_kwds={})
 print(f"\nCarte par code postal sauvegardée sous: {cp_output_png}")
 
 # Exporter les données en CSV
@@ -7,6 +7,8 @@ import glob
 from pathlib import Path
 import pandas as pd
 import re
+import json
+import pyarrow.parquet as pq
 
 # Chemins des fichiers
 base_dir = "/Users/noa/Desktop/PRISM/Data/Indicateurs_PRISM/SécheresseRGA"
@@ -32,13 +34,36 @@ def extract_scenario(filename):
     else:
         return "UNKNOWN"
 
+# Lecture d'un fichier de résultats DRIAS : GeoPackage, ou Parquet sans géométrie (FORMAT_SORTIE = "PARQUET"),
+# dont la géométrie est dans la couche GEOMETRIES_*.gpkg indiquée par les métadonnées du fichier
+def read_result_file(data_file, with_geometry=True):
+    if not data_file.endswith(".parquet"):
+        return gpd.read_file(data_file)
+    data_df = pd.read_parquet(data_file)
+    if not with_geometry:
+        return data_df
+    meta = json.loads(pq.read_schema(data_file).metadata[b"drias_geometries"])
+    geom_gdf = gpd.read_file(os.path.join(os.path.dirname(data_file), meta["couche"]), columns=[meta["cle"]])
+    return geom_gdf.merge(data_df, on=meta["cle"], how="right")
+
+# Liste des fichiers de résultats d'un dossier (le plus récent si un résultat existe aux deux formats)
+def find_result_files(data_dir):
+    data_files = {}
+    for data_file in glob.glob(os.path.join(data_dir, "*.gpkg")) + glob.glob(os.path.join(data_dir, "*.parquet")):
+        if os.path.basename(data_file).startswith("GEOMETRIES_"):
+            continue
+        stem = os.path.splitext(data_file)[0]
+        if stem not in data_files or os.path.getmtime(data_file) > os.path.getmtime(data_files[stem]):
+            data_files[stem] = data_file
+    return sorted(data_files.values())
+
 # Fonction générique pour traiter les données DRIAS
 def process_drias_data(base_path, prefix_code, variable_name, column_prefix):
     print(f"Traitement de {variable_name} (Données DRIAS)...")
     data_dir = os.path.join(base_path, "Resultats")
     
-    # Trouver tous les fichiers gpkg disponibles
-    data_files = glob.glob(os.path.join(data_dir, "*.gpkg"))
+    # Trouver tous les fichiers de résultats disponibles (gpkg ou parquet)
+    data_files = find_result_files(data_dir)
     print(f"Fichiers {variable_name} trouvés: {data_files}")
     
     global final_gdf
@@ -50,7 +75,7 @@ def process_drias_data(base_path, prefix_code, variable_name, column_prefix):
         
         print(f"Traitement de {filename}, scénario détecté: {scenario}")
         try:
-            data_gdf = gpd.read_file(data_file)
+            data_gdf = read_result_file(data_file, with_geometry=False)
             
             # Afficher les colonnes disponibles pour le debug
             print(f"Colonnes disponibles dans {data_file}: {list(data_gdf.columns)}")
@@ -93,7 +118,7 @@ def process_drias_data(base_path, prefix_code, variable_name, column_prefix):
             # Fusionner avec le DataFrame final
             if final_gdf is None:
                 # Pour le premier jeu de données, conserver la géométrie
-                data_gdf_with_geom = gpd.read_file(data_file)
+                data_gdf_with_geom = read_result_file(data_file)
                 data_gdf_with_geom = data_gdf_with_geom.rename(columns={prefix_code: "code_postal"})
                 if "geometry" in data_gdf_with_geom.columns:
                     final_gdf = gpd.GeoDataFrame(data_gdf, geometry=data_gdf_with_geom["geometry"])
@@ -0,0 +1,135 @@
+# Rendu par lots des cartes choroplèthes (DRIAS_V4.py, DRIAS_V4_ETE_HIVER.py, GASPAR.py) : les chemins des
+# polygones et la figure sont construits une fois par couche, chaque carte ne change que les couleurs,
+# l'échelle et le titre ; les cartes sont réparties sur des processus
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib
+import matplotlib.pyplot as plt
+import numpy as np
+import shapely
+from matplotlib.collections import PathCollection
+from matplotlib.colors import Normalize
+from matplotlib.path import Path
+
+
+def chemins_polygones(geometries):
+    """Un chemin matplotlib par géométrie (polygones et multipolygones, trous compris), construit sans
+    boucle sur les sommets. Les anneaux sont orientés (extérieur anti-horaire, trous horaires) pour que
+    le remplissage par enroulement non nul laisse les trous vides."""
+    geometries = shapely.orient_polygons(np.asarray(geometries))
+    parties, geometrie_partie = shapely.get_parts(geometries, return_index=True)
+    anneaux, partie_anneau = shapely.get_rings(parties, return_index=True)
+    sommets, anneau_sommet = shapely.get_coordinates(anneaux, return_index=True)
+
+    # MOVETO au premier sommet de chaque anneau, CLOSEPOLY au dernier (qui répète le premier)
+    codes = np.full(len(sommets), Path.LINETO, dtype=Path.code_type)
+    debuts = np.flatnonzero(np.r_[True, anneau_sommet[1:] != anneau_sommet[:-1]])
+    codes[debuts] = Path.MOVETO
+    codes[np.r_[debuts[1:], len(sommets)] - 1] = Path.CLOSEPOLY
+
+    geometrie_sommet = geometrie_partie[partie_anneau[anneau_sommet]]
+    bornes = np.searchsorted(geometrie_sommet, np.arange(len(geometries) + 1))
+    return [Path(sommets[a:b], codes[a:b]) for a, b in zip(bornes[:-1], bornes[1:])]
+
+
+class CarteChoroplethe:
+    """Figure d'une couche de polygones réutilisée pour toutes ses cartes.
+
+    Les remplissages (tramés si `rasteriser`, les contours restant vectoriels dans un PDF) et les
+    contours sont deux collections construites une fois ; `rendre` change le tableau de valeurs,
+    l'échelle de couleurs, la légende et le titre, puis enregistre la figure.
+    """
+
+    def __init__(self, geometries, cmap, figsize=(11, 8.5), alpha=None, couleur_contour='black',
+                 largeur_contour=0.2, rasteriser=False, axes=True, taille_titre=18, gras=True,
+                 legende_kwds=None, dpi=300):
+        chemins = chemins_polygones(geometries)
+        self.dpi, self.taille_titre, self.gras = dpi, taille_titre, gras
+        self.fig, self.ax = plt.subplots(figsize=figsize)
+        self.remplissage = PathCollection(chemins, cmap=cmap, norm=Normalize(), alpha=alpha,
+                                          edgecolor='none', linewidth=0, zorder=1)
+        self.remplissage.set_array(np.zeros(len(chemins)))
+        self.remplissage.set_rasterized(rasteriser)
+        collections = [self.remplissage]
+        if largeur_contour:
+            collections.append(PathCollection(chemins, facecolor='none', edgecolor=couleur_contour,
+                                              linewidth=largeur_contour, zorder=2))
+        for collection in collections:
+            # Hors du calcul du cadrage : les polygones sont dans les axes, inutile de mesurer chaque chemin
+            collection.set_in_layout(False)
+            self.ax.add_collection(collection, autolim=False)
+        xmin, ymin, xmax, ymax = shapely.total_bounds(np.asarray(geometries))
+        marge_x, marge_y = 0.05 * (xmax - xmin), 0.05 * (ymax - ymin)
+        self.ax.set_xlim(xmin - marge_x, xmax + marge_x)
+        self.ax.set_ylim(ymin - marge_y, ymax + marge_y)
+        self.ax.set_aspect('equal')
+        if not axes:
+            self.ax.set_axis_off()
+        self.barre = self.fig.colorbar(self.remplissage, ax=self.ax, **({'shrink': 0.6, 'aspect': 20} if legende_kwds is None else legende_kwds))
+        self.titre = self.ax.set_title(" ", fontsize=taille_titre, fontweight='bold' if gras else 'normal')
+        self.fig.tight_layout()
+
+    def rendre(self, chemin, valeurs, titre, legende="", vmin=None, vmax=None):
+        """Enregistre la carte de `valeurs` (une par géométrie, NaN non coloriés) dans `chemin` (PDF, PNG...)."""
+        valeurs = np.ma.masked_invalid(np.asarray(valeurs, dtype=float))
+        self.remplissage.set_array(valeurs)
+        self.remplissage.set_clim(valeurs.min() if vmin is None else vmin, valeurs.max() if vmax is None else vmax)
+        self.barre.set_label(legende)
+        self.titre.set_text(titre)
+        # Cadrage serré mesuré sans dessiner les polygones (bbox_inches='tight' dessinerait la carte deux fois)
+        if hasattr(self.fig.canvas, "get_renderer"):
+            cadre = self.fig.get_tightbbox(self.fig.canvas.get_renderer()).padded(0.1)
+        else:
+            cadre = 'tight'
+        self.fig.savefig(chemin, dpi=self.dpi, bbox_inches=cadre)
+        return chemin
+
+    def fermer(self):
+        plt.close(self.fig)
+
+
+# Carte construite une fois dans chaque processus de rendu
+_carte_processus = None
+
+
+def _initialiser_processus(geometries_wkb, options):
+    global _carte_processus
+    matplotlib.use("Agg")
+    _carte_processus = CarteChoroplethe(shapely.from_wkb(geometries_wkb), **options)
+
+
+def _rendre_paquet(cartes):
+    return [_carte_processus.rendre(*carte) for carte in cartes]
+
+
+def rendre_cartes(geometries, cartes, nb_processus=0, **options):
+    """Rend les `cartes` (tuples (chemin, valeurs, titre, légende[, vmin, vmax])) d'une même couche.
+
+    Avec plusieurs processus (0 = tous les cœurs), chacun construit la figure une fois puis rend sa part
+    des cartes ; appelé depuis un processus de traiter_lot, le rendu reste séquentiel. `options` est
+    transmis à CarteChoroplethe. Retourne les chemins écrits.
+    """
+    if not cartes:
+        return []
+    debut = time.perf_counter()
+    nb_processus = min(nb_processus or os.cpu_count() or 1, len(cartes))
+    if multiprocessing.parent_process() is not None:
+        # Déjà dans un processus du lot (traiter_lot) : les cœurs sont occupés par les autres fichiers
+        nb_processus = 1
+    if nb_processus <= 1:
+        carte = CarteChoroplethe(geometries, **options)
+        try:
+            chemins = [carte.rendre(*c) for c in cartes]
+        finally:
+            carte.fermer()
+    else:
+        paquets = [cartes[i::nb_processus] for i in range(nb_processus)]
+        with ProcessPoolExecutor(max_workers=nb_processus, initializer=_initialiser_processus,
+                                 initargs=(shapely.to_wkb(np.asarray(geometries)), options)) as pool:
+            chemins = [c for paquet in pool.map(_rendre_paquet, paquets) for c in paquet]
+    print(f"{len(chemins)} carte(s) créée(s) en {time.perf_counter() - debut:.1f} s "
+          f"({nb_processus} processus), ex. {chemins[0]}")
+    return chemins
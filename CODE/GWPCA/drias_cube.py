@@ -0,0 +1,242 @@
+# Cube des résultats DRIAS (entité x variable x scénario x horizon x saison) écrit en Zarr ou NetCDF à la fin
+# d'un lot de DRIAS_V4.py / DRIAS_V4_ETE_HIVER.py (FORMAT_CUBE) : une seule lecture indexée remplace
+# l'ouverture des fichiers *_FINAL_RESULTS_* et l'analyse des noms de colonnes ({variable}_{horizon})
+import glob
+import json
+import os
+import re
+import shutil
+
+import numpy as np
+import pandas as pd
+import pyogrio
+
+from drias_lots import chemin_temporaire, est_temporaire
+
+try:
+    import xarray as xr
+except ImportError:  # xarray absent : FORMAT_CUBE doit rester "AUCUN"
+    xr = None
+
+# Libellés des dimensions, dans l'ordre d'affichage (les libellés inconnus sont ajoutés à la suite)
+SCENARIOS = ["REF", "RCP2.6", "RCP4.5", "RCP8.5"]
+HORIZONS = ["REF", "H1", "H2", "H3"]
+SAISONS = ["ANNEE", "HIVER", "ETE"]
+# Suffixes de colonnes qui désignent une saison (DRIAS_V4_ETE_HIVER.py, colonne 'Saison')
+SUFFIXES_SAISON = {"Hiver": "HIVER", "HIVER": "HIVER", "Été": "ETE", "ETE": "ETE"}
+# Groupes du cube : niveau -> (motif des fichiers de résultats, colonne identifiant les entités)
+NIVEAUX = {
+    "entites": ("_FINAL_RESULTS_{type}", None),
+    "departements": ("_FINAL_RESULTS_DEPARTEMENTS_{type}", "INSEE_DEP"),
+    "regions": ("_FINAL_RESULTS_REGIONS_{type}", "INSEE_REG"),
+}
+
+
+def scenario_fichier(nom):
+    """Scénario d'un fichier d'après son nom (même règle que extract_scenario d'AGGREGATION.py, les RCP
+    2_6, 4_5 et 8_5 étant cherchés d'abord pour les noms de modèles contenant des chiffres)."""
+    correspondance = re.search(r'(?<![0-9])(2_6|4_5|8_5)(?![0-9])', nom)
+    if correspondance:
+        return f"RCP{correspondance.group(1).replace('_', '.')}"
+    correspondance = re.search(r'(\d+)_(\d+)', nom)
+    if correspondance:
+        return f"RCP{correspondance.group(1)}.{correspondance.group(2)}"
+    return "REF" if "REF" in nom.upper() else None
+
+
+def saison_chemin(chemin):
+    """Saison indiquée par le nom du fichier ou de son dossier d'entrée (..._ETE, ..._HIVER), sinon ANNEE."""
+    dossier_entree = os.path.dirname(os.path.dirname(os.path.abspath(chemin)))
+    mots = re.split(r'[^A-ZÉ0-9]+', f"{os.path.basename(dossier_entree)}_{os.path.basename(chemin)}".upper())
+    if "HIVER" in mots:
+        return "HIVER"
+    if "ETE" in mots or "ÉTÉ" in mots:
+        return "ETE"
+    return "ANNEE"
+
+
+def fichiers_resultats(dossiers, motif):
+    """Fichiers de résultats (Parquet ou GeoPackage, le plus récent si les deux existent) dont le nom
+    se termine par `motif`, dans tous les `dossiers`, sans les fichiers temporaires à moitié écrits."""
+    fichiers = {}
+    for dossier in dossiers:
+        for chemin in glob.glob(os.path.join(dossier, f"*{motif}.parquet")) + glob.glob(os.path.join(dossier, f"*{motif}.gpkg")):
+            if est_temporaire(chemin):
+                continue
+            racine = os.path.splitext(chemin)[0]
+            if racine not in fichiers or os.path.getmtime(chemin) > os.path.getmtime(fichiers[racine]):
+                fichiers[racine] = chemin
+    return sorted(fichiers.values())
+
+
+def couches_fichier(fichier, type_reference):
+    """Couche de résultats de chaque niveau d'un fichier d'entrée dans son dossier Resultats/ : {niveau: chemin}
+    (la plus récente si les sorties Parquet et GeoPackage existent toutes deux)."""
+    dossier_resultats = os.path.join(os.path.dirname(os.path.abspath(fichier)), "Resultats")
+    racine = os.path.splitext(os.path.basename(fichier))[0] + "_clean"
+    couches = {}
+    for niveau, (motif, _) in NIVEAUX.items():
+        base = os.path.join(dossier_resultats, racine + motif.format(type=type_reference))
+        chemins = [c for c in (base + ".parquet", base + ".gpkg") if os.path.exists(c)]
+        if chemins:
+            couches[niveau] = max(chemins, key=os.path.getmtime)
+    return couches
+
+
+def lire_valeurs(chemin):
+    """Table de résultats sans géométrie."""
+    if chemin.endswith(".parquet"):
+        return pd.read_parquet(chemin)
+    return pyogrio.read_dataframe(chemin, read_geometry=False)
+
+
+def decomposer_colonne(colonne):
+    """(variable, horizon, saison) d'une colonne de résultat {variable}_{suffixe} ; saison None si le
+    suffixe est un horizon."""
+    variable, _, suffixe = colonne.rpartition("_")
+    if suffixe in SUFFIXES_SAISON:
+        return variable, None, SUFFIXES_SAISON[suffixe]
+    return variable, suffixe, None
+
+
+def _libelles(connus, trouves):
+    return [l for l in connus if l in trouves] + sorted(trouves - set(connus))
+
+
+def separer_colonnes(table):
+    """(colonnes de valeurs {variable}_{suffixe} en flottants, colonnes descriptives) d'une table de résultats."""
+    colonnes_valeurs = [c for c in table.columns if "_" in c and table[c].dtype.kind == "f"]
+    return colonnes_valeurs, [c for c in table.columns if c not in colonnes_valeurs and c != "id_entite"]
+
+
+def cles_entites(table, colonne_id, colonnes_descriptives):
+    """Clé de chaque ligne : `colonne_id`, sinon id_entite (sorties Parquet), sinon les colonnes descriptives
+    (numérotées en cas de doublon, dans l'ordre du fichier)."""
+    if colonne_id is not None and colonne_id in table.columns:
+        return table[colonne_id].astype(str).to_numpy()
+    if "id_entite" in table.columns:
+        return table["id_entite"].to_numpy(dtype=np.int64)
+    cles = table[colonnes_descriptives].astype(str).agg("|".join, axis=1)
+    return (cles + "#" + cles.groupby(cles).cumcount().astype(str)).to_numpy()
+
+
+def cube_niveau(chemins, colonne_id=None):
+    """Dataset xarray d'un niveau (entités, départements ou régions) : variable `valeur` (float32) de
+    dimensions (entite, variable, scenario, horizon, saison), colonnes descriptives en coordonnées."""
+    tables, descriptions = [], {}
+    for chemin in chemins:
+        scenario = scenario_fichier(os.path.basename(chemin))
+        if scenario is None:
+            print(f"Scénario non reconnu, fichier ignoré pour le cube: {chemin}")
+            continue
+        table = lire_valeurs(chemin)
+        colonnes_valeurs, colonnes_descriptives = separer_colonnes(table)
+        cles = cles_entites(table, colonne_id, colonnes_descriptives)
+        for cle, ligne in zip(cles, table[colonnes_descriptives].astype(str).itertuples(index=False)):
+            descriptions.setdefault(cle, ligne._asdict())
+        saison_fichier = saison_chemin(chemin)
+        colonnes = []
+        for colonne in colonnes_valeurs:
+            variable, horizon, saison = decomposer_colonne(colonne)
+            # Colonnes par saison : l'horizon vient du nom de fichier (H1, H2...) ou du scénario de référence
+            if horizon is None:
+                horizon = next(iter(re.findall(r'(?<![A-Z0-9])(H\d)(?![0-9])', os.path.basename(chemin).upper())),
+                               "REF" if scenario == "REF" else None)
+                if horizon is None:
+                    print(f"Horizon introuvable pour {colonne} dans {chemin}, colonne ignorée pour le cube")
+                    continue
+            colonnes.append((colonne, variable, horizon, saison or saison_fichier))
+        tables.append((scenario, cles, table, colonnes))
+
+    if not tables:
+        return None
+    cles = list(descriptions)
+    # Entités repérées par id_entite (sorties Parquet) : rangées dans l'ordre de la couche de référence
+    par_identifiant = all(isinstance(c, (int, np.integer)) for c in cles)
+    if par_identifiant:
+        cles = sorted(cles)
+    variables = list(dict.fromkeys(v for _, _, _, cs in tables for _, v, _, _ in cs))
+    scenarios = _libelles(SCENARIOS, {s for s, _, _, _ in tables})
+    horizons = _libelles(HORIZONS, {h for _, _, _, cs in tables for _, _, h, _ in cs})
+    saisons = _libelles(SAISONS, {s for _, _, _, cs in tables for _, _, _, s in cs})
+
+    valeurs = np.full((len(cles), len(variables), len(scenarios), len(horizons), len(saisons)), np.nan, dtype=np.float32)
+    index_cles = pd.Index(cles)
+    for scenario, cles_table, table, colonnes in tables:
+        lignes = index_cles.get_indexer(cles_table)
+        k = scenarios.index(scenario)
+        for colonne, variable, horizon, saison in colonnes:
+            valeurs[lignes, variables.index(variable), k, horizons.index(horizon), saisons.index(saison)] = \
+                table[colonne].to_numpy(dtype=np.float32)
+
+    # Libellés en chaînes de longueur variable (type de chaîne standard de Zarr v3 et NetCDF 4)
+    coordonnees = {"entite": np.arange(len(cles)), "variable": np.array(variables, dtype=object),
+                   "scenario": np.array(scenarios, dtype=object), "horizon": np.array(horizons, dtype=object),
+                   "saison": np.array(saisons, dtype=object)}
+    if par_identifiant:
+        coordonnees["id_entite"] = ("entite", np.array(cles, dtype=np.int64))
+    description = pd.DataFrame([descriptions[c] for c in cles])
+    for colonne in description.columns:
+        coordonnees[colonne] = ("entite", description[colonne].to_numpy(dtype=object))
+    return xr.Dataset({"valeur": (("entite", "variable", "scenario", "horizon", "saison"), valeurs)},
+                      coords=coordonnees)
+
+
+def chemin_cube(dossiers_resultats, type_reference, format_cube="ZARR"):
+    """Chemin par défaut du cube : DRIAS_CUBE_{type}.zarr ou .nc dans le dossier commun aux résultats."""
+    extension = ".zarr" if format_cube == "ZARR" else ".nc"
+    return os.path.join(os.path.commonpath([os.path.abspath(d) for d in dossiers_resultats]),
+                        f"DRIAS_CUBE_{type_reference}{extension}")
+
+
+def ecrire_cube(dossiers_resultats, type_reference, format_cube="ZARR", chemin=None, taille_bloc=8192):
+    """Rassemble les résultats des `dossiers_resultats` en un cube (un groupe par niveau : entites,
+    departements, regions) écrit en Zarr (dossier .zarr) ou NetCDF (.nc), compressé et découpé en blocs
+    de `taille_bloc` entités. Retourne le chemin écrit (None si aucun résultat)."""
+    if xr is None:
+        print("xarray n'est pas installé : cube non écrit")
+        return None
+    if chemin is None:
+        chemin = chemin_cube(dossiers_resultats, type_reference, format_cube)
+    chemin_tmp = chemin_temporaire(chemin)
+    ecrits = []
+    try:
+        for niveau, (motif, colonne_id) in NIVEAUX.items():
+            fichiers = fichiers_resultats(dossiers_resultats, motif.format(type=type_reference))
+            cube = cube_niveau(fichiers, colonne_id)
+            if cube is None:
+                continue
+            cube.attrs.update(type_reference=type_reference, niveau=niveau,
+                              fichiers=json.dumps([os.path.basename(f) for f in fichiers]))
+            blocs = (min(taille_bloc, cube.sizes["entite"]),) + cube["valeur"].shape[1:]
+            if format_cube == "ZARR":
+                cube.to_zarr(chemin_tmp, group=niveau, mode="w" if not ecrits else "a",
+                             encoding={"valeur": {"chunks": blocs}}, consolidated=False)
+            else:
+                cube.to_netcdf(chemin_tmp, group=niveau, mode="w" if not ecrits else "a",
+                               encoding={"valeur": {"zlib": True, "complevel": 4, "chunksizes": blocs}})
+            ecrits.append(f"{niveau} {dict(cube['valeur'].sizes)}")
+        if not ecrits:
+            print("Aucun résultat trouvé pour le cube")
+            return None
+        # Remplacement de l'ancien cube (dossier Zarr ou fichier NetCDF)
+        if os.path.isdir(chemin):
+            shutil.rmtree(chemin)
+        os.replace(chemin_tmp, chemin)
+    finally:
+        if os.path.isdir(chemin_tmp):
+            shutil.rmtree(chemin_tmp)
+        elif os.path.exists(chemin_tmp):
+            os.remove(chemin_tmp)
+    print(f"Cube des résultats écrit: {chemin}")
+    for ligne in ecrits:
+        print(f"  {ligne}")
+    return chemin
+
+
+def ouvrir_cube(chemin, niveau="entites"):
+    """Ouvre un niveau du cube sans le charger : cube.valeur.sel(variable=..., scenario=..., horizon=...)
+    ne lit que les blocs nécessaires."""
+    if chemin.endswith(".zarr"):
+        return xr.open_dataset(chemin, group=niveau, engine="zarr", consolidated=False)
+    return xr.open_dataset(chemin, group=niveau, engine="netcdf4")
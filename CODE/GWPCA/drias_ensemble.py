@@ -0,0 +1,237 @@
+# Statistiques d'ensemble des résultats DRIAS de plusieurs modèles (DRIAS_V4.py / DRIAS_V4_ETE_HIVER.py,
+# STATISTIQUES_ENSEMBLE) : les couches de résultats de chaque fichier sont ajoutées dès qu'il est traité à des
+# accumulateurs par entité x colonne (moyenne et variance en ligne, histogramme pour les quantiles) dont la
+# taille dépend du nombre d'entités et non du nombre de modèles ; un résumé par groupe est écrit à la fin
+import os
+import re
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+from drias_cube import (NIVEAUX, cles_entites, couches_fichier, lire_valeurs, saison_chemin, scenario_fichier,
+                        separer_colonnes)
+from drias_lots import ecrire_atomique
+from drias_sorties import ecrire_table_valeurs, geometries_associees
+
+# Quantiles du résumé (suffixe de colonne -> probabilité)
+QUANTILES = {"Q10": 0.1, "MEDIANE": 0.5, "Q90": 0.9}
+# Valeurs gardées telles quelles par entité et colonne (quantiles exacts jusqu'à ce nombre de modèles)
+TAILLE_TAMPON = 16
+# Classes de l'histogramme, bornées d'après les valeurs du tampon (plus deux classes de débordement)
+NB_CLASSES = 64
+# Sous-dossier de Resultats/ des résumés (hors des motifs *_FINAL_RESULTS_* lus par le cube et les tuiles)
+DOSSIER_ENSEMBLE = "Ensemble"
+
+
+def _agrandir(tableau, nb_entites, nb_colonnes, remplissage):
+    """Étend les deux derniers axes (entités, colonnes) d'un tableau d'accumulateurs."""
+    ajout = [(0, 0)] * (tableau.ndim - 2) + [(0, nb_entites - tableau.shape[-2]), (0, nb_colonnes - tableau.shape[-1])]
+    return np.pad(tableau, ajout, constant_values=remplissage)
+
+
+class AccumulateurEnsemble:
+    """Statistiques en ligne d'un groupe de couches de résultats, par entité x colonne de valeurs.
+
+    Moyenne et variance suivent l'algorithme de Welford. Les `taille_tampon` premières valeurs de chaque
+    case sont conservées (quantiles exacts pour les petits ensembles) puis fixent les bornes d'un
+    histogramme de `nb_classes` classes, étendues de deux fois leur écart de part et d'autre, où sont
+    comptées toutes les valeurs ; les valeurs hors bornes vont dans deux classes de débordement limitées par le minimum et
+    le maximum observés. Les entités et colonnes nouvelles d'une couche sont ajoutées à la volée.
+    """
+
+    def __init__(self, taille_tampon=TAILLE_TAMPON, nb_classes=NB_CLASSES):
+        self.taille_tampon, self.nb_classes = taille_tampon, nb_classes
+        self.cles = pd.Index([])
+        self.descriptions = None
+        self.colonnes = []
+        self.nb_couches = 0
+        self.n = np.zeros((0, 0), dtype=np.uint32)
+        self.moyenne = np.zeros((0, 0))
+        self.m2 = np.zeros((0, 0))
+        self.minimum = np.full((0, 0), np.nan)
+        self.maximum = np.full((0, 0), np.nan)
+        self.tampon = np.full((taille_tampon, 0, 0), np.nan, dtype=np.float32)
+        self.bornes = np.full((2, 0, 0), np.nan)
+        # Effectifs sur 16 bits : jusqu'à 65535 couches par groupe
+        self.histogramme = np.zeros((nb_classes + 2, 0, 0), dtype=np.uint16)
+
+    def _agrandir(self, nb_entites, nb_colonnes):
+        for nom, remplissage in (("n", 0), ("moyenne", 0), ("m2", 0), ("minimum", np.nan), ("maximum", np.nan),
+                                 ("tampon", np.nan), ("bornes", np.nan), ("histogramme", 0)):
+            setattr(self, nom, _agrandir(getattr(self, nom), nb_entites, nb_colonnes, remplissage))
+
+    def _compter(self, valeurs, entites, colonnes):
+        """Ajoute des valeurs aux histogrammes (déjà bornés) de leurs cases."""
+        bas, haut = self.bornes[0, entites, colonnes], self.bornes[1, entites, colonnes]
+        classes = np.floor((valeurs - bas) / (haut - bas) * self.nb_classes)
+        classes = np.clip(classes, -1, self.nb_classes).astype(np.int64) + 1
+        np.add.at(self.histogramme, (classes, entites, colonnes), 1)
+
+    def ajouter(self, table, colonne_id=None):
+        """Ajoute une couche de résultats (table sans géométrie, entités repérées comme dans le cube)."""
+        colonnes_valeurs, colonnes_descriptives = separer_colonnes(table)
+        cles = cles_entites(table, colonne_id, colonnes_descriptives)
+        nouvelles = ~pd.Index(cles).isin(self.cles)
+        if nouvelles.any():
+            description = table.loc[nouvelles, [c for c in table.columns if c not in colonnes_valeurs]]
+            self.cles = self.cles.append(pd.Index(cles[nouvelles]))
+            self.descriptions = pd.concat([self.descriptions, description], ignore_index=True)
+        self.colonnes += [c for c in colonnes_valeurs if c not in self.colonnes]
+        self._agrandir(len(self.cles), len(self.colonnes))
+
+        valeurs = np.full(self.n.shape, np.nan)
+        valeurs[np.ix_(self.cles.get_indexer(cles), [self.colonnes.index(c) for c in colonnes_valeurs])] = \
+            table[colonnes_valeurs].to_numpy(dtype=np.float64)
+        valides = ~np.isnan(valeurs)
+        n_avant = self.n.copy()
+        self.n += valides
+
+        # Welford : moyenne et somme des carrés des écarts, cases sans valeur inchangées
+        delta = np.where(valides, valeurs - self.moyenne, 0.0)
+        self.moyenne += delta / np.maximum(self.n, 1)
+        self.m2 += np.where(valides, delta * (valeurs - self.moyenne), 0.0)
+        self.minimum = np.fmin(self.minimum, valeurs)
+        self.maximum = np.fmax(self.maximum, valeurs)
+
+        # Tampon tant qu'il n'est pas plein, histogramme ensuite
+        entites, colonnes = np.nonzero(valides & (n_avant < self.taille_tampon))
+        self.tampon[n_avant[entites, colonnes], entites, colonnes] = valeurs[entites, colonnes]
+        entites, colonnes = np.nonzero(valides & (n_avant >= self.taille_tampon))
+        self._compter(valeurs[entites, colonnes], entites, colonnes)
+
+        # Tampons qui viennent d'être remplis : bornes de l'histogramme, puis comptage des valeurs du tampon
+        entites, colonnes = np.nonzero(valides & (n_avant == self.taille_tampon - 1))
+        if len(entites):
+            tampon = self.tampon[:, entites, colonnes].astype(np.float64)
+            bas, haut = tampon.min(axis=0), tampon.max(axis=0)
+            marge = np.where(haut > bas, 2 * (haut - bas), np.maximum(np.abs(bas) * 0.01, 1e-6))
+            self.bornes[0, entites, colonnes] = bas - marge
+            self.bornes[1, entites, colonnes] = haut + marge
+            self._compter(tampon.ravel(), np.tile(entites, self.taille_tampon), np.tile(colonnes, self.taille_tampon))
+        self.nb_couches += 1
+
+    def quantiles(self, probabilite):
+        """Quantile de chaque case : exact tant que le tampon suffit, interpolé dans l'histogramme sinon."""
+        resultat = np.full(self.n.shape, np.nan)
+        petits = (self.n > 0) & (self.n <= self.taille_tampon)
+        if petits.any():
+            resultat[petits] = np.nanquantile(self.tampon[:, petits].astype(np.float64), probabilite, axis=0)
+        grands = self.n > self.taille_tampon
+        if grands.any():
+            histogramme = self.histogramme[:, grands].astype(np.float64)
+            bas, haut = self.bornes[0, grands], self.bornes[1, grands]
+            limites = bas + np.arange(self.nb_classes + 1)[:, None] * ((haut - bas) / self.nb_classes)
+            minimum, maximum = np.minimum(self.minimum[grands], bas), np.maximum(self.maximum[grands], haut)
+            gauches = np.vstack([minimum, limites])
+            droites = np.vstack([limites, maximum])
+            cumul = np.cumsum(histogramme, axis=0)
+            # Rang du quantile comme np.quantile (interpolation entre les valeurs classées), chaque valeur
+            # occupant une unité de rang au milieu de sa classe
+            cible = probabilite * (self.n[grands] - 1.0) + 0.5
+            classe = np.argmax(cumul >= cible, axis=0)
+            colonnes = np.arange(len(classe))
+            avant = np.where(classe > 0, cumul[np.maximum(classe - 1, 0), colonnes], 0.0)
+            fraction = (cible - avant) / np.maximum(histogramme[classe, colonnes], 1)
+            valeurs = gauches[classe, colonnes] + fraction * (droites[classe, colonnes] - gauches[classe, colonnes])
+            resultat[grands] = np.clip(valeurs, self.minimum[grands], self.maximum[grands])
+        return resultat
+
+    def resume(self):
+        """Table des entités avec, pour chaque colonne de valeurs, {colonne}_N, _MOYENNE, _ECART_TYPE
+        (écart-type entre modèles), _MIN, les quantiles de QUANTILES et _MAX."""
+        vide = self.n == 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            statistiques = {
+                "N": self.n,
+                "MOYENNE": np.where(vide, np.nan, self.moyenne),
+                "ECART_TYPE": np.where(self.n > 1, np.sqrt(self.m2 / (self.n.astype(np.float64) - 1)), np.nan),
+                "MIN": self.minimum,
+                **{nom: self.quantiles(p) for nom, p in QUANTILES.items()},
+                "MAX": self.maximum,
+            }
+        colonnes = {}
+        for j, colonne in enumerate(self.colonnes):
+            for nom, valeurs in statistiques.items():
+                colonnes[f"{colonne}_{nom}"] = valeurs[:, j] if nom == "N" else valeurs[:, j].astype(np.float32)
+        return pd.concat([self.descriptions.reset_index(drop=True), pd.DataFrame(colonnes)], axis=1)
+
+
+class EnsembleDrias:
+    """Statistiques d'ensemble d'un lot DRIAS.
+
+    `ajouter_fichier` (passé en rappel à traiter_lot) lit les couches de résultats d'un fichier d'entrée
+    dès qu'il est traité et les ajoute à l'accumulateur de leur groupe : même niveau (entités,
+    départements, régions), scénario, horizon indiqué dans le nom et saison, les autres parties du nom
+    (modèle, membre...) étant ce qui varie d'un fichier à l'autre. `ecrire` écrit un résumé par groupe
+    dans Resultats/Ensemble/ENSEMBLE_{groupe}_FINAL_RESULTS_{niveau}{type}.
+    """
+
+    def __init__(self, type_reference, taille_tampon=TAILLE_TAMPON, nb_classes=NB_CLASSES):
+        self.type_reference = type_reference
+        self.taille_tampon, self.nb_classes = taille_tampon, nb_classes
+        self.groupes = {}
+        self.fichiers = set()
+
+    def _groupe(self, chemin):
+        """(scénario, horizon, saison) d'une couche de résultats, None si le scénario n'est pas reconnu."""
+        nom = os.path.basename(chemin)
+        scenario = scenario_fichier(nom)
+        if scenario is None:
+            return None
+        horizon = next(iter(re.findall(r'(?<![A-Z0-9])(H\d)(?![0-9])', nom.upper())), None)
+        return scenario, horizon, saison_chemin(chemin)
+
+    def ajouter_fichier(self, fichier, succes=True):
+        """Ajoute les couches de résultats d'un fichier d'entrée traité avec succès (une seule fois par fichier)."""
+        if not succes or fichier in self.fichiers:
+            return
+        self.fichiers.add(fichier)
+        for niveau, chemin in couches_fichier(fichier, self.type_reference).items():
+            colonne_id = NIVEAUX[niveau][1]
+            groupe = self._groupe(chemin)
+            if groupe is None:
+                print(f"Scénario non reconnu, fichier ignoré pour l'ensemble: {chemin}")
+                continue
+            cle = (niveau,) + groupe
+            if cle not in self.groupes:
+                self.groupes[cle] = (AccumulateurEnsemble(self.taille_tampon, self.nb_classes), chemin)
+            try:
+                self.groupes[cle][0].ajouter(lire_valeurs(chemin), colonne_id)
+            except Exception as e:
+                print(f"Erreur lors de l'ajout de {chemin} à l'ensemble: {e}")
+
+    def ecrire(self):
+        """Écrit le résumé de chaque groupe (Parquet relié à la même couche de géométries que ses membres,
+        sinon GeoPackage avec les géométries du premier membre). Retourne les chemins écrits."""
+        ecrits = []
+        for (niveau, scenario, horizon, saison), (accumulateur, exemple) in sorted(self.groupes.items()):
+            if accumulateur.nb_couches == 0:
+                continue
+            etiquette = "_".join([scenario.replace(".", "_")] + [h for h in (horizon,) if h] +
+                                 [saison] * (saison != "ANNEE"))
+            motif, colonne_id = NIVEAUX[niveau]
+            dossier = os.path.join(os.path.dirname(exemple), DOSSIER_ENSEMBLE)
+            os.makedirs(dossier, exist_ok=True)
+            base = os.path.join(dossier, f"ENSEMBLE_{etiquette}{motif.format(type=self.type_reference)}")
+            resume = accumulateur.resume()
+            if exemple.endswith(".parquet"):
+                chemin = base + ".parquet"
+                ecrire_table_valeurs(chemin, resume, os.path.relpath(geometries_associees(exemple)[0], dossier))
+            else:
+                # Géométries du premier membre du groupe, rattachées aux entités par la même clé
+                valeurs = lire_valeurs(exemple)
+                cles = cles_entites(valeurs, colonne_id, separer_colonnes(valeurs)[1])
+                lignes = pd.Index(cles).get_indexer(accumulateur.cles)
+                geometries = gpd.read_file(exemple, columns=[]).geometry
+                geometries = gpd.GeoSeries(geometries.values[np.maximum(lignes, 0)], crs=geometries.crs)
+                geometries[lignes < 0] = None
+                couche = gpd.GeoDataFrame(resume, geometry=geometries.values, crs=geometries.crs)
+                chemin = base + ".gpkg"
+                ecrire_atomique(chemin, lambda c: couche.to_file(c, driver="GPKG"))
+            ecrits.append(chemin)
+            print(f"Ensemble {niveau} {etiquette}: {accumulateur.nb_couches} couche(s), "
+                  f"{len(accumulateur.cles)} entités, {len(accumulateur.colonnes)} colonnes -> {chemin}")
+        if not ecrits:
+            print("Aucun résultat à rassembler pour les statistiques d'ensemble")
+        return ecrits
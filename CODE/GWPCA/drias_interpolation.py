@@ -0,0 +1,94 @@
+# Interpolation ponctuelle des valeurs DRIAS sur le réseau régulier SAFRAN (bilinéaire ou inverse
+# de la distance), utilisée par DRIAS_V4.py / DRIAS_V4_ETE_HIVER.py et réutilisable pour des adresses
+from typing import NamedTuple
+
+import numpy as np
+from pyproj import Transformer
+from scipy import sparse
+
+from drias_poids import moyennes_ponderees
+
+# La grille SAFRAN est régulière (8 km) en Lambert II étendu
+CRS_RESEAU_SAFRAN = "EPSG:27572"
+PAS_SAFRAN = 8000.0
+
+
+class ReseauSafran(NamedTuple):
+    """Réseau régulier des cellules SAFRAN : origine, pas et position de chaque nœud (-1 si absent)."""
+    x0: float
+    y0: float
+    pas: float
+    positions: np.ndarray  # (lignes, colonnes) -> indice de la cellule dans l'ordre des valeurs
+    crs: str = CRS_RESEAU_SAFRAN
+
+
+def reseau_safran(longitudes, latitudes, pas=PAS_SAFRAN, crs_reseau=CRS_RESEAU_SAFRAN, tolerance=0.05):
+    """Range les cellules (WGS 84, dans l'ordre des valeurs) sur le réseau régulier de la grille SAFRAN.
+
+    Lève une ValueError si les points ne tombent pas sur un réseau de pas `pas` (à `tolerance` pas près).
+    """
+    transformateur = Transformer.from_crs("EPSG:4326", crs_reseau, always_xy=True)
+    x, y = transformateur.transform(np.asarray(longitudes, dtype=np.float64), np.asarray(latitudes, dtype=np.float64))
+    x, y = np.asarray(x), np.asarray(y)
+    x0, y0 = x.min(), y.min()
+    colonnes, lignes = np.rint((x - x0) / pas).astype(np.int64), np.rint((y - y0) / pas).astype(np.int64)
+    ecart = max(np.abs((x - x0) / pas - colonnes).max(), np.abs((y - y0) / pas - lignes).max())
+    if ecart > tolerance:
+        raise ValueError(f"Les points SAFRAN ne forment pas un réseau régulier de {pas:g} m "
+                         f"dans {crs_reseau} (écart {ecart:.2f} pas)")
+    # Origine recalée sur la moyenne des résidus pour absorber l'arrondi des coordonnées du fichier
+    x0 += np.mean(x - x0 - colonnes * pas)
+    y0 += np.mean(y - y0 - lignes * pas)
+    positions = np.full((lignes.max() + 1, colonnes.max() + 1), -1, dtype=np.int64)
+    positions[lignes, colonnes] = np.arange(len(x))
+    return ReseauSafran(float(x0), float(y0), float(pas), positions, crs_reseau)
+
+
+def matrice_interpolation(reseau, x, y, methode="BILINEAIRE", crs="EPSG:2154", puissance=2.0):
+    """Matrice creuse points x cellules des poids d'interpolation aux coordonnées (x, y) données dans `crs`.
+
+    methode="BILINEAIRE" utilise les 4 nœuds qui encadrent le point ; methode="IDW" les 16 nœuds
+    voisins (4 x 4) pondérés par 1/distance**puissance. Les nœuds absents sont ignorés ; les poids
+    sont renormalisés par `moyennes_ponderees`, qui écarte aussi les cellules sans valeur.
+    """
+    if methode not in ("BILINEAIRE", "IDW"):
+        raise ValueError(f"Méthode d'interpolation inconnue: {methode}")
+    transformateur = Transformer.from_crs(crs, reseau.crs, always_xy=True)
+    x, y = transformateur.transform(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+    u = (np.asarray(x) - reseau.x0) / reseau.pas
+    v = (np.asarray(y) - reseau.y0) / reseau.pas
+    c0, l0 = np.floor(u).astype(np.int64), np.floor(v).astype(np.int64)
+    tu, tv = u - c0, v - l0
+
+    if methode == "BILINEAIRE":
+        decalages = [(0, 0), (1, 0), (0, 1), (1, 1)]
+    else:
+        decalages = [(dc, dl) for dl in range(-1, 3) for dc in range(-1, 3)]
+    points, cellules, poids = [], [], []
+    nb_lignes, nb_colonnes = reseau.positions.shape
+    for dc, dl in decalages:
+        colonne, ligne = c0 + dc, l0 + dl
+        dedans = (colonne >= 0) & (colonne < nb_colonnes) & (ligne >= 0) & (ligne < nb_lignes)
+        cellule = np.full(len(u), -1, dtype=np.int64)
+        cellule[dedans] = reseau.positions[ligne[dedans], colonne[dedans]]
+        if methode == "BILINEAIRE":
+            p = (tu if dc else 1 - tu) * (tv if dl else 1 - tv)
+        else:
+            distance = np.hypot(tu - dc, tv - dl)
+            with np.errstate(divide='ignore'):
+                p = np.where(distance < 1e-9, 1e12, 1.0 / distance ** puissance)
+        garder = (cellule >= 0) & (p > 0)
+        points.append(np.flatnonzero(garder))
+        cellules.append(cellule[garder])
+        poids.append(p[garder])
+
+    return sparse.csr_matrix((np.concatenate(poids), (np.concatenate(points), np.concatenate(cellules))),
+                             shape=(len(u), int(reseau.positions.max()) + 1))
+
+
+def interpoler(reseau, valeurs, x, y, methode="BILINEAIRE", crs="EPSG:4326", puissance=2.0):
+    """Valeurs (points x variables) interpolées aux coordonnées données, par exemple des adresses en WGS 84.
+
+    `valeurs` est un tableau cellules x variables dans l'ordre utilisé pour construire le réseau.
+    """
+    return moyennes_ponderees(matrice_interpolation(reseau, x, y, methode, crs, puissance), valeurs)
@@ -0,0 +1,277 @@
+# Lecture des exports DRIAS au format texte (.txt) partagée par DRIAS_V4.py et DRIAS_V4_ETE_HIVER.py
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from drias_poids import cle_cellules, empreinte_fichier
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow absent : lecture directe du .txt à chaque exécution
+    pa = pq = None
+
+VERSION_CACHE_LECTURE = 1
+
+
+def corriger_mojibake(texte):
+    """Corrige les accents UTF-8 décodés en Latin-1 (ex: 'PÃ©riode' -> 'Période')."""
+    try:
+        return texte.encode('latin-1').decode('utf-8')
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        return texte
+
+
+def _reperer_entete(fichier):
+    """Parcourt les lignes de commentaire et retourne (en-tête, position du début des données).
+
+    L'en-tête est la ligne '#' contenant des ';' qui suit 'Format des enregistrements'
+    (dans les 4 lignes suivantes), sinon la première ligne '#' contenant des ';'.
+    """
+    entete, entete_secours = "", ""
+    index_format = -1
+    num_ligne = 0
+    while True:
+        position = fichier.tell()
+        brute = fichier.readline()
+        if not brute:
+            return entete or entete_secours, None
+        ligne = brute.decode('utf-8').rstrip('\r\n')
+
+        if ligne.startswith("#"):
+            if "Format des enregistrements" in ligne and index_format == -1:
+                index_format = num_ligne
+                print(f"Ligne 'Format des enregistrements' trouvée à l'index {num_ligne}: {ligne}")
+            elif ";" in ligne:
+                if index_format != -1 and not entete and num_ligne <= index_format + 4:
+                    entete = ligne.replace("#", "").strip()
+                    print(f"Ligne d'en-tête trouvée à l'index {num_ligne}: {ligne}")
+                elif not entete_secours:
+                    entete_secours = ligne.replace("#", "").strip()
+        elif ";" in ligne and ligne.strip():
+            # Première ligne de données : on revient à son début pour la lecture en colonnes
+            print(f"Première ligne de données trouvée à l'index {num_ligne}: {ligne.strip()}")
+            return entete or entete_secours, position
+        num_ligne += 1
+
+
+def chemin_cache_lecture(chemin):
+    """Fichier Parquet rangé à côté du fichier source (ex: DRIAS_4_5.txt -> DRIAS_4_5_cache.parquet)."""
+    return os.path.splitext(chemin)[0] + "_cache.parquet"
+
+
+def _signature_source(chemin, nom_periode):
+    stat = os.stat(chemin)
+    return {'version': VERSION_CACHE_LECTURE, 'nom_periode': nom_periode,
+            'taille': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _ecrire_parquet(table, chemin_cache, signature):
+    meta = dict(table.schema.metadata or {})
+    meta[b'drias_source'] = json.dumps(signature).encode('utf-8')
+    tmp = f"{chemin_cache}.{os.getpid()}.tmp"
+    pq.write_table(table.replace_schema_metadata(meta), tmp)
+    os.replace(tmp, chemin_cache)
+
+
+def charger_cache_lecture(chemin, nom_periode='Période'):
+    """Relit la table Parquet si elle correspond toujours au fichier source, sinon retourne None.
+
+    La taille doit être identique ; si la date de modification a changé, l'empreinte du contenu
+    est recalculée et le cache reste valide tant qu'elle n'a pas bougé.
+    """
+    chemin_cache = chemin_cache_lecture(chemin)
+    if pq is None or not os.path.exists(chemin_cache):
+        return None
+    try:
+        meta = pq.read_schema(chemin_cache).metadata or {}
+        stockee = json.loads(meta.get(b'drias_source', b'{}'))
+    except Exception as e:
+        print(f"Cache de lecture illisible ({e}), relecture du fichier source")
+        return None
+
+    signature = _signature_source(chemin, nom_periode)
+    for cle in ('version', 'nom_periode', 'taille'):
+        if stockee.get(cle) != signature[cle]:
+            return None
+    table = None
+    if stockee.get('mtime_ns') != signature['mtime_ns']:
+        if stockee.get('empreinte') != empreinte_fichier(chemin):
+            return None
+        # Contenu inchangé (fichier copié ou touché) : on met à jour la date dans le cache
+        table = pq.read_table(chemin_cache)
+        _ecrire_parquet(table, chemin_cache, dict(stockee, mtime_ns=signature['mtime_ns']))
+    if table is None:
+        table = pq.read_table(chemin_cache)
+    return table.to_pandas()
+
+
+def sauvegarder_cache_lecture(chemin, df, nom_periode='Période'):
+    """Enregistre la table lue au format Parquet, avec la taille, la date et l'empreinte du source."""
+    if pq is None:
+        return
+    signature = _signature_source(chemin, nom_periode)
+    signature['empreinte'] = empreinte_fichier(chemin)
+    try:
+        _ecrire_parquet(pa.Table.from_pandas(df, preserve_index=False), chemin_cache_lecture(chemin), signature)
+    except OSError as e:
+        print(f"Impossible d'écrire le cache de lecture: {e}")
+
+
+def lire_fichier_drias(chemin, nom_periode='Période', utiliser_cache=True):
+    """Lit un export DRIAS en passant par le cache Parquet quand il est à jour."""
+    if utiliser_cache:
+        df = charger_cache_lecture(chemin, nom_periode)
+        if df is not None:
+            print(f"Table relue depuis le cache: {chemin_cache_lecture(chemin)}")
+            return df
+
+    df = lire_texte_drias(chemin, nom_periode)
+    if utiliser_cache and df is not None and not df.empty:
+        sauvegarder_cache_lecture(chemin, df, nom_periode)
+    return df
+
+
+def _lecteur_drias(fichier, nom_periode='Période', taille_bloc=None):
+    """Repère l'en-tête d'un fichier ouvert en binaire et retourne le lecteur CSV pandas des données
+    (DataFrame, ou itérateur de blocs de `taille_bloc` lignes), None si aucune donnée n'est trouvée."""
+    entete, debut_donnees = _reperer_entete(fichier)
+    if debut_donnees is None:
+        print("ERREUR: aucune ligne de données trouvée!")
+        return None
+
+    fichier.seek(debut_donnees)
+    premiere_ligne = fichier.readline().decode('utf-8').strip()
+    fichier.seek(debut_donnees)
+
+    if entete:
+        print(f"En-tête trouvée: {entete}")
+        noms = [corriger_mojibake(nom.strip()) for nom in entete.split(";")]
+    else:
+        # Pas d'en-tête : noms génériques déduits du nombre de champs de la première ligne
+        print("ERREUR: Impossible de trouver la ligne d'en-tête! Création d'un en-tête générique")
+        noms = [f"Col{i}" for i in range(1, premiere_ligne.count(";") + 2)]
+    noms = [nom_periode if nom in ('Période', 'Periode') else nom for nom in noms]
+
+    # Les champs vides (';' final) ne sont pas conservés
+    nb_champs = max(len(noms), premiere_ligne.count(";") + 1)
+    noms_complets = [nom if nom else f"_vide{i}" for i, nom in enumerate(noms)]
+    noms_complets += [f"_vide{i}" for i in range(len(noms_complets), nb_champs)]
+    colonnes_utiles = [nom for nom in noms_complets if not nom.startswith("_vide")]
+
+    types = {'Latitude': np.float64, 'Longitude': np.float64}
+    return pd.read_csv(fichier, sep=";", header=None, names=noms_complets, usecols=colonnes_utiles,
+                       index_col=False, comment="#", skip_blank_lines=True, encoding='utf-8',
+                       dtype={k: v for k, v in types.items() if k in colonnes_utiles}, engine='c',
+                       chunksize=taille_bloc)
+
+
+def lire_texte_drias(chemin, nom_periode='Période'):
+    """Lit un export DRIAS .txt en un seul passage et retourne un DataFrame aux colonnes typées.
+
+    L'en-tête est repéré dans les commentaires, les accents mal encodés y sont corrigés et la
+    colonne de période est renommée en `nom_periode` ; les lignes de données sont lues directement
+    par le lecteur CSV de pandas, sans fichier intermédiaire ni copie du texte en mémoire.
+    Retourne None si aucune donnée n'est trouvée.
+    """
+    with open(chemin, 'rb') as fichier:
+        df = _lecteur_drias(fichier, nom_periode)
+    if df is None:
+        return None
+
+    print(f"Nombre total de lignes de données lues: {len(df)}")
+    return df
+
+
+def preparer_cache_lecture(chemin, nom_periode='Période', taille_bloc=200_000):
+    """Garantit un cache Parquet à jour pour `chemin` et retourne son chemin (None sans pyarrow).
+
+    Le fichier texte est converti par blocs de `taille_bloc` lignes, sans jamais être chargé en entier ;
+    si les types d'un bloc diffèrent du premier (entiers devenus décimaux...), la conversion est
+    reprise par une lecture complète.
+    """
+    if pq is None:
+        return None
+    chemin_cache = chemin_cache_lecture(chemin)
+    signature = _signature_source(chemin, nom_periode)
+    if os.path.exists(chemin_cache):
+        try:
+            stockee = json.loads((pq.read_schema(chemin_cache).metadata or {}).get(b'drias_source', b'{}'))
+        except Exception:
+            stockee = {}
+        # Mêmes règles que charger_cache_lecture, sans relire la table
+        if all(stockee.get(cle) == signature[cle] for cle in ('version', 'nom_periode', 'taille')) and (
+                stockee.get('mtime_ns') == signature['mtime_ns']
+                or stockee.get('empreinte') == empreinte_fichier(chemin)):
+            return chemin_cache
+
+    signature['empreinte'] = empreinte_fichier(chemin)
+    tmp = f"{chemin_cache}.{os.getpid()}.tmp"
+    ecrivain, nb_lignes = None, 0
+    try:
+        with open(chemin, 'rb') as fichier:
+            lecteur = _lecteur_drias(fichier, nom_periode, taille_bloc)
+            if lecteur is None:
+                return None
+            for bloc in lecteur:
+                if ecrivain is None:
+                    schema = pa.Schema.from_pandas(bloc, preserve_index=False)
+                    schema = schema.with_metadata({b'drias_source': json.dumps(signature).encode('utf-8')})
+                    ecrivain = pq.ParquetWriter(tmp, schema)
+                ecrivain.write_table(pa.Table.from_pandas(bloc, schema=schema, preserve_index=False))
+                nb_lignes += len(bloc)
+        if ecrivain is None:
+            return None
+        ecrivain.close()
+        os.replace(tmp, chemin_cache)
+        print(f"Fichier converti par blocs en {nb_lignes} lignes: {chemin_cache}")
+        return chemin_cache
+    except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError, ValueError) as e:
+        print(f"Types variables d'un bloc à l'autre ({e}), conversion par lecture complète")
+        if ecrivain is not None:
+            ecrivain.close()
+        df = lire_texte_drias(chemin, nom_periode)
+        if df is None or df.empty:
+            return None
+        sauvegarder_cache_lecture(chemin, df, nom_periode)
+        return chemin_cache if os.path.exists(chemin_cache) else None
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def resumer_cache_lecture(chemin_cache, nom_periode='Période', colonnes_a_exclure=()):
+    """Parcourt le cache Parquet par groupes de lignes et retourne (cellules, périodes, variables, lignes) :
+    coordonnées des cellules uniques indexées par identifiant (triées), périodes dans l'ordre
+    d'apparition, colonnes numériques hors `colonnes_a_exclure` et nombre total de lignes."""
+    fichier = pq.ParquetFile(chemin_cache)
+    schema = fichier.schema_arrow
+    colonnes_cellules = [c for c in ('Point', 'Longitude', 'Latitude') if c in schema.names]
+    colonnes_periode = [nom_periode] if nom_periode in schema.names else []
+    variables = [champ.name for champ in schema
+                 if champ.name not in colonnes_a_exclure and not champ.name.startswith('Unnamed')
+                 and (pa.types.is_floating(champ.type) or pa.types.is_integer(champ.type))]
+
+    cellules, periodes = [], {}
+    for lot in fichier.iter_batches(columns=colonnes_cellules + colonnes_periode):
+        bloc = lot.to_pandas()
+        if colonnes_periode:
+            periodes.update(dict.fromkeys(bloc.pop(nom_periode).unique()))
+        cle = cle_cellules(bloc)
+        uniques = ~cle.duplicated().to_numpy()
+        cellules.append(bloc.loc[uniques, ['Longitude', 'Latitude']].set_index(cle[uniques].to_numpy()))
+    cellules = pd.concat(cellules)
+    cellules = cellules[~cellules.index.duplicated()].sort_index()
+    return cellules, list(periodes), variables, fichier.metadata.num_rows
+
+
+def lire_cache_cellules(chemin_cache, ids_cellules, longitudes, latitudes, colonnes=None):
+    """Lignes du cache Parquet appartenant aux cellules `ids_cellules` (de coordonnées données) ;
+    seuls les groupes de lignes recoupant l'emprise des cellules sont décodés."""
+    marge = 1e-6
+    filtres = [('Longitude', '>=', float(np.min(longitudes)) - marge), ('Longitude', '<=', float(np.max(longitudes)) + marge),
+               ('Latitude', '>=', float(np.min(latitudes)) - marge), ('Latitude', '<=', float(np.max(latitudes)) + marge)]
+    df = pq.read_table(chemin_cache, columns=colonnes, filters=filtres).to_pandas()
+    return df[cle_cellules(df).isin(ids_cellules).to_numpy()]
@@ -0,0 +1,102 @@
+# Traitement par lots des dossiers DRIAS (DRIAS_V4.py et DRIAS_V4_ETE_HIVER.py) :
+# répartition des fichiers sur un pool de processus, couches chargées une fois par processus
+# et écriture atomique des résultats
+import os
+import re
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import geopandas as gpd
+
+# Couches vectorielles déjà lues par ce processus, par chemin
+_couches_en_memoire = {}
+
+
+def charger_couche(chemin):
+    """Lit une couche (shapefile, gpkg) une seule fois par processus et en retourne une copie."""
+    if chemin not in _couches_en_memoire:
+        _couches_en_memoire[chemin] = gpd.read_file(chemin)
+    return _couches_en_memoire[chemin].copy()
+
+
+def chemin_temporaire(chemin):
+    """Nom du fichier temporaire propre au processus, renommé en `chemin` une fois l'écriture finie."""
+    racine, extension = os.path.splitext(chemin)
+    return f"{racine}.{os.getpid()}.tmp{extension}"
+
+
+def est_temporaire(chemin):
+    """Vrai pour un fichier temporaire de chemin_temporaire (laissé par un processus interrompu)."""
+    return re.search(r'\.\d+\.tmp(\.[^.]*)?$', os.path.basename(chemin)) is not None
+
+
+def ecrire_atomique(chemin, ecrire):
+    """Appelle ecrire(chemin_temporaire) puis renomme le fichier : jamais de résultat à moitié écrit."""
+    chemin_tmp = chemin_temporaire(chemin)
+    try:
+        ecrire(chemin_tmp)
+        os.replace(chemin_tmp, chemin)
+    finally:
+        if os.path.exists(chemin_tmp):
+            os.remove(chemin_tmp)
+    return chemin
+
+
+def _traiter_protege(fonction, fichier, arguments):
+    """Exécute le traitement d'un fichier sans laisser une exception interrompre le lot."""
+    try:
+        return bool(fonction(fichier, *arguments))
+    except Exception as e:
+        print(f"Erreur non interceptée pour {fichier}: {e}")
+        traceback.print_exc()
+        return False
+
+
+def traiter_lot(fichiers, fonction, arguments=(), nb_processus=0, rappel=None):
+    """Traite une liste de fichiers avec fonction(fichier, *arguments) et retourne {fichier: succès}.
+
+    Le premier fichier est traité dans le processus principal pour remplir les caches (lecture,
+    poids) ; les suivants sont répartis sur nb_processus processus (0 = tous les cœurs, 1 = séquentiel).
+    `rappel(fichier, succès)` (ou chaque fonction d'une liste `rappel`) est appelé dans le processus
+    principal dès qu'un fichier est terminé.
+    `fonction` ne doit retourner une valeur vraie que si toutes les sorties du fichier ont été écrites :
+    le bilan du lot, le manifeste incrémental et les étapes suivantes s'y fient.
+    """
+    fichiers = sorted(fichiers)
+    if not fichiers:
+        return {}
+    nb_processus = nb_processus or os.cpu_count() or 1
+    nb_processus = min(nb_processus, max(len(fichiers) - 1, 1))
+    debut = time.perf_counter()
+    rappels = [] if rappel is None else list(rappel) if isinstance(rappel, (list, tuple)) else [rappel]
+
+    def terminer(fichier, succes):
+        resultats[fichier] = succes
+        for r in rappels:
+            r(fichier, succes)
+
+    resultats = {}
+    terminer(fichiers[0], _traiter_protege(fonction, fichiers[0], arguments))
+    if nb_processus == 1:
+        for fichier in fichiers[1:]:
+            terminer(fichier, _traiter_protege(fonction, fichier, arguments))
+    else:
+        print(f"\nRépartition de {len(fichiers) - 1} fichiers sur {nb_processus} processus...")
+        with ProcessPoolExecutor(max_workers=nb_processus) as pool:
+            taches = {pool.submit(_traiter_protege, fonction, fichier, arguments): fichier
+                      for fichier in fichiers[1:]}
+            for tache in as_completed(taches):
+                try:
+                    succes = tache.result()
+                except Exception as e:  # processus interrompu (mémoire, signal...)
+                    print(f"Échec du processus pour {taches[tache]}: {e}")
+                    succes = False
+                terminer(taches[tache], succes)
+
+    echecs = [f for f in fichiers if not resultats.get(f)]
+    print(f"\nLot terminé en {time.perf_counter() - debut:.1f} s: "
+          f"{len(fichiers) - len(echecs)} fichier(s) traité(s), {len(echecs)} échec(s)")
+    for fichier in echecs:
+        print(f"  - Échec: {fichier}")
+    return resultats
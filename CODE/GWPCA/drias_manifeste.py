@@ -0,0 +1,132 @@
+# Manifeste des lots DRIAS (DRIAS_V4.py / DRIAS_V4_ETE_HIVER.py, TRAITEMENT_INCREMENTAL) : pour chaque fichier
+# d'entrée, empreinte de son contenu, version des couches de référence, options de traitement et sorties
+# produites ; seuls les fichiers nouveaux, modifiés ou traités avec d'autres options sont retraités
+import glob
+import json
+import os
+import time
+
+from drias_lots import ecrire_atomique, est_temporaire
+from drias_sorties import empreinte_couche, fichiers_couche, geometries_associees
+
+VERSION_MANIFESTE = 1
+
+
+def signature(chemins):
+    """Taille et date de modification (ns) des fichiers existants : test rapide avant tout calcul d'empreinte."""
+    return [[os.path.basename(c), os.stat(c).st_size, os.stat(c).st_mtime_ns] for c in chemins if os.path.exists(c)]
+
+
+def sorties_fichier(fichier):
+    """Sorties d'un fichier d'entrée : fichiers {nom}_clean_* de Resultats/ et Verification/, et couches de
+    géométries partagées dont dépendent ses tables Parquet."""
+    dossier, nom = os.path.split(fichier)
+    prefixe = os.path.splitext(nom)[0] + "_clean_"
+    sorties = []
+    for sous_dossier in ("Resultats", "Verification"):
+        sorties += [c for c in glob.glob(os.path.join(dossier, sous_dossier, glob.escape(prefixe) + "*")) if not est_temporaire(c)]
+    sorties += [geometries_associees(c)[0] for c in sorties if c.endswith(".parquet")]
+    return sorted(set(sorties))
+
+
+class ManifesteLot:
+    """Manifestes Resultats/MANIFESTE_LOT_{nom}.json des dossiers d'entrée d'un lot.
+
+    `a_traiter` retourne les fichiers dont l'empreinte, les couches de référence, les options ou les
+    sorties ont changé depuis le dernier traitement réussi ; `enregistrer` met à jour les manifestes
+    avec le résultat de traiter_lot. Le contenu d'un fichier n'est relu que si sa taille ou sa date a changé.
+    """
+
+    def __init__(self, nom):
+        self.nom = nom
+        self._manifestes = {}
+        self._couches, self._options = {}, {}
+
+    def _chemin(self, dossier_entree):
+        return os.path.join(dossier_entree, "Resultats", f"MANIFESTE_LOT_{self.nom}.json")
+
+    def _manifeste(self, dossier_entree):
+        if dossier_entree not in self._manifestes:
+            manifeste = {}
+            chemin = self._chemin(dossier_entree)
+            if os.path.exists(chemin):
+                try:
+                    with open(chemin, encoding="utf-8") as f:
+                        manifeste = json.load(f)
+                except (OSError, ValueError) as e:
+                    print(f"Manifeste illisible, lot entièrement retraité: {chemin} ({e})")
+            if manifeste.get("version") != VERSION_MANIFESTE:
+                manifeste = {"version": VERSION_MANIFESTE, "fichiers": {}, "empreintes": {}}
+            self._manifestes[dossier_entree] = manifeste
+        return self._manifestes[dossier_entree]
+
+    def _empreinte(self, manifeste, chemin):
+        """Empreinte du contenu de `chemin`, reprise du manifeste si sa signature n'a pas changé."""
+        cle = os.path.abspath(chemin)
+        signature_actuelle = signature(fichiers_couche(chemin))
+        connue = manifeste["empreintes"].get(cle)
+        if connue is None or connue["signature"] != signature_actuelle:
+            connue = {"signature": signature_actuelle, "empreinte": empreinte_couche(chemin)}
+            manifeste["empreintes"][cle] = connue
+        return connue["empreinte"]
+
+    def _a_jour(self, fichier):
+        dossier_entree, nom = os.path.split(os.path.abspath(fichier))
+        manifeste = self._manifeste(dossier_entree)
+        entree = manifeste["fichiers"].get(nom)
+        if entree is None or entree["options"] != self._options:
+            return False
+        couches = {role: self._empreinte(manifeste, chemin) for role, chemin in self._couches.items()}
+        if entree["couches"] != couches or entree["empreinte"] != self._empreinte(manifeste, fichier):
+            return False
+        return all(signature([os.path.join(dossier_entree, c)]) == [s] for c, s in entree["sorties"].items())
+
+    def _couches_finales_manquantes(self, fichier, sorties):
+        """Couches finales attendues ({nom}_clean_FINAL_RESULTS_[DEPARTEMENTS_]{type}) absentes des sorties."""
+        prefixe = os.path.splitext(os.path.basename(fichier))[0] + "_clean_FINAL_RESULTS_"
+        attendues = [prefixe + self.nom] + ([prefixe + "DEPARTEMENTS_" + self.nom] if "departements" in self._couches else [])
+        racines = {os.path.splitext(os.path.basename(c))[0] for c in sorties if c.endswith((".gpkg", ".parquet"))}
+        return [a for a in attendues if a not in racines]
+
+    def a_traiter(self, fichiers, couches, options):
+        """Fichiers à (re)traiter parmi `fichiers`, pour les `couches` de référence ({rôle: chemin}) et les
+        `options` (dictionnaire sérialisable en JSON) du lot."""
+        debut = time.perf_counter()
+        self._couches = {role: chemin for role, chemin in couches.items() if chemin}
+        self._options = json.loads(json.dumps(options))
+        a_traiter = [f for f in fichiers if not self._a_jour(f)]
+        a_jour = len(fichiers) - len(a_traiter)
+        print(f"Manifeste du lot: {a_jour} fichier(s) à jour, {len(a_traiter)} à traiter "
+              f"(vérifié en {(time.perf_counter() - debut) * 1000:.0f} ms)")
+        for fichier in sorted(set(fichiers) - set(a_traiter)):
+            print(f"  - À jour: {os.path.basename(fichier)}")
+        return a_traiter
+
+    def enregistrer(self, resultats):
+        """Inscrit les fichiers traités avec succès ({fichier: succès}, retour de traiter_lot), retire les
+        échecs et les fichiers dont une couche finale manque, puis réécrit les manifestes."""
+        for fichier, succes in resultats.items():
+            dossier_entree, nom = os.path.split(os.path.abspath(fichier))
+            manifeste = self._manifeste(dossier_entree)
+            sorties = sorties_fichier(fichier) if succes else []
+            manquantes = self._couches_finales_manquantes(fichier, sorties) if succes else []
+            if manquantes:
+                print(f"Couches finales absentes, {nom} sera retraité: {', '.join(manquantes)}")
+            if not succes or manquantes:
+                manifeste["fichiers"].pop(nom, None)
+                continue
+            manifeste["fichiers"][nom] = {
+                "empreinte": self._empreinte(manifeste, fichier),
+                "couches": {role: self._empreinte(manifeste, chemin) for role, chemin in self._couches.items()},
+                "options": self._options,
+                "sorties": {os.path.relpath(c, dossier_entree): signature([c])[0] for c in sorties},
+                "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+            }
+        for dossier_entree, manifeste in self._manifestes.items():
+            chemin = self._chemin(dossier_entree)
+            os.makedirs(os.path.dirname(chemin), exist_ok=True)
+
+            def ecrire(c, manifeste=manifeste):
+                with open(c, "w", encoding="utf-8") as f:
+                    json.dump(manifeste, f, indent=1, ensure_ascii=False)
+            ecrire_atomique(chemin, ecrire)
@@ -0,0 +1,215 @@
+# Variations par rapport à la période de référence (REF) des résultats DRIAS, calculées au fil d'un lot de
+# DRIAS_V4.py / DRIAS_V4_ETE_HIVER.py (NORMALISER_REF) à la place de normalize_drias_data.R : chaque fichier
+# est normalisé dès qu'il est traité, la table REF de chaque niveau est lue une fois et gardée en mémoire,
+# les scénarios lui sont appariés par identifiant d'entité et toutes les colonnes sont calculées en une seule
+# opération sur les tableaux
+import os
+import re
+import shutil
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+from drias_cube import NIVEAUX, cles_entites, couches_fichier, decomposer_colonne, lire_valeurs, separer_colonnes
+from drias_lots import ecrire_atomique
+from drias_sorties import ecrire_table_valeurs, geometries_associees
+from drias_tuiles_web import niveau_resultat
+
+# Variables normalisées (mêmes que normalize_drias_data.R et l'option "variations en %" de DRIAS_INTERACTIVE)
+VARIABLES_NORMALISEES = ["NORTAV", "NORSD", "NORTX35", "NORTR", "NORTXHWD", "NORTNCWD",
+                         "NORTNFD", "NORRR", "NORRR1MM", "NORFFQ98", "NORFF98"]
+# |REF| sous lequel la variation relative n'est pas calculée (NaN), comme dans normalize_drias_data.R
+SEUIL_REFERENCE = 0.001
+# Suffixe des colonnes d'écart absolu (valeur - REF) ajoutées à côté des variations en %
+SUFFIXE_ECART = "_ECART"
+
+
+def dossier_normalise(dossier_resultats):
+    """Dossier lu par l'application pour les variations : Data/{thème}/Resultats -> Data/DRIAS_NORM/{thème}/Resultats."""
+    dossier_entree = os.path.dirname(os.path.abspath(dossier_resultats))
+    return os.path.join(os.path.dirname(dossier_entree), "DRIAS_NORM", os.path.basename(dossier_entree), "Resultats")
+
+
+def nom_reference(nom):
+    """Fichier REF d'un fichier de scénario (2_6, 4_5 ou 8_5 remplacé par REFERENCE), None si ce n'en est pas un."""
+    if "REFERENCE" in nom:
+        return None
+    reference = re.sub(r'(2_6|4_5|8_5)', 'REFERENCE', nom, count=1)
+    return reference if reference != nom else None
+
+
+def colonnes_variation(colonnes_scenario, colonnes_reference, variables=VARIABLES_NORMALISEES):
+    """Paires (colonne du scénario, colonne de REF) : {variable}_H1..H3 face à {variable}_REF, colonnes
+    par saison ({variable}_Hiver...) face à la même colonne du fichier REF."""
+    paires = []
+    for colonne in colonnes_scenario:
+        variable, horizon, saison = decomposer_colonne(colonne)
+        if variable not in variables or horizon == "REF":
+            continue
+        reference = colonne if saison is not None else f"{variable}_REF"
+        if reference in colonnes_reference:
+            paires.append((colonne, reference))
+    return paires
+
+
+def variations(valeurs, reference, seuil=SEUIL_REFERENCE):
+    """Écarts absolus (valeur - REF) et variations relatives ((valeur - REF) / |REF| * 100, NaN si |REF| <= seuil)."""
+    ecarts = valeurs - reference
+    with np.errstate(invalid='ignore', divide='ignore'):
+        relatives = np.where(np.abs(reference) > seuil, ecarts / np.abs(reference) * 100, np.nan)
+    return ecarts, relatives
+
+
+class _TableReference:
+    """Valeurs d'un fichier REF indexées par entité (et géométries pour un GeoPackage), lues une fois."""
+
+    def __init__(self, chemin):
+        self.table = lire_valeurs(chemin)
+        _, colonnes_descriptives = separer_colonnes(self.table)
+        self.colonne_id = NIVEAUX[niveau_resultat(os.path.basename(chemin))][1]
+        self.index = pd.Index(cles_entites(self.table, self.colonne_id, colonnes_descriptives))
+        self.geometries = None if chemin.endswith(".parquet") else gpd.read_file(chemin, columns=[]).geometry
+
+    def lignes(self, table):
+        """Ligne de REF de chaque entité de `table` (-1 si absente)."""
+        return self.index.get_indexer(cles_entites(table, self.colonne_id, separer_colonnes(table)[1]))
+
+
+def _a_jour(sortie, sources):
+    return os.path.exists(sortie) and os.path.getmtime(sortie) >= max(os.path.getmtime(s) for s in sources)
+
+
+def _lier(source, sortie):
+    """Écrit `sortie` comme lien physique vers `source` (copie si le système de fichiers ne le permet pas)."""
+    def lier(chemin):
+        try:
+            os.link(source, chemin)
+        except OSError:
+            shutil.copyfile(source, chemin)
+    return ecrire_atomique(sortie, lier)
+
+
+class NormalisationRef:
+    """Variations par rapport à REF d'un lot DRIAS, écrites au fil du lot dans le dossier DRIAS_NORM.
+
+    `ajouter_fichier` (passé en rappel à traiter_lot) reçoit chaque fichier d'entrée dès qu'il est traité.
+    Ses couches REF (ou hors scénario) sont liées dans DRIAS_NORM sans être copiées, et chaque table REF
+    n'est lue qu'une fois, à sa première utilisation, puis gardée en mémoire. Ses couches de scénario
+    reçoivent dans les colonnes des `variables` la variation en % par rapport à la couche REFERENCE
+    correspondante, avec l'écart absolu dans {colonne}_ECART, dès que celle-ci est arrivée ; elles
+    attendent sinon. Les couches déjà plus récentes que leurs sources ne sont pas réécrites et une couche
+    en échec n'arrête pas les autres. `terminer` traite les scénarios encore en attente.
+    """
+
+    def __init__(self, type_reference, variables=VARIABLES_NORMALISEES):
+        self.type_reference, self.variables = type_reference, variables
+        self.fichiers = set()
+        # Couches REF arrivées (chemin sans extension -> chemin), tables REF lues et scénarios en attente
+        self.chemins_reference = {}
+        self.references = {}
+        self.en_attente = {}
+        self.ecrits, self.a_jour, self.echecs = [], 0, 0
+
+    def ajouter_fichier(self, fichier, succes=True):
+        """Normalise les couches de résultats d'un fichier d'entrée traité avec succès (une seule fois par fichier)."""
+        if not succes or fichier in self.fichiers:
+            return
+        self.fichiers.add(fichier)
+        for chemin in couches_fichier(fichier, self.type_reference).values():
+            racine = os.path.splitext(chemin)[0]
+            racine_reference = nom_reference(os.path.basename(racine))
+            if racine_reference is None:
+                self._normaliser(chemin, None)
+                if "REFERENCE" in os.path.basename(racine):
+                    self.chemins_reference[racine] = chemin
+                    for scenario in self.en_attente.pop(racine, []):
+                        self._normaliser(scenario, chemin)
+                continue
+            racine_reference = os.path.join(os.path.dirname(chemin), racine_reference)
+            if racine_reference in self.chemins_reference:
+                self._normaliser(chemin, self.chemins_reference[racine_reference])
+            else:
+                self.en_attente.setdefault(racine_reference, []).append(chemin)
+
+    def _reference(self, chemin):
+        if chemin not in self.references:
+            self.references[chemin] = _TableReference(chemin)
+        return self.references[chemin]
+
+    def _normaliser(self, chemin, chemin_reference):
+        """Écrit la couche de DRIAS_NORM de `chemin` : lien vers la couche si `chemin_reference` est None."""
+        nom = os.path.basename(chemin)
+        dossier_sortie = dossier_normalise(os.path.dirname(chemin))
+        sortie = os.path.join(dossier_sortie, nom)
+        try:
+            sources = [chemin] + ([chemin_reference] if chemin_reference else [])
+            if chemin.endswith(".parquet"):
+                geometries = geometries_associees(chemin)[0]
+                sources.append(geometries)
+            if _a_jour(sortie, sources):
+                self.a_jour += 1
+                return
+            os.makedirs(dossier_sortie, exist_ok=True)
+            if chemin.endswith(".parquet"):
+                # Couche de géométries liée à côté des tables, qui la désignent par son nom comme dans Resultats/
+                lien_geometries = os.path.basename(geometries)
+                sortie_geometries = os.path.join(dossier_sortie, lien_geometries)
+                if not _a_jour(sortie_geometries, [geometries]):
+                    _lier(geometries, sortie_geometries)
+            if chemin_reference is None:
+                # Fichier REF (ou hors scénario) : repris tel quel
+                _lier(chemin, sortie)
+                self.ecrits.append(sortie)
+                return
+
+            reference = self._reference(chemin_reference)
+            table = lire_valeurs(chemin)
+            paires = colonnes_variation(table.columns, reference.table.columns, self.variables)
+            lignes = reference.lignes(table)
+            absentes = int((lignes < 0).sum())
+            if absentes:
+                print(f"Attention: {absentes} entité(s) de {nom} absentes du fichier REF (variations NaN)")
+
+            # Toutes les colonnes du fichier en une opération : (entités x colonnes) face aux lignes de REF
+            colonnes = [c for c, _ in paires]
+            valeurs_reference = reference.table[[r for _, r in paires]].to_numpy(dtype=np.float64)[lignes]
+            valeurs_reference[lignes < 0] = np.nan
+            ecarts, relatives = variations(table[colonnes].to_numpy(dtype=np.float64), valeurs_reference)
+            table[colonnes] = relatives
+            table = pd.concat([table, pd.DataFrame(ecarts, columns=[c + SUFFIXE_ECART for c in colonnes],
+                                                   index=table.index)], axis=1)
+
+            if chemin.endswith(".parquet"):
+                ecrire_table_valeurs(sortie, table, lien_geometries)
+            else:
+                # GeoPackage lu par l'application : géométries reprises du fichier REF en mémoire (mêmes
+                # entités), le scénario n'est relu avec sa géométrie que si certaines manquent dans REF
+                if absentes:
+                    geometries = gpd.read_file(chemin, columns=[]).geometry
+                else:
+                    geometries = gpd.GeoSeries(reference.geometries.values[lignes], crs=reference.geometries.crs)
+                couche = gpd.GeoDataFrame(table, geometry=geometries.values, crs=geometries.crs)
+                ecrire_atomique(sortie, lambda c: couche.to_file(c, driver="GPKG"))
+            self.ecrits.append(sortie)
+            print(f"Variations par rapport à REF écrites: {sortie} ({len(colonnes)} colonnes)")
+        except Exception as e:
+            # Couche illisible ou écriture en échec : retentée au prochain lot (sortie plus ancienne que ses sources)
+            print(f"Erreur lors de la normalisation de {nom}: {e}")
+            self.echecs += 1
+
+    def terminer(self):
+        """Normalise les scénarios dont la couche REF n'est pas arrivée pendant le lot avec celle déjà présente
+        dans Resultats/ s'il y en a une, puis affiche le bilan. Retourne les chemins écrits."""
+        for racine_reference, scenarios in sorted(self.en_attente.items()):
+            chemins = [c for c in (racine_reference + ".parquet", racine_reference + ".gpkg") if os.path.exists(c)]
+            for chemin in scenarios:
+                if chemins:
+                    self._normaliser(chemin, max(chemins, key=os.path.getmtime))
+                else:
+                    print(f"Fichier de référence non trouvé pour {os.path.basename(chemin)}: "
+                          f"{os.path.basename(racine_reference)}")
+        self.en_attente = {}
+        print(f"Normalisation REF: {len(self.ecrits)} couche(s) écrite(s), {self.a_jour} à jour, "
+              f"{self.echecs} échec(s)")
+        return self.ecrits
@@ -0,0 +1,736 @@
+# Fonctions partagées par DRIAS_V4.py et DRIAS_V4_ETE_HIVER.py pour le calcul
+# des moyennes pondérées par la surface (cellules SAFRAN -> entités de référence)
+import hashlib
+import multiprocessing
+import os
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+import geopandas as gpd
+import numpy as np
+import shapely
+from pyproj import Transformer
+from scipy import sparse
+
+try:
+    import fcntl
+except ImportError:  # Windows : registre de la grille complété sans verrou entre processus
+    fcntl = None
+
+# Demi-côté des cellules SAFRAN (8 km x 8 km) en mètres, Lambert 93
+DEMI_COTE_SAFRAN = 4000
+
+# Version du format des poids : à incrémenter si le calcul des intersections change
+VERSION_POIDS = 1
+
+
+def cle_cellules(df):
+    """Identifiant de la cellule SAFRAN de chaque ligne (colonne Point, sinon couple Longitude/Latitude)."""
+    if 'Point' in df.columns:
+        return df['Point']
+    return df['Longitude'].astype(str) + '_' + df['Latitude'].astype(str)
+
+
+def valeurs_par_cellule(grille_scenario, ids_cellules, colonnes_variables):
+    """Aligne les valeurs d'un scénario sur l'ordre des cellules de la matrice des poids (NaN si absente)."""
+    valeurs = grille_scenario[colonnes_variables].copy()
+    valeurs.index = cle_cellules(grille_scenario).to_numpy()
+    valeurs = valeurs[~valeurs.index.duplicated()]
+    return valeurs.reindex(ids_cellules).to_numpy(dtype=np.float64)
+
+
+def _aretes_signees(geometries, trier=True):
+    """Arêtes (tableaux x0, y0, x1, y1) de tous les anneaux des (multi)polygones, avec facteur de signe et entité.
+
+    Le facteur vaut +1/-1 pour que la somme des produits vectoriels donne une aire positive
+    pour les extérieurs et négative pour les trous, quelle que soit l'orientation des anneaux.
+    Les arêtes sont rangées par entité puis par ordonnée minimale croissante (si `trier`).
+    """
+    parties, entite_partie = shapely.get_parts(np.asarray(geometries), return_index=True)
+    polygones = shapely.get_type_id(parties) == 3
+    parties, entite_partie = parties[polygones], entite_partie[polygones]
+    anneaux, partie_anneau = shapely.get_rings(parties, return_index=True)
+    exterieur = np.r_[True, partie_anneau[1:] != partie_anneau[:-1]] if len(anneaux) else np.empty(0, bool)
+    coords, anneau_coord = shapely.get_coordinates(anneaux, return_index=True)
+
+    meme_anneau = anneau_coord[:-1] == anneau_coord[1:]
+    debut, fin = coords[:-1][meme_anneau], coords[1:][meme_anneau]
+    anneau = anneau_coord[:-1][meme_anneau]
+    produits = debut[:, 0] * fin[:, 1] - fin[:, 0] * debut[:, 1]
+    orientation = np.sign(np.bincount(anneau, produits, minlength=len(anneaux)))
+    facteurs = np.where(exterieur, 1.0, -1.0)[anneau] * orientation[anneau]
+    entites = entite_partie[partie_anneau[anneau]]
+    if not trier:
+        return (debut[:, 0], debut[:, 1], fin[:, 0], fin[:, 1]), facteurs, entites
+    ordre = np.lexsort((np.fmin(debut[:, 1], fin[:, 1]), entites))
+    aretes = (debut[ordre, 0], debut[ordre, 1], fin[ordre, 0], fin[ordre, 1])
+    return aretes, facteurs[ordre], entites[ordre]
+
+
+def aires_paires_rectangles(geometries, paires_entites, xmin, ymin, xmax, ymax, taille_bloc=4_000_000):
+    """Aires exactes des intersections entre des (multi)polygones et des rectangles alignés sur les axes.
+
+    `paires_entites[k]` désigne le polygone intersecté avec le rectangle k. Le contour du
+    polygone est borné au rectangle (x et y ramenés dans leurs intervalles) : ce contour a la
+    même aire signée que l'intersection. Pour chaque arête, l'intégrale de X dY du contour borné
+    a une expression fermée, ce qui rend le calcul vectorisé sur toutes les paires
+    (arête, rectangle), traitées par blocs de `taille_bloc` lignes.
+    """
+    paires_entites = np.asarray(paires_entites, dtype=np.int64)
+    cx, cy = (np.asarray(xmin) + np.asarray(xmax)) / 2, (np.asarray(ymin) + np.asarray(ymax)) / 2
+    demi_x, demi_y = (np.asarray(xmax) - np.asarray(xmin)) / 2, (np.asarray(ymax) - np.asarray(ymin)) / 2
+    aires = np.zeros(len(paires_entites))
+    (ax0, ay0, ax1, ay1), facteurs, entites_aretes = _aretes_signees(geometries)
+    if len(ax0) == 0 or len(paires_entites) == 0:
+        return aires
+
+    # Pour chaque paire, seules les arêtes qui peuvent traverser la bande horizontale du rectangle
+    # sont retenues : les arêtes étant triées par (entité, y minimal), c'est une plage contiguë
+    # trouvée par recherche dichotomique sur une clé composite entité/ordonnée.
+    nb_entites = len(np.asarray(geometries))
+    debut_aretes = np.searchsorted(entites_aretes, np.arange(nb_entites + 1))
+    ymin_aretes = np.fmin(ay0, ay1)
+    hauteur_max = np.zeros(nb_entites)
+    np.maximum.at(hauteur_max, entites_aretes, np.abs(ay1 - ay0))
+    origine = ymin_aretes.min()
+    echelle = ymin_aretes.max() - origine + 1.0
+    cle = entites_aretes * echelle + (ymin_aretes - origine)
+    decalage_entite = paires_entites * echelle - origine
+    premiere = np.clip(np.searchsorted(cle, decalage_entite + cy - demi_y - hauteur_max[paires_entites] - 1.0),
+                       debut_aretes[paires_entites], debut_aretes[paires_entites + 1])
+    derniere = np.clip(np.searchsorted(cle, decalage_entite + cy + demi_y + 1.0, side='right'),
+                       premiere, debut_aretes[paires_entites + 1])
+    lignes_par_paire = derniere - premiere
+    fin_lignes = np.cumsum(lignes_par_paire)
+
+    debut_paire = 0
+    while debut_paire < len(paires_entites):
+        fin_paire = max(int(np.searchsorted(fin_lignes, fin_lignes[debut_paire] - lignes_par_paire[debut_paire]
+                                            + taille_bloc, side='right')), debut_paire + 1)
+        bloc = np.arange(debut_paire, fin_paire)
+        nb = lignes_par_paire[bloc]
+        paire = np.repeat(bloc, nb)
+        arete = premiere[paire] + np.arange(nb.sum()) - np.repeat(np.cumsum(nb) - nb, nb)
+
+        # Seules les arêtes qui traversent la bande horizontale du rectangle contribuent (dY borné non nul)
+        cy_ligne = cy[paire]
+        ya, yb = ay0[arete] - cy_ligne, ay1[arete] - cy_ligne
+        hy = demi_y[paire]
+        utile = (np.fmax(ya, yb) > -hy) & (np.fmin(ya, yb) < hy)
+        paire, arete, y0, hy = paire[utile], arete[utile], ya[utile], hy[utile]
+        dy = yb[utile] - y0
+
+        # Coordonnées relatives au centre du rectangle pour limiter les erreurs d'arrondi
+        xa0 = ax0[arete]
+        x0 = xa0 - cx[paire]
+        dx = ax1[arete] - xa0
+        hx = demi_x[paire]
+
+        # Portion [ta, tb] de l'arête où y est dans le rectangle (seule partie où dY borné est non nul)
+        # (les arêtes horizontales ont dy = 0 et ne contribuent pas)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t1, t2 = (-hy - y0) / dy, (hy - y0) / dy
+        ta = np.clip(np.fmin(t1, t2), 0.0, 1.0)
+        tb = np.clip(np.fmax(t1, t2), 0.0, 1.0)
+
+        # Intégrale de x borné sur [ta, tb] via la primitive G(u) = u²/2 (|u| <= h), h|u| - h²/2 sinon
+        xa, xb = x0 + ta * dx, x0 + tb * dx
+        ga = np.where(np.abs(xa) <= hx, 0.5 * xa * xa, hx * np.abs(xa) - 0.5 * hx * hx)
+        gb = np.where(np.abs(xb) <= hx, 0.5 * xb * xb, hx * np.abs(xb) - 0.5 * hx * hx)
+        etendue = np.abs(xb - xa)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            integrale = np.where(etendue > 1e-6, (gb - ga) / dx,
+                                 np.clip(0.5 * (xa + xb), -hx, hx) * (tb - ta))
+
+        contributions = np.where(dy != 0, dy * integrale, 0.0) * facteurs[arete]
+        aires[bloc] = np.bincount(paire - debut_paire, contributions, minlength=len(bloc))
+        debut_paire = fin_paire
+    return np.maximum(aires, 0.0)
+
+
+def aires_rectangles(geometrie, xmin, ymin, xmax, ymax):
+    """Aires exactes de l'intersection d'un (multi)polygone avec plusieurs rectangles alignés sur les axes."""
+    xmin = np.atleast_1d(np.asarray(xmin, dtype=np.float64))
+    return aires_paires_rectangles([geometrie], np.zeros(len(xmin), dtype=np.int64), xmin,
+                                   np.atleast_1d(ymin), np.atleast_1d(xmax), np.atleast_1d(ymax))
+
+
+class GrilleSafran(NamedTuple):
+    """Grille SAFRAN implicite : centres des cellules en Lambert 93 et demi-côté commun (m)."""
+    x: np.ndarray
+    y: np.ndarray
+    demi_cote: float = DEMI_COTE_SAFRAN
+
+
+def grille_safran(longitudes, latitudes, demi_cote=DEMI_COTE_SAFRAN):
+    """Grille implicite à partir des points SAFRAN en WGS 84 (aucune géométrie construite)."""
+    transformateur = Transformer.from_crs("EPSG:4326", "EPSG:2154", always_xy=True)
+    x, y = transformateur.transform(np.asarray(longitudes, dtype=np.float64),
+                                    np.asarray(latitudes, dtype=np.float64))
+    return GrilleSafran(np.asarray(x), np.asarray(y), float(demi_cote))
+
+
+def bornes_grille(grille, indices=None):
+    """Emprises (xmin, ymin, xmax, ymax) des cellules, toutes ou seulement `indices`."""
+    x = grille.x if indices is None else grille.x[indices]
+    y = grille.y if indices is None else grille.y[indices]
+    h = grille.demi_cote
+    return x - h, y - h, x + h, y + h
+
+
+def geometries_grille(grille, indices=None):
+    """Polygones carrés des cellules, construits à la demande (cartes, vérifications, moteur SHAPELY)."""
+    return shapely.box(*bornes_grille(grille, indices))
+
+
+def grille_geodataframe(lignes, ids_cellules, grille):
+    """GeoDataFrame des lignes données avec le polygone de leur cellule (construit pour ces lignes seulement)."""
+    positions = np.searchsorted(ids_cellules, cle_cellules(lignes).to_numpy())
+    return gpd.GeoDataFrame(lignes, geometry=geometries_grille(grille, positions), crs="EPSG:2154")
+
+
+def apparier_entites_grille(geometries_entites, grille):
+    """Paires (entité, cellule) dont les emprises se recouvrent, par arithmétique sur la grille.
+
+    Les centres sont rangés dans des cases de la taille d'une cellule ; pour chaque entité, seules
+    les cases couvrant son emprise élargie d'un demi-côté sont parcourues, puis les emprises sont
+    comparées. Aucun polygone de cellule n'est construit. Paires triées par entité.
+    """
+    b = shapely.bounds(np.asarray(geometries_entites))
+    return _apparier_emprises(b[:, 0], b[:, 1], b[:, 2], b[:, 3], grille)
+
+
+def _apparier_emprises(xmin, ymin, xmax, ymax, grille):
+    """Paires (emprise, cellule) qui se recouvrent, par cases de la taille d'une cellule ; triées par emprise."""
+    h, pas = grille.demi_cote, 2 * grille.demi_cote
+    vides = np.empty(0, dtype=np.int64)
+    if len(grille.x) == 0:
+        return vides, vides
+    x0, y0 = grille.x.min() - h, grille.y.min() - h
+    nb_x = int((grille.x.max() - x0) // pas) + 1
+    nb_y = int((grille.y.max() - y0) // pas) + 1
+
+    # Index des cases : cellules triées par case, début de chaque case dans cet ordre
+    case = ((grille.x - x0) // pas).astype(np.int64) * nb_y + ((grille.y - y0) // pas).astype(np.int64)
+    ordre = np.argsort(case, kind='stable')
+    debuts = np.searchsorted(case[ordre], np.arange(nb_x * nb_y + 1))
+
+    # Plage de cases couverte par l'emprise de chaque entité (élargie d'un demi-côté)
+    # (géométrie vide ou absente : emprise NaN remplacée avant la conversion en entiers, aucune case)
+    b = np.column_stack([xmin, ymin, xmax, ymax]).astype(np.float64)
+    vide = np.isnan(b).any(axis=1)
+    b = np.where(vide[:, None], 0.0, b)
+    ix0 = np.clip(np.floor((b[:, 0] - h - x0) / pas), 0, nb_x - 1).astype(np.int64)
+    ix1 = np.clip(np.floor((b[:, 2] + h - x0) / pas), -1, nb_x - 1).astype(np.int64)
+    iy0 = np.clip(np.floor((b[:, 1] - h - y0) / pas), 0, nb_y - 1).astype(np.int64)
+    iy1 = np.clip(np.floor((b[:, 3] + h - y0) / pas), -1, nb_y - 1).astype(np.int64)
+    nx = np.where(vide, 0, np.maximum(ix1 - ix0 + 1, 0))
+    ny = np.where(vide, 0, np.maximum(iy1 - iy0 + 1, 0))
+
+    # Énumération (entité, case) puis (entité, cellule de la case)
+    nb_cases = nx * ny
+    entites = np.repeat(np.arange(len(b)), nb_cases)
+    rang = np.arange(len(entites)) - np.repeat(np.cumsum(nb_cases) - nb_cases, nb_cases)
+    cases = (ix0[entites] + rang // ny[entites]) * nb_y + iy0[entites] + rang % ny[entites]
+    nb_cellules = debuts[cases + 1] - debuts[cases]
+    entites = np.repeat(entites, nb_cellules)
+    rang = np.arange(len(entites)) - np.repeat(np.cumsum(nb_cellules) - nb_cellules, nb_cellules)
+    cellules = ordre[np.repeat(debuts[cases], nb_cellules) + rang]
+
+    # Test exact de recouvrement des emprises
+    garder = ((np.abs(grille.x[cellules] - (b[entites, 0] + b[entites, 2]) / 2) <= h + (b[entites, 2] - b[entites, 0]) / 2)
+              & (np.abs(grille.y[cellules] - (b[entites, 1] + b[entites, 3]) / 2) <= h + (b[entites, 3] - b[entites, 1]) / 2))
+    entites, cellules = entites[garder], cellules[garder]
+    tri = np.lexsort((cellules, entites))
+    return entites[tri], cellules[tri]
+
+
+def apparier_entites_cellules(geometries_entites, geometries_cellules, predicat="intersects"):
+    """Paires candidates (entité, cellule) en une seule requête STRtree, triées par entité.
+
+    predicat=None ne teste que le recouvrement des emprises (suffisant pour le moteur RECTANGLES).
+    """
+    arbre = shapely.STRtree(np.asarray(geometries_cellules))
+    entites, cellules = arbre.query(np.asarray(geometries_entites), predicate=predicat)
+    ordre = np.lexsort((cellules, entites))
+    return entites[ordre], cellules[ordre]
+
+
+def matrice_poids_raster(geometries_entites, grille, resolution=200.0):
+    """Matrice creuse entités x cellules approchée par rastérisation (aires en m²).
+
+    Les entités sont rastérisées sur une grille de pixels de `resolution` mètres couvrant la grille
+    SAFRAN : un pixel appartient à une entité si son centre est à l'intérieur (règle pair-impair par
+    ligne de balayage), et à une cellule si son centre est dans la cellule. L'aire d'une paire
+    (entité, cellule) est le nombre de pixels communs fois l'aire d'un pixel ; les pixels sont
+    comptés par segment de ligne de balayage, sans construire d'image.
+    """
+    entites = np.asarray(geometries_entites)
+    h, r = grille.demi_cote, float(resolution)
+    nb_cellules = len(grille.x)
+    if nb_cellules == 0 or len(entites) == 0:
+        return sparse.csr_matrix((len(entites), nb_cellules))
+    x_origine, y_origine = (grille.x - h).min(), (grille.y - h).min()
+    nb_colonnes = int(np.ceil(((grille.x + h).max() - x_origine) / r))
+    nb_lignes = int(np.ceil(((grille.y + h).max() - y_origine) / r))
+
+    def rang_pixel(valeurs, origine):
+        # Premier pixel dont le centre est >= valeur
+        return np.ceil((valeurs - origine) / r - 0.5).astype(np.int64)
+
+    # Blocs de pixels [début, fin[ de chaque cellule, en colonnes et en lignes
+    col0, col1 = rang_pixel(grille.x - h, x_origine), rang_pixel(grille.x + h, x_origine)
+    lig0, lig1 = rang_pixel(grille.y - h, y_origine), rang_pixel(grille.y + h, y_origine)
+
+    # Intersections des arêtes avec les lignes de balayage (centres des lignes de pixels)
+    (ax0, ay0, ax1, ay1), _, entites_aretes = _aretes_signees(entites, trier=False)
+    bas = np.clip(rang_pixel(np.fmin(ay0, ay1), y_origine), 0, nb_lignes)
+    haut = np.clip(rang_pixel(np.fmax(ay0, ay1), y_origine), 0, nb_lignes)
+    nb = np.maximum(haut - bas, 0)
+    arete = np.repeat(np.arange(len(nb)), nb)
+    ligne = bas[arete] + np.arange(len(arete)) - np.repeat(np.cumsum(nb) - nb, nb)
+    y_ligne = y_origine + (ligne + 0.5) * r
+    x = ax0[arete] + (y_ligne - ay0[arete]) * (ax1[arete] - ax0[arete]) / (ay1[arete] - ay0[arete])
+    entite = entites_aretes[arete]
+
+    # Segments intérieurs : intersections triées par (entité, ligne, x) et associées deux à deux
+    ordre = np.lexsort((x, ligne, entite))
+    entite, ligne, x = entite[ordre], ligne[ordre], x[ordre]
+    nouveau_groupe = np.r_[True, (entite[1:] != entite[:-1]) | (ligne[1:] != ligne[:-1])]
+    rang = np.arange(len(x)) - np.maximum.accumulate(np.where(nouveau_groupe, np.arange(len(x)), 0))
+    gauche = np.flatnonzero(rang % 2 == 0)
+    gauche = gauche[gauche + 1 < len(x)]
+    gauche = gauche[~nouveau_groupe[gauche + 1]]
+    seg_entite, seg_ligne = entite[gauche], ligne[gauche]
+    seg_debut = np.clip(rang_pixel(x[gauche], x_origine), 0, nb_colonnes)
+    seg_fin = np.clip(rang_pixel(x[gauche + 1], x_origine), 0, nb_colonnes)
+    pleins = seg_fin > seg_debut
+    seg_entite, seg_ligne, seg_debut, seg_fin = seg_entite[pleins], seg_ligne[pleins], seg_debut[pleins], seg_fin[pleins]
+
+    # Cellules recouvrant chaque segment (emprise des centres de ses pixels), puis pixels communs
+    y_segment = y_origine + (seg_ligne + 0.5) * r
+    segments, cellules = _apparier_emprises(x_origine + (seg_debut + 0.5) * r, y_segment,
+                                            x_origine + (seg_fin - 0.5) * r, y_segment, grille)
+    comptes = np.where((seg_ligne[segments] >= lig0[cellules]) & (seg_ligne[segments] < lig1[cellules]),
+                       np.minimum(seg_fin[segments], col1[cellules]) - np.maximum(seg_debut[segments], col0[cellules]),
+                       0)
+    garder = comptes > 0
+    return sparse.csr_matrix((comptes[garder].astype(np.float64) * r * r, (seg_entite[segments[garder]], cellules[garder])),
+                             shape=(len(entites), nb_cellules))
+
+
+def construire_matrice_poids(geometries_entites, cellules, moteur="SHAPELY", paires=None,
+                             taille_bloc=50_000, resolution_raster=200.0):
+    """Matrice creuse (CSR) entités x cellules contenant les aires d'intersection (m²).
+
+    `cellules` est une GrilleSafran ou un tableau de polygones. moteur="SHAPELY" utilise GEOS ;
+    moteur="RECTANGLES" utilise le noyau NumPy `aires_paires_rectangles`, valable uniquement pour des
+    cellules rectangulaires alignées sur les axes (grille SAFRAN). Avec une GrilleSafran et ce moteur,
+    aucune géométrie de cellule n'est construite. `paires` (entités, cellules) peut être fourni s'il a
+    déjà été calculé. moteur="RASTER" donne des aires approchées par rastérisation à `resolution_raster`
+    mètres (voir `matrice_poids_raster`) et demande une GrilleSafran.
+    """
+    entites = np.asarray(geometries_entites)
+    if moteur not in ("SHAPELY", "RECTANGLES", "RASTER"):
+        raise ValueError(f"Moteur d'intersection inconnu: {moteur}")
+    grille = cellules if isinstance(cellules, GrilleSafran) else None
+    if moteur == "RASTER":
+        if grille is None:
+            raise ValueError("Le moteur RASTER demande une GrilleSafran")
+        return matrice_poids_raster(entites, grille, resolution_raster)
+    if grille is None or moteur == "SHAPELY":
+        cellules = geometries_grille(grille) if grille is not None else np.asarray(cellules)
+    if paires is None:
+        if grille is not None and moteur == "RECTANGLES":
+            paires = apparier_entites_grille(entites, grille)
+        else:
+            paires = apparier_entites_cellules(entites, cellules, None if moteur == "RECTANGLES" else "intersects")
+    lignes, colonnes = paires
+    print(f"{len(lignes)} paires (entité, cellule) candidates")
+
+    if moteur == "RECTANGLES":
+        if grille is not None:
+            xmin, ymin, xmax, ymax = bornes_grille(grille, colonnes)
+        else:
+            b = shapely.bounds(cellules[colonnes])
+            xmin, ymin, xmax, ymax = b[:, 0], b[:, 1], b[:, 2], b[:, 3]
+        aires = aires_paires_rectangles(entites, lignes, xmin, ymin, xmax, ymax)
+    else:
+        aires = np.empty(len(lignes))
+        for debut in range(0, len(lignes), taille_bloc):
+            fin = debut + taille_bloc
+            aires[debut:fin] = shapely.area(shapely.intersection(entites[lignes[debut:fin]],
+                                                                 cellules[colonnes[debut:fin]]))
+            print(f"Intersections calculées: {min(fin, len(lignes))}/{len(lignes)}")
+
+    # Les contacts par un bord donnent des aires nulles ou résiduelles de l'ordre de l'arrondi
+    garder = aires > 1e-3
+    return sparse.csr_matrix((aires[garder], (lignes[garder], colonnes[garder])),
+                             shape=(len(entites), len(grille.x) if grille is not None else len(cellules)))
+
+
+def blocs_spatiaux(geometries_entites, nb_blocs):
+    """Découpe les entités en `nb_blocs` groupes d'indices voisins dans l'espace (ordre de Hilbert
+    des emprises), pour que chaque bloc ne touche qu'une partie de la grille SAFRAN."""
+    entites = np.asarray(geometries_entites)
+    ordre = np.argsort(gpd.GeoSeries(entites).hilbert_distance().to_numpy(), kind="stable")
+    return [bloc for bloc in np.array_split(ordre, max(1, min(nb_blocs, len(entites)))) if len(bloc)]
+
+
+def construire_matrice_poids_parallele(geometries_entites, cellules, moteur="SHAPELY", nb_threads=0,
+                                       blocs_par_thread=4, **options):
+    """Même matrice que `construire_matrice_poids`, calculée par blocs spatiaux d'entités répartis
+    sur `nb_threads` threads (0 = tous les cœurs).
+
+    Les opérations vectorisées de shapely 2 et de NumPy libèrent le GIL ; chaque entité est traitée
+    dans un seul bloc et les lignes sont remises dans l'ordre des entités à la fin. Appelé depuis un
+    processus de traiter_lot, le calcul reste sur un thread.
+    """
+    entites = np.asarray(geometries_entites)
+    nb_threads = nb_threads or os.cpu_count() or 1
+    if multiprocessing.parent_process() is not None:
+        # Déjà dans un processus du lot (traiter_lot) : les cœurs sont occupés par les autres fichiers
+        nb_threads = 1
+    if nb_threads == 1 or len(entites) < 2 * nb_threads:
+        return construire_matrice_poids(entites, cellules, moteur, **options)
+    if moteur == "SHAPELY" and isinstance(cellules, GrilleSafran):
+        # Polygones des cellules construits une fois pour tous les blocs
+        cellules = geometries_grille(cellules)
+
+    blocs = blocs_spatiaux(entites, nb_threads * blocs_par_thread)
+    with ThreadPoolExecutor(max_workers=nb_threads) as pool:
+        matrices = list(pool.map(lambda bloc: construire_matrice_poids(entites[bloc], cellules, moteur, **options),
+                                 blocs))
+    rangs = np.empty(len(entites), dtype=np.int64)
+    rangs[np.concatenate(blocs)] = np.arange(len(entites))
+    return sparse.vstack(matrices, format="csr")[rangs]
+
+
+def mesurer_parallelisme(geometries_entites, cellules, moteur="SHAPELY", nb_threads=0, **options):
+    """Rapport de passage à l'échelle : durée du calcul des poids avec 1, 2, 4... `nb_threads` threads,
+    accélération par rapport à 1 thread et écart maximal avec la matrice calculée séquentiellement.
+    Sans objet dans un processus de traiter_lot (calcul limité à un thread) : retourne None."""
+    if multiprocessing.parent_process() is not None:
+        print("Passage à l'échelle du calcul des poids non mesuré dans un processus du lot")
+        return None
+    nb_threads = nb_threads or os.cpu_count() or 1
+    paliers = sorted({min(2 ** k, nb_threads) for k in range(int(np.log2(nb_threads)) + 2)})
+    reference, duree_reference = None, None
+    print(f"Passage à l'échelle du calcul des poids (moteur {moteur}, {len(geometries_entites)} entités):")
+    for nb in paliers:
+        debut = time.perf_counter()
+        matrice = construire_matrice_poids_parallele(geometries_entites, cellules, moteur, nb, **options)
+        duree = max(time.perf_counter() - debut, 1e-6)
+        if reference is None:
+            reference, duree_reference = matrice, duree
+        difference = abs(matrice - reference)
+        ecart = difference.max() if difference.nnz else 0.0
+        print(f"  {nb:>3} thread(s): {duree:.2f}s, accélération x{duree_reference / duree:.2f}, "
+              f"efficacité {duree_reference / duree / nb:.0%}, écart max {ecart:.2e} m²")
+    return reference
+
+
+def groupes_par_point_interieur(geometries_entites, geometries_groupes):
+    """Indice du groupe (département...) contenant un point intérieur de chaque entité, -1 si aucun."""
+    points = shapely.point_on_surface(np.asarray(geometries_entites))
+    entites, groupes = shapely.STRtree(np.asarray(geometries_groupes)).query(points, predicate="within")
+    groupe = np.full(len(points), -1, dtype=np.int64)
+    groupe[entites[::-1]] = groupes[::-1]  # en cas de recouvrement, le premier groupe trouvé
+    return groupe
+
+
+def matrice_groupes(groupe_par_element, nb_groupes):
+    """Matrice creuse d'appartenance groupes x éléments (1 si l'élément appartient au groupe)."""
+    groupe_par_element = np.asarray(groupe_par_element)
+    membres = np.flatnonzero(groupe_par_element >= 0)
+    return sparse.csr_matrix((np.ones(len(membres)), (groupe_par_element[membres], membres)),
+                             shape=(nb_groupes, len(groupe_par_element)))
+
+
+def agreger_poids(matrice_appartenance, matrice_poids, aires_entites=None):
+    """Poids groupes x cellules obtenus en sommant les poids des entités de chaque groupe (M @ W).
+
+    Les aires d'intersection étant additives, les numérateurs et dénominateurs d'un département sont
+    la somme de ceux de ses entités : aucune nouvelle intersection n'est calculée. Pour des poids
+    d'interpolation (somme 1 par entité), `aires_entites` pondère chaque entité par sa surface.
+    """
+    if aires_entites is not None:
+        sommes = np.asarray(matrice_poids.sum(axis=1)).ravel()
+        facteurs = np.divide(aires_entites, sommes, out=np.zeros_like(sommes), where=sommes > 0)
+        matrice_poids = sparse.diags(facteurs) @ matrice_poids
+    return sparse.csr_matrix(matrice_appartenance @ matrice_poids)
+
+
+def comparer_appariement(geometries_entites, grille, taille_echantillon=200, graine=0):
+    """Compare le balayage complet de la grille par entité, la requête STRtree groupée et
+    l'appariement par arithmétique sur la grille (durées, la première extrapolée)."""
+    entites = np.asarray(geometries_entites)
+    cellules = geometries_grille(grille)
+    rng = np.random.default_rng(graine)
+    echantillon = np.sort(rng.choice(len(entites), size=min(taille_echantillon, len(entites)), replace=False))
+
+    debut = time.perf_counter()
+    nb_paires_boucle = sum(int(shapely.intersects(geom, cellules).sum()) for geom in entites[echantillon])
+    duree_boucle = (time.perf_counter() - debut) * len(entites) / max(len(echantillon), 1)
+    debut = time.perf_counter()
+    paires = apparier_entites_cellules(entites, cellules)
+    duree_arbre = time.perf_counter() - debut
+    debut = time.perf_counter()
+    paires_grille = apparier_entites_grille(entites, grille)
+    duree_grille = time.perf_counter() - debut
+
+    nb_paires_arbre = int(np.isin(paires[0], echantillon).sum())
+    emprises = apparier_entites_cellules(entites, cellules, None)
+    identiques = np.array_equal(np.stack(emprises), np.stack(paires_grille))
+    print(f"Appariement entités/cellules: balayage par entité ~{duree_boucle:.2f}s (extrapolé), "
+          f"STRtree groupé {duree_arbre:.2f}s, grille implicite {duree_grille:.2f}s ; "
+          f"paires sur l'échantillon: {nb_paires_boucle} / {nb_paires_arbre} ; "
+          f"emprises grille = STRtree: {identiques}")
+    return duree_boucle, duree_arbre, duree_grille
+
+
+def comparer_moteurs(geometries_entites, cellules, taille_echantillon=50, graine=0):
+    """Compare les moteurs RECTANGLES et SHAPELY sur un échantillon d'entités (écarts d'aires et durées)."""
+    entites = np.asarray(geometries_entites)
+    rng = np.random.default_rng(graine)
+    echantillon = np.sort(rng.choice(len(entites), size=min(taille_echantillon, len(entites)), replace=False))
+
+    debut = time.perf_counter()
+    reference = construire_matrice_poids(entites[echantillon], cellules, moteur="SHAPELY")
+    duree_shapely = time.perf_counter() - debut
+    debut = time.perf_counter()
+    rectangles = construire_matrice_poids(entites[echantillon], cellules, moteur="RECTANGLES")
+    duree_rectangles = time.perf_counter() - debut
+
+    ecart = abs(reference - rectangles)
+    ecart_max = ecart.max() if ecart.nnz else 0.0
+    ecart_relatif = ecart_max / reference.max() if reference.nnz else 0.0
+    print(f"Comparaison des moteurs sur {len(echantillon)} entités: écart max {ecart_max:.6f} m² "
+          f"(relatif {ecart_relatif:.2e}), SHAPELY {duree_shapely:.2f}s, RECTANGLES {duree_rectangles:.2f}s")
+    return ecart_max, duree_shapely, duree_rectangles
+
+
+def comparer_raster(geometries_entites, grille, resolution=200.0, tolerance=0.05, taille_echantillon=200, graine=0):
+    """Erreur maximale des poids (part de l'entité dans chaque cellule) du moteur RASTER par rapport au
+    calcul exact (RECTANGLES) sur un échantillon d'entités ; avertit si elle dépasse `tolerance`."""
+    entites = np.asarray(geometries_entites)
+    rng = np.random.default_rng(graine)
+    echantillon = np.sort(rng.choice(len(entites), size=min(taille_echantillon, len(entites)), replace=False))
+
+    debut = time.perf_counter()
+    exacte = construire_matrice_poids(entites[echantillon], grille, moteur="RECTANGLES")
+    duree_exacte = time.perf_counter() - debut
+    debut = time.perf_counter()
+    approchee = matrice_poids_raster(entites[echantillon], grille, resolution)
+    duree_raster = time.perf_counter() - debut
+
+    def normaliser(matrice):
+        sommes = np.asarray(matrice.sum(axis=1)).ravel()
+        return sparse.diags(np.divide(1.0, sommes, out=np.zeros_like(sommes), where=sommes > 0)) @ matrice
+
+    ecart = abs(normaliser(exacte) - normaliser(approchee))
+    erreur_max = ecart.max() if ecart.nnz else 0.0
+    print(f"Validation du moteur RASTER ({resolution:g} m) sur {len(echantillon)} entités: erreur max des poids "
+          f"{erreur_max:.4f} (tolérance {tolerance}), exact {duree_exacte:.2f}s, raster {duree_raster:.2f}s")
+    if erreur_max > tolerance:
+        print("ATTENTION: erreur des poids au-delà de la tolérance, réduire RESOLUTION_RASTER "
+              "ou utiliser le moteur RECTANGLES")
+    return erreur_max
+
+
+def moyennes_ponderees(matrice_poids, valeurs):
+    """Moyennes pondérées par l'aire de chaque colonne de `valeurs` (cellules x variables) pour chaque entité.
+
+    Les cellules sans valeur (NaN) sont exclues du numérateur et du dénominateur ;
+    une entité sans aucune cellule valide reçoit NaN.
+    """
+    valeurs = np.asarray(valeurs, dtype=np.float64)
+    if valeurs.ndim == 1:
+        valeurs = valeurs[:, None]
+    valides = ~np.isnan(valeurs)
+    numerateur = matrice_poids @ np.where(valides, valeurs, 0.0)
+    denominateur = matrice_poids @ valides.astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        moyennes = numerateur / denominateur
+    moyennes[denominateur <= 0] = np.nan
+    return moyennes
+
+
+def empreinte_fichier(chemin):
+    """Empreinte du contenu d'une couche de référence (fichier principal et .prj associé)."""
+    h = hashlib.blake2b(digest_size=16)
+    chemins = [chemin]
+    if chemin.lower().endswith('.shp'):
+        chemins.append(os.path.splitext(chemin)[0] + '.prj')
+    for c in chemins:
+        if not os.path.exists(c):
+            continue
+        with open(c, 'rb') as f:
+            for bloc in iter(lambda: f.read(1 << 20), b''):
+                h.update(bloc)
+    return h.hexdigest()
+
+
+def cle_cache_poids(ids_cellules, longitudes, latitudes, taille_buffer, chemin_reference, moteur="SHAPELY"):
+    """Clé du cache des poids : coordonnées des points SAFRAN, taille du buffer et couche de référence."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"v{VERSION_POIDS};buffer={taille_buffer};moteur={moteur};".encode())
+    h.update(np.asarray(ids_cellules).astype(str).astype('U').tobytes())
+    h.update(np.ascontiguousarray(longitudes, dtype=np.float64).tobytes())
+    h.update(np.ascontiguousarray(latitudes, dtype=np.float64).tobytes())
+    h.update(empreinte_fichier(chemin_reference).encode())
+    return h.hexdigest()
+
+
+# Matrices déjà rechargées par ce processus (un lot de fichiers partage souvent la même grille)
+_poids_en_memoire = {}
+
+
+def charger_poids_cache(dossier_cache, cle):
+    """Recharge une matrice des poids depuis le cache disque, ou None si absente."""
+    if cle in _poids_en_memoire:
+        return _poids_en_memoire[cle]
+    chemin = os.path.join(dossier_cache, f"poids_{cle}.npz")
+    if not os.path.exists(chemin):
+        return None
+    try:
+        with np.load(chemin, allow_pickle=False) as archive:
+            matrice = sparse.csr_matrix(
+                (archive['aires'], archive['indices'], archive['indptr']), shape=tuple(archive['forme']))
+            _poids_en_memoire[cle] = (matrice, archive['ids_cellules'], archive['ids_entites'])
+            return _poids_en_memoire[cle]
+    except Exception as e:
+        print(f"Cache des poids illisible ({chemin}): {e}")
+        return None
+
+
+def sauvegarder_poids_cache(dossier_cache, cle, matrice, ids_cellules, ids_entites):
+    """Enregistre la matrice des poids et les identifiants entités/cellules (npz compressé)."""
+    os.makedirs(dossier_cache, exist_ok=True)
+    chemin = os.path.join(dossier_cache, f"poids_{cle}.npz")
+    ids_cellules = np.asarray(ids_cellules)
+    if ids_cellules.dtype == object:
+        ids_cellules = ids_cellules.astype(str)
+    # Écriture dans un fichier temporaire puis renommage pour ne jamais laisser un cache partiel
+    chemin_tmp = f"{chemin}.{os.getpid()}.tmp.npz"
+    np.savez_compressed(chemin_tmp, aires=matrice.data, indices=matrice.indices, indptr=matrice.indptr,
+                        forme=np.asarray(matrice.shape), ids_cellules=ids_cellules,
+                        ids_entites=np.asarray(ids_entites))
+    os.replace(chemin_tmp, chemin)
+    _poids_en_memoire[cle] = (matrice, ids_cellules, np.asarray(ids_entites))
+    return chemin
+
+
+# Registre de la grille SAFRAN déjà chargé par ce processus, par dossier
+_registres_en_memoire = {}
+
+
+def charger_registre_grille(dossier_cache, relire=False):
+    """Registre de la grille SAFRAN (identifiant Point -> coordonnées WGS 84 et Lambert 93, numéro de
+    cellule entier stable), trié par identifiant ; registre vide s'il n'existe pas encore. `relire`
+    ignore la copie en mémoire (registre complété entre-temps par un autre processus)."""
+    if dossier_cache in _registres_en_memoire and not relire:
+        return _registres_en_memoire[dossier_cache]
+    chemin = os.path.join(dossier_cache, "registre_grille_safran.npz")
+    registre = {'points': np.empty(0, dtype='U1'), 'longitude': np.empty(0), 'latitude': np.empty(0),
+                'x': np.empty(0), 'y': np.empty(0), 'id_cellule': np.empty(0, dtype=np.int64)}
+    if os.path.exists(chemin):
+        try:
+            with np.load(chemin, allow_pickle=False) as archive:
+                registre = {cle: archive[cle] for cle in registre}
+        except Exception as e:
+            print(f"Registre de la grille illisible ({chemin}): {e}")
+    _registres_en_memoire[dossier_cache] = registre
+    return registre
+
+
+@contextmanager
+def verrou_registre_grille(dossier_cache):
+    """Verrou exclusif entre processus sur le registre de la grille, libéré à la fin du bloc (ou à
+    l'arrêt du processus)."""
+    os.makedirs(dossier_cache, exist_ok=True)
+    with open(os.path.join(dossier_cache, "registre_grille_safran.lock"), "a") as verrou:
+        if fcntl is not None:
+            fcntl.flock(verrou.fileno(), fcntl.LOCK_EX)
+        yield
+
+
+def _points_connus(registre, ids, longitudes, latitudes):
+    """Points déjà dans le registre avec les mêmes coordonnées."""
+    if not len(registre['points']):
+        return np.zeros(len(ids), dtype=bool)
+    positions = np.minimum(np.searchsorted(registre['points'], ids), len(registre['points']) - 1)
+    return ((registre['points'][positions] == ids)
+            & (registre['longitude'][positions] == longitudes)
+            & (registre['latitude'][positions] == latitudes))
+
+
+def sauvegarder_registre_grille(dossier_cache, registre):
+    """Enregistre le registre de la grille (écriture atomique)."""
+    os.makedirs(dossier_cache, exist_ok=True)
+    chemin = os.path.join(dossier_cache, "registre_grille_safran.npz")
+    chemin_tmp = f"{chemin}.{os.getpid()}.tmp.npz"
+    np.savez(chemin_tmp, **registre)
+    os.replace(chemin_tmp, chemin)
+    _registres_en_memoire[dossier_cache] = registre
+    return chemin
+
+
+def grille_depuis_registre(ids_cellules, longitudes, latitudes, dossier_cache, demi_cote=DEMI_COTE_SAFRAN):
+    """Grille implicite des cellules `ids_cellules`, lue dans le registre par jointure sur l'identifiant.
+
+    Seuls les points absents du registre (ou dont les coordonnées ont changé) sont reprojetés ; ils
+    y sont ajoutés avec un nouveau numéro de cellule. L'ajout se fait sous verrou, sur le registre relu
+    depuis le disque : les processus d'un lot qui ajoutent des points différents ne perdent pas les
+    ajouts des autres et ne donnent jamais le même numéro à deux points. Retourne (GrilleSafran,
+    numéros de cellule).
+    """
+    ids = np.asarray(ids_cellules).astype(str)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    registre = charger_registre_grille(dossier_cache)
+    if not _points_connus(registre, ids, longitudes, latitudes).all():
+        try:
+            with verrou_registre_grille(dossier_cache):
+                registre = _completer_registre(dossier_cache, ids, longitudes, latitudes, demi_cote)
+        except OSError as e:
+            print(f"Impossible de verrouiller le registre de la grille: {e}")
+            registre = _completer_registre(dossier_cache, ids, longitudes, latitudes, demi_cote, ecrire=False)
+
+    positions = np.searchsorted(registre['points'], ids)
+    return (GrilleSafran(registre['x'][positions], registre['y'][positions], float(demi_cote)),
+            registre['id_cellule'][positions])
+
+
+def _completer_registre(dossier_cache, ids, longitudes, latitudes, demi_cote, ecrire=True):
+    """Ajoute au registre relu depuis le disque les points inconnus, puis l'enregistre si `ecrire`."""
+    registre = charger_registre_grille(dossier_cache, relire=True)
+    connus = _points_connus(registre, ids, longitudes, latitudes)
+    if not connus.all():
+        nouveaux = ~connus
+        print(f"Registre de la grille SAFRAN: {int(nouveaux.sum())} point(s) ajouté(s) ou mis à jour")
+        projetee = grille_safran(longitudes[nouveaux], latitudes[nouveaux], demi_cote)
+        # Les points déjà connus sous le même identifiant gardent leur numéro de cellule
+        anciens = np.isin(registre['points'], ids[nouveaux])
+        numeros_anciens = dict(zip(registre['points'][anciens], registre['id_cellule'][anciens]))
+        prochain = int(registre['id_cellule'].max()) + 1 if len(registre['id_cellule']) else 0
+        numeros = []
+        for point in ids[nouveaux]:
+            if point not in numeros_anciens:
+                numeros_anciens[point] = prochain
+                prochain += 1
+            numeros.append(numeros_anciens[point])
+        fusion = {cle: np.concatenate([valeurs[~anciens], nouvelles])
+                  for (cle, valeurs), nouvelles in zip(registre.items(),
+                                                       [ids[nouveaux], longitudes[nouveaux], latitudes[nouveaux],
+                                                        projetee.x, projetee.y, np.asarray(numeros, dtype=np.int64)])}
+        tri = np.argsort(fusion['points'], kind='stable')
+        registre = {cle: valeurs[tri] for cle, valeurs in fusion.items()}
+        _registres_en_memoire[dossier_cache] = registre
+        if ecrire:
+            try:
+                sauvegarder_registre_grille(dossier_cache, registre)
+            except OSError as e:
+                print(f"Impossible d'écrire le registre de la grille: {e}")
+    return registre
@@ -0,0 +1,98 @@
+# Niveaux de détail des géométries (DRIAS_V4.py / DRIAS_V4_ETE_HIVER.py) : simplifications de couverture
+# qui conservent les frontières communes, taille mesurée en sommets, cache écrit à côté de la couche source
+import os
+
+import geopandas as gpd
+import numpy as np
+import pyogrio
+import shapely
+
+from drias_lots import ecrire_atomique
+from drias_sorties import COLONNE_ID, empreinte_couche
+
+# Tolérances (m) des niveaux de détail : 10 m pour le zoom local, 500 m pour la France entière
+NIVEAUX_DETAIL = (10, 100, 200, 500)
+
+
+def nb_sommets(geometries):
+    """Nombre total de sommets (mesure de la taille des géométries, sans conversion en texte)."""
+    return int(shapely.get_num_coordinates(np.asarray(geometries)).sum())
+
+
+def simplifier_couverture(geometries, tolerance):
+    """Simplifie des polygones jointifs sans ouvrir de trous ni de chevauchements entre voisins.
+
+    Si les géométries forment une couverture valide, chaque frontière commune est simplifiée une seule
+    fois (shapely.coverage_simplify, GEOS >= 3.12 : la tolérance est alors la racine carrée de l'aire
+    des triangles retirés) ; sinon chaque géométrie est simplifiée séparément (Douglas-Peucker,
+    topologie de chaque polygone préservée).
+    """
+    geometries = np.asarray(geometries)
+    if hasattr(shapely, "coverage_simplify") and shapely.coverage_is_valid(geometries):
+        simplifiees = shapely.coverage_simplify(geometries, tolerance)
+        if shapely.is_valid(simplifiees).all():
+            return simplifiees
+    return shapely.simplify(geometries, tolerance, preserve_topology=True)
+
+
+def chemin_niveaux(chemin_source, nom=None):
+    """Cache des niveaux de détail d'une couche, à côté de celle-ci ({couche}_LOD[_{nom}].gpkg)."""
+    return f"{os.path.splitext(chemin_source)[0]}_LOD{'_' + nom if nom else ''}.gpkg"
+
+
+def _niveaux_en_cache(chemin, tolerances, empreinte):
+    if not os.path.exists(chemin):
+        return None
+    try:
+        couches = {nom for nom, _ in pyogrio.list_layers(chemin)}
+        if not all(f"lod_{t}" in couches
+                   and (pyogrio.read_info(chemin, layer=f"lod_{t}").get("layer_metadata") or {}).get("empreinte") == empreinte
+                   for t in tolerances):
+            return None
+        niveaux = {}
+        for t in tolerances:
+            couche = gpd.read_file(chemin, layer=f"lod_{t}")
+            niveaux[t] = couche.set_index(COLONNE_ID).sort_index().geometry
+        return niveaux
+    except Exception:
+        return None
+
+
+def niveaux_detail(chemin_source, geometries, tolerances=NIVEAUX_DETAIL, nom=None):
+    """Variantes simplifiées de `geometries` (GeoSeries dans l'ordre de la couche `chemin_source`, ou
+    géométries qui en dérivent, distinguées par `nom`), une par tolérance : {tolérance: GeoSeries}
+    avec le même index que `geometries`.
+
+    Les niveaux sont relus du cache s'il a été écrit pour la même couche (empreinte des fichiers) et le
+    même système de coordonnées ; sinon ils sont calculés et le cache est réécrit.
+    """
+    empreinte = empreinte_couche(chemin_source, nom, str(geometries.crs), "couverture")
+    chemin = chemin_niveaux(chemin_source, nom)
+    niveaux = _niveaux_en_cache(chemin, tolerances, empreinte)
+    if niveaux is not None and all(len(n) == len(geometries) for n in niveaux.values()):
+        return {t: gpd.GeoSeries(n.values, index=geometries.index, crs=geometries.crs) for t, n in niveaux.items()}
+
+    sommets = nb_sommets(geometries.values)
+    niveaux = {}
+    for t in tolerances:
+        niveaux[t] = gpd.GeoSeries(simplifier_couverture(geometries.values, t), index=geometries.index, crs=geometries.crs)
+        reduction = (1 - nb_sommets(niveaux[t].values) / sommets) * 100 if sommets else 0
+        print(f"Niveau de détail {t} m: {nb_sommets(niveaux[t].values)} sommets ({reduction:.1f}% de moins que {sommets})")
+
+    def ecrire(chemin_tmp):
+        for k, (t, serie) in enumerate(niveaux.items()):
+            couche = gpd.GeoDataFrame({COLONNE_ID: np.arange(len(serie))}, geometry=serie.values, crs=serie.crs)
+            couche.to_file(chemin_tmp, layer=f"lod_{t}", driver="GPKG", mode="w" if k == 0 else "a",
+                           layer_metadata={"empreinte": empreinte, "tolerance": str(t)})
+    try:
+        ecrire_atomique(chemin, ecrire)
+        print(f"Niveaux de détail mis en cache: {chemin}")
+    except OSError as e:  # dossier de la couche en lecture seule : niveaux recalculés à chaque exécution
+        print(f"Cache des niveaux de détail non écrit ({e})")
+    return niveaux
+
+
+def niveau_pour_resolution(tolerances, taille_pixel):
+    """Niveau le moins détaillé dont la tolérance reste sous la taille d'un pixel (m) de la carte."""
+    candidates = [t for t in tolerances if t <= taille_pixel]
+    return max(candidates) if candidates else min(tolerances)
@@ -0,0 +1,158 @@
+# Sorties sans géométrie de DRIAS_V4.py / DRIAS_V4_ETE_HIVER.py (FORMAT_SORTIE = "PARQUET") : les valeurs
+# de chaque fichier sont écrites dans une table Parquet légère et les géométries une seule fois par couche
+# de référence (GEOMETRIES_{nom}.gpkg), les deux étant reliées par l'identifiant d'entité
+import hashlib
+import json
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyogrio
+
+from drias_lots import chemin_temporaire, ecrire_atomique
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow absent : seules les sorties GeoPackage sont possibles
+    pa = pq = None
+
+# Colonne reliant les tables de valeurs à la couche de géométries (rang de l'entité dans la référence)
+COLONNE_ID = "id_entite"
+CLE_METADONNEES = b"drias_geometries"
+
+
+def fichiers_couche(chemin):
+    """Fichiers d'une couche : le fichier lui-même et, pour un shapefile, ses fichiers associés."""
+    racine, extension = os.path.splitext(chemin)
+    chemins = [chemin]
+    if extension.lower() == ".shp":
+        chemins += [racine + ext for ext in (".shx", ".dbf", ".prj", ".cpg")]
+    return chemins
+
+
+def empreinte_couche(chemin, *precisions):
+    """Empreinte d'une couche vectorielle (avec les fichiers associés d'un shapefile) et des options
+    qui modifient les géométries écrites (tolérance de simplification...)."""
+    h = hashlib.blake2b(digest_size=16)
+    for c in fichiers_couche(chemin):
+        if os.path.exists(c):
+            with open(c, "rb") as f:
+                for bloc in iter(lambda: f.read(1 << 20), b""):
+                    h.update(bloc)
+    h.update(repr(precisions).encode("utf-8"))
+    return h.hexdigest()
+
+
+def chemin_geometries(dossier, nom):
+    """Couche de géométries partagée par tous les résultats d'une même référence dans `dossier`."""
+    return os.path.join(dossier, f"GEOMETRIES_{nom}.gpkg")
+
+
+def geometries_a_jour(chemin, empreinte):
+    """Vrai si la couche de géométries existe et a été écrite pour cette empreinte de référence."""
+    if not os.path.exists(chemin):
+        return False
+    try:
+        return (pyogrio.read_info(chemin).get("layer_metadata") or {}).get("empreinte") == empreinte
+    except Exception:
+        return False
+
+
+def _table_valeurs(valeurs, nom_couche):
+    table = pa.Table.from_pandas(pd.DataFrame(valeurs), preserve_index=False)
+    meta = dict(table.schema.metadata or {})
+    meta[CLE_METADONNEES] = json.dumps({"couche": nom_couche, "cle": COLONNE_ID}).encode("utf-8")
+    return table.replace_schema_metadata(meta)
+
+
+def ecrire_table_valeurs(chemin, valeurs, nom_couche):
+    """Écrit une table de valeurs Parquet reliée à la couche de géométries `nom_couche` (chemin relatif
+    au dossier de la table)."""
+    table = _table_valeurs(valeurs, nom_couche)
+    return ecrire_atomique(chemin, lambda c: pq.write_table(table, c))
+
+
+def ecrire_sans_geometrie(chemin, gdf, dossier, nom_geometries, empreinte, colonnes_valeurs, ids=None):
+    """Écrit `gdf` en deux parties reliées par COLONNE_ID (`ids`, par défaut l'index) :
+
+    - ses colonnes descriptives et sa géométrie dans GEOMETRIES_{nom_geometries}.gpkg, réécrite
+      seulement si `empreinte` a changé ;
+    - toutes ses colonnes sauf la géométrie dans la table Parquet `chemin`.
+    """
+    ids = np.asarray(gdf.index if ids is None else ids)
+    chemin_geom = chemin_geometries(dossier, nom_geometries)
+    if not geometries_a_jour(chemin_geom, empreinte):
+        geometries = gdf[[col for col in gdf.columns if col not in colonnes_valeurs]].reset_index(drop=True)
+        geometries.insert(0, COLONNE_ID, ids)
+        ecrire_atomique(chemin_geom, lambda c: geometries.to_file(c, driver="GPKG", layer_metadata={"empreinte": empreinte}))
+        print(f"Couche de géométries écrite: {chemin_geom}")
+    valeurs = pd.DataFrame(gdf.drop(columns="geometry")).reset_index(drop=True)
+    valeurs.insert(0, COLONNE_ID, ids)
+    return ecrire_table_valeurs(chemin, valeurs, os.path.basename(chemin_geom))
+
+
+class SortieSansGeometrie:
+    """Équivalent de `ecrire_sans_geometrie` alimenté tuile par tuile (MODE_TUILES) : les valeurs sont
+    ajoutées à un fichier Parquet temporaire et les géométries à une couche temporaire si elle doit être
+    réécrite ; `terminer` renomme les deux fichiers, `abandonner` les supprime."""
+
+    def __init__(self, chemin, dossier, nom_geometries, empreinte, colonnes_valeurs):
+        self.chemin, self.colonnes_valeurs, self.empreinte = chemin, set(colonnes_valeurs), empreinte
+        self.chemin_geom = chemin_geometries(dossier, nom_geometries)
+        self.ecrire_geom = not geometries_a_jour(self.chemin_geom, empreinte)
+        self.tmp, self.tmp_geom = chemin_temporaire(chemin), chemin_temporaire(self.chemin_geom)
+        self.ecrivain, self.schema = None, None
+
+    def ajouter(self, gdf, ids):
+        ids = np.asarray(ids)
+        if self.ecrire_geom:
+            geometries = gdf[[col for col in gdf.columns if col not in self.colonnes_valeurs]].reset_index(drop=True)
+            geometries.insert(0, COLONNE_ID, ids)
+            geometries.to_file(self.tmp_geom, driver="GPKG", mode="a" if self.ecrivain else "w",
+                               layer_metadata={"empreinte": self.empreinte})
+        valeurs = pd.DataFrame(gdf.drop(columns="geometry")).reset_index(drop=True)
+        valeurs.insert(0, COLONNE_ID, ids)
+        if self.ecrivain is None:
+            table = _table_valeurs(valeurs, os.path.basename(self.chemin_geom))
+            self.schema = table.schema
+            self.ecrivain = pq.ParquetWriter(self.tmp, self.schema)
+        else:
+            table = pa.Table.from_pandas(valeurs, schema=self.schema, preserve_index=False)
+        self.ecrivain.write_table(table)
+
+    def terminer(self):
+        if self.ecrivain is None:
+            return None
+        self.ecrivain.close()
+        self.ecrivain = None
+        if self.ecrire_geom:
+            os.replace(self.tmp_geom, self.chemin_geom)
+            print(f"Couche de géométries écrite: {self.chemin_geom}")
+        os.replace(self.tmp, self.chemin)
+        return self.chemin
+
+    def abandonner(self):
+        if self.ecrivain is not None:
+            self.ecrivain.close()
+            self.ecrivain = None
+        for chemin in (self.tmp, self.tmp_geom):
+            if os.path.exists(chemin):
+                os.remove(chemin)
+
+
+def geometries_associees(chemin):
+    """Couche de géométries d'une table de valeurs Parquet et colonne qui les relie."""
+    meta = json.loads(pq.read_schema(chemin).metadata[CLE_METADONNEES])
+    return os.path.join(os.path.dirname(chemin), meta["couche"]), meta["cle"]
+
+
+def lire_resultats(chemin, avec_geometrie=False):
+    """Relit une table de valeurs Parquet, avec sa géométrie (GeoDataFrame) si `avec_geometrie`."""
+    valeurs = pd.read_parquet(chemin)
+    if not avec_geometrie:
+        return valeurs
+    chemin_geom, cle = geometries_associees(chemin)
+    geometries = gpd.read_file(chemin_geom, columns=[cle])
+    return geometries.merge(valeurs, on=cle, how="right")
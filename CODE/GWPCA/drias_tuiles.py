@@ -0,0 +1,145 @@
+# Exécution par tuiles à mémoire bornée de DRIAS_V4.py / DRIAS_V4_ETE_HIVER.py pour les couches de
+# référence nationales : découpage de l'emprise, estimation de la mémoire et cellules de chaque tuile
+import math
+import os
+import sys
+from typing import NamedTuple
+
+import geopandas as gpd
+import numpy as np
+import pyogrio
+import shapely
+from pyproj import CRS, Transformer
+
+try:
+    import resource
+except ImportError:  # Windows : pas de mesure du pic mémoire
+    resource = None
+
+
+class Tuile(NamedTuple):
+    """Emprise (Lambert 93) d'une tuile, éventuellement restreinte aux entités d'un département."""
+    xmin: float
+    ymin: float
+    xmax: float
+    ymax: float
+    departement: int = -1
+
+
+class ProfilMemoire(NamedTuple):
+    """Mémoire estimée d'une tuile : octets par m² pour les entités et pour les cellules SAFRAN,
+    et marge (m) de cellules chargées autour de l'emprise."""
+    entites: float
+    cellules: float
+    marge: float
+
+
+def taille_couche(chemin):
+    """Taille sur disque d'une couche vectorielle (fichiers .shp et .dbf pour un shapefile)."""
+    racine, extension = os.path.splitext(chemin)
+    fichiers = [chemin] + ([racine + ".dbf"] if extension.lower() == ".shp" else [])
+    return sum(os.path.getsize(f) for f in fichiers if os.path.exists(f))
+
+
+def profil_memoire(chemin_reference, nb_entites, emprise, nb_lignes, nb_cellules, nb_colonnes, nb_sorties,
+                   demi_cote, marge):
+    """Coûts mémoire par m² déduits de la couche de référence et du fichier DRIAS.
+
+    Une entité compte quatre fois sa taille sur disque (géométrie, paires candidates, copies de travail)
+    plus ses résultats ; une cellule compte ses lignes DRIAS (toutes périodes) en float64, trois fois
+    (table Arrow, DataFrame et valeurs alignées).
+    """
+    xmin, ymin, xmax, ymax = emprise
+    surface = max((xmax - xmin) * (ymax - ymin), 1.0)
+    octets_entite = 4 * taille_couche(chemin_reference) / max(nb_entites, 1) + 8 * nb_sorties + 16 * 24
+    octets_cellule = 3 * 8 * nb_colonnes * nb_lignes / max(nb_cellules, 1)
+    return ProfilMemoire(nb_entites * octets_entite / surface, octets_cellule / (2 * demi_cote) ** 2, marge)
+
+
+def octets_tuile(tuile, profil):
+    """Mémoire estimée (octets) pour traiter une tuile, marge de cellules comprise."""
+    largeur, hauteur = tuile.xmax - tuile.xmin, tuile.ymax - tuile.ymin
+    return (largeur * hauteur * profil.entites
+            + (largeur + 2 * profil.marge) * (hauteur + 2 * profil.marge) * profil.cellules)
+
+
+def decouper_emprise(emprise, profil, budget_octets, departement=-1, cote_min=10_000.0):
+    """Tuiles carrées couvrant `emprise`, dont le côté est divisé par deux jusqu'à tenir dans le budget."""
+    xmin, ymin, xmax, ymax = emprise
+    cote = max(xmax - xmin, ymax - ymin, cote_min)
+    while cote > cote_min and octets_tuile(Tuile(0.0, 0.0, cote, cote), profil) > budget_octets:
+        cote /= 2
+    if octets_tuile(Tuile(0.0, 0.0, cote, cote), profil) > budget_octets:
+        print(f"ATTENTION: une tuile de {cote / 1000:.0f} km dépasse le budget mémoire "
+              f"({octets_tuile(Tuile(0.0, 0.0, cote, cote), profil) / 2**20:.0f} Mo estimés)")
+    nb_x = max(1, math.ceil((xmax - xmin) / cote))
+    nb_y = max(1, math.ceil((ymax - ymin) / cote))
+    return [Tuile(xmin + i * cote, ymin + j * cote, min(xmin + (i + 1) * cote, xmax),
+                  min(ymin + (j + 1) * cote, ymax), departement)
+            for j in range(nb_y) for i in range(nb_x)]
+
+
+def tuiles_reference(emprise, profil, budget_octets, bornes_departements=None):
+    """Tuiles de l'exécution : carrés sur toute l'emprise, ou un département par tuile (découpé s'il
+    dépasse le budget) quand `bornes_departements` (département x [xmin, ymin, xmax, ymax]) est fourni."""
+    if bornes_departements is None:
+        return decouper_emprise(emprise, profil, budget_octets)
+    tuiles = []
+    for departement, bornes in enumerate(bornes_departements):
+        tuiles.extend(decouper_emprise(bornes, profil, budget_octets, departement))
+    return tuiles
+
+
+def entites_de_la_tuile(geometries_entites, tuile, departement_entite=None):
+    """Masque des entités dont le point intérieur est dans la tuile (et dans son département).
+
+    Les bords supérieurs sont exclus : une entité dont le point tombe sur le bord de l'emprise n'est
+    prise par aucune tuile et doit être traitée à part (voir les entités restantes).
+    """
+    points = shapely.point_on_surface(np.asarray(geometries_entites))
+    x, y = shapely.get_x(points), shapely.get_y(points)
+    dedans = (x >= tuile.xmin) & (x < tuile.xmax) & (y >= tuile.ymin) & (y < tuile.ymax)
+    if tuile.departement >= 0:
+        dedans &= departement_entite == tuile.departement
+    return dedans
+
+
+def infos_couche(chemin, crs="EPSG:2154"):
+    """Nombre d'entités et emprise (dans `crs`) d'une couche, lus sans charger les géométries."""
+    infos = pyogrio.read_info(chemin, force_total_bounds=True)
+    xmin, ymin, xmax, ymax = infos["total_bounds"]
+    if infos["crs"] and CRS(infos["crs"]) != CRS(crs):
+        xmin, ymin, xmax, ymax = Transformer.from_crs(infos["crs"], crs, always_xy=True).transform_bounds(
+            xmin, ymin, xmax, ymax)
+    return infos["features"], (xmin, ymin, xmax, ymax)
+
+
+def fids_couche(chemin):
+    """Identifiants (FID) de toutes les entités d'une couche, sans géométrie ni attribut."""
+    return pyogrio.read_dataframe(chemin, columns=[], read_geometry=False, fid_as_index=True).index.to_numpy()
+
+
+def lire_entites(chemin, bornes=None, fids=None, crs="EPSG:2154"):
+    """Entités d'une couche dont l'emprise recoupe `bornes` (données dans `crs`) ou de FID `fids`,
+    indexées par FID et reprojetées dans `crs`."""
+    emprise = gpd.GeoSeries([shapely.box(*bornes)], crs=crs) if bornes is not None else None
+    entites = gpd.read_file(chemin, bbox=emprise, fids=fids, fid_as_index=True, engine="pyogrio")
+    if entites.crs is not None and entites.crs != crs:
+        entites = entites.to_crs(crs)
+    return entites
+
+
+def cellules_emprise(grille, bornes, marge):
+    """Indices des cellules de `grille` dont le centre est à moins de `marge` de l'emprise `bornes`
+    (avec marge = demi-côté, toutes les cellules qui recoupent l'emprise)."""
+    xmin, ymin, xmax, ymax = bornes
+    return np.flatnonzero((grille.x >= xmin - marge) & (grille.x <= xmax + marge)
+                          & (grille.y >= ymin - marge) & (grille.y <= ymax + marge))
+
+
+def memoire_max_mo():
+    """Pic de mémoire résidente du processus en Mo (None si la mesure n'est pas disponible)."""
+    if resource is None:
+        return None
+    pic = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return pic / (2**20 if sys.platform == "darwin" else 2**10)
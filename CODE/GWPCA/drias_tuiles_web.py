@@ -0,0 +1,95 @@
+# Export hors ligne des résultats DRIAS en tuiles vectorielles (PMTiles ou MBTiles, pilotes GDAL) pour que
+# la carte de DRIAS_INTERACTIVE ne charge que les tuiles visibles : une archive par couche de résultats,
+# régénérée seulement quand la couche a changé
+import json
+import os
+
+import geopandas as gpd
+
+from drias_cube import fichiers_resultats
+from drias_lots import ecrire_atomique
+from drias_sorties import empreinte_couche, geometries_associees, lire_resultats
+
+FORMATS_TUILES = {"PMTILES": ("PMTiles", ".pmtiles"), "MBTILES": ("MBTiles", ".mbtiles")}
+# Zooms (min, max) par niveau : les entités ne sont pas tuilées aux petites échelles (France entière)
+ZOOMS = {"entites": (5, 12), "departements": (0, 10), "regions": (0, 8)}
+# Simplification en unités de tuile (4096 par tuile) : la tolérance au sol est divisée par deux à chaque zoom
+SIMPLIFICATION = 8
+SIMPLIFICATION_ZOOM_MAX = 2
+MANIFESTE_TUILES = "tuiles.json"
+
+
+def niveau_resultat(nom):
+    """Niveau (entites, departements, regions) d'un fichier *_FINAL_RESULTS_*."""
+    if "_FINAL_RESULTS_REGIONS_" in nom:
+        return "regions"
+    if "_FINAL_RESULTS_DEPARTEMENTS_" in nom:
+        return "departements"
+    return "entites"
+
+
+def empreinte_resultat(chemin, *options):
+    """Empreinte d'un fichier de résultats (et de sa couche de géométries pour une table Parquet)."""
+    if chemin.endswith(".parquet"):
+        return empreinte_couche(chemin, empreinte_couche(geometries_associees(chemin)[0]), *options)
+    return empreinte_couche(chemin, *options)
+
+
+def lire_couche_resultat(chemin):
+    """Couche de résultats avec sa géométrie, quel que soit FORMAT_SORTIE."""
+    if chemin.endswith(".parquet"):
+        return lire_resultats(chemin, avec_geometrie=True)
+    return gpd.read_file(chemin)
+
+
+def exporter_tuiles(dossier_resultats, format_tuiles="PMTILES"):
+    """Écrit une archive de tuiles vectorielles par couche *_FINAL_RESULTS_* de `dossier_resultats` dans
+    son sous-dossier Tuiles/ (couche nommée entites, departements ou regions, attributs conservés).
+
+    Le manifeste Tuiles/tuiles.json garde l'empreinte de chaque couche source : seules les couches
+    nouvelles ou modifiées sont retuilées. Une couche illisible ou en échec est signalée sans
+    interrompre les autres (et retentée au prochain export). Retourne la liste des archives écrites.
+    """
+    pilote, extension = FORMATS_TUILES[format_tuiles]
+    dossier_tuiles = os.path.join(dossier_resultats, "Tuiles")
+    os.makedirs(dossier_tuiles, exist_ok=True)
+    chemin_manifeste = os.path.join(dossier_tuiles, MANIFESTE_TUILES)
+    manifeste = {}
+    if os.path.exists(chemin_manifeste):
+        with open(chemin_manifeste, encoding="utf-8") as f:
+            manifeste = json.load(f)
+
+    ecrites, inchangees, echecs = [], 0, []
+    for chemin in fichiers_resultats([dossier_resultats], "_FINAL_RESULTS_*"):
+        nom = os.path.splitext(os.path.basename(chemin))[0]
+        try:
+            niveau = niveau_resultat(nom)
+            zoom_min, zoom_max = ZOOMS[niveau]
+            sortie = os.path.join(dossier_tuiles, nom + extension)
+            empreinte = empreinte_resultat(chemin, pilote, zoom_min, zoom_max, SIMPLIFICATION, SIMPLIFICATION_ZOOM_MAX)
+            if manifeste.get(nom) == empreinte and os.path.exists(sortie):
+                inchangees += 1
+                continue
+
+            couche = lire_couche_resultat(chemin)
+            ecrire_atomique(sortie, lambda c: couche.to_file(
+                c, driver=pilote, layer=niveau, engine="pyogrio",
+                dataset_options={"NAME": nom, "MINZOOM": zoom_min, "MAXZOOM": zoom_max,
+                                 "SIMPLIFICATION": SIMPLIFICATION, "SIMPLIFICATION_MAX_ZOOM": SIMPLIFICATION_ZOOM_MAX}))
+        except Exception as e:
+            print(f"Erreur lors de l'export des tuiles de {chemin}: {e}")
+            manifeste.pop(nom, None)
+            echecs.append(chemin)
+            continue
+        manifeste[nom] = empreinte
+        ecrites.append(sortie)
+        print(f"Tuiles vectorielles écrites: {sortie} (zooms {zoom_min}-{zoom_max}, {len(couche)} entités)")
+
+    if ecrites or echecs:
+        def ecrire_manifeste(c):
+            with open(c, "w", encoding="utf-8") as f:
+                json.dump(manifeste, f, indent=1)
+        ecrire_atomique(chemin_manifeste, ecrire_manifeste)
+    print(f"Tuiles vectorielles: {len(ecrites)} couche(s) régénérée(s), {inchangees} inchangée(s), "
+          f"{len(echecs)} échec(s)")
+    return ecrites
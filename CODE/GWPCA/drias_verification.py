@@ -0,0 +1,98 @@
+# Vérification des moyennes DRIAS (GENERER_VERIFICATION) construite après le calcul, à partir des lignes de la
+# matrice des poids : échantillon d'entités reproductible, une table de détail, figures facultatives
+import os
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import shapely
+from matplotlib.collections import PathCollection
+
+from drias_cartes import chemins_polygones
+from drias_poids import geometries_grille
+from drias_sorties import COLONNE_ID
+
+
+def echantillon_entites(nb_entites, nb_verifications, graine=0):
+    """Positions triées de `nb_verifications` entités tirées au hasard, identiques d'une exécution à l'autre
+    pour la même graine."""
+    rng = np.random.default_rng(graine)
+    return np.sort(rng.choice(nb_entites, size=min(nb_verifications, nb_entites), replace=False))
+
+
+def table_verification(matrice_poids, indices, ids_entites, ids_cellules, valeurs_cellules, moyennes, noms_sorties,
+                       descriptions=None):
+    """Détail du calcul des entités `indices` pour chaque sortie : une ligne par (entité, sortie, cellule).
+
+    `valeurs_cellules` (cellules x sorties) et `moyennes` (entités x sorties) sont dans l'ordre de
+    `noms_sorties`. Les poids sont renormalisés sur les cellules valides comme dans moyennes_ponderees ;
+    `moyenne_recalculee` est la somme des contributions et `ecart` sa différence avec la moyenne écrite
+    (float32, d'où des écarts de l'ordre de 1e-7 en relatif).
+    `poids_brut` est l'aire d'intersection (m²) en mode SURFACE, le coefficient d'interpolation sinon.
+    """
+    paires = matrice_poids[indices].tocoo()
+    lignes, colonnes, poids_brut = paires.row, paires.col, paires.data
+    valeurs = np.asarray(valeurs_cellules, dtype=np.float64)[colonnes]          # paires x sorties
+    poids_valides = np.where(np.isnan(valeurs), 0.0, poids_brut[:, None])
+    denominateur = np.zeros((len(indices), len(noms_sorties)))
+    np.add.at(denominateur, lignes, poids_valides)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        poids = poids_valides / denominateur[lignes]
+    contributions = poids * valeurs
+    recalculees = np.zeros_like(denominateur)
+    np.add.at(recalculees, lignes, np.nan_to_num(contributions))
+    recalculees[denominateur <= 0] = np.nan
+    calculees = np.asarray(moyennes, dtype=np.float64)[indices]
+
+    # Table longue : sortie la plus rapide dans les tableaux (paires x sorties), puis tri par entité et sortie
+    nb_sorties = len(noms_sorties)
+    ligne_paire = np.repeat(lignes, nb_sorties)
+    sortie = np.tile(np.arange(nb_sorties), len(lignes))
+    table = pd.DataFrame({
+        COLONNE_ID: np.asarray(ids_entites)[indices][ligne_paire],
+        "sortie": np.asarray(noms_sorties, dtype=object)[sortie],
+        "id_cellule": np.asarray(ids_cellules)[np.repeat(colonnes, nb_sorties)],
+        "poids_brut": np.repeat(poids_brut, nb_sorties),
+        "poids": poids.ravel(),
+        "valeur": valeurs.ravel(),
+        "contribution": contributions.ravel(),
+        "moyenne_recalculee": recalculees[ligne_paire, sortie],
+        "moyenne_calculee": calculees[ligne_paire, sortie],
+    })
+    table["ecart"] = table["moyenne_calculee"] - table["moyenne_recalculee"]
+    if descriptions is not None and len(descriptions.columns):
+        for position, colonne in enumerate(descriptions.columns, start=1):
+            table.insert(position, colonne, descriptions[colonne].to_numpy()[indices][ligne_paire])
+    ordre = np.lexsort((np.repeat(np.arange(len(lignes)), nb_sorties), sortie, ligne_paire))
+    return table.iloc[ordre].reset_index(drop=True)
+
+
+def figures_verification(dossier, prefixe, geometries_entites, noms_entites, indices, matrice_poids, grille, dpi=150):
+    """Une figure par entité vérifiée : son contour sur les cellules qui la recouvrent, coloriées par leur
+    part du poids de l'entité. Retourne les chemins écrits."""
+    chemins = []
+    for position in indices:
+        debut, fin = matrice_poids.indptr[position], matrice_poids.indptr[position + 1]
+        if fin == debut:
+            continue
+        poids = matrice_poids.data[debut:fin] / matrice_poids.data[debut:fin].sum()
+        cellules = geometries_grille(grille, matrice_poids.indices[debut:fin])
+        entite = np.asarray(geometries_entites)[[position]]
+
+        fig, ax = plt.subplots(figsize=(10, 10))
+        collection = PathCollection(chemins_polygones(cellules), cmap='viridis', alpha=0.6, edgecolor='0.3', linewidth=0.5)
+        collection.set_array(poids)
+        ax.add_collection(collection, autolim=False)
+        ax.add_collection(PathCollection(chemins_polygones(entite), facecolor='none', edgecolor='black', linewidth=1.5),
+                          autolim=False)
+        xmin, ymin, xmax, ymax = shapely.total_bounds(np.concatenate([cellules, entite]))
+        ax.set_xlim(xmin, xmax)
+        ax.set_ylim(ymin, ymax)
+        ax.set_aspect('equal')
+        fig.colorbar(collection, ax=ax, shrink=0.6, label="Part du poids de l'entité")
+        ax.set_title(f"Vérification de l'entité {position + 1} - {noms_entites[position]}\n{fin - debut} cellule(s)")
+        chemin = os.path.join(dossier, f"{prefixe}_entite_{position + 1}_{str(noms_entites[position]).replace(' ', '_')}.png")
+        fig.savefig(chemin, dpi=dpi)
+        plt.close(fig)
+        chemins.append(chemin)
+    return chemins